@@ -0,0 +1,1227 @@
+#!/usr/bin/python -u
+"""
+Benchmark of ceph-backup.py on a simulated cloud.
+
+ceph-backup.py runs unmodified against in-memory stand-ins for rados, rbd,
+libvirt, Nova, Cinder and Keystone with configurable latencies and
+bandwidth. For every fleet size a synthetic fleet gets a full backup,
+incremental backups after days of changes and restores of a few instances.
+Each run is forked, so its wall time, peak memory and phase breakdown
+(taken from the metrics of ceph-backup.py) are measured separately.
+With --s3 backup files go to an in-memory S3 stand-in served over HTTP
+by the bench itself, as they would go to RGW.
+Results can be saved as JSON and compared with a baseline saved before
+a change:
+
+    ./ceph-backup-bench.py --fleet 10,100,1000 --json before.json
+    ./ceph-backup-bench.py --fleet 10,100,1000 --baseline before.json
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+import json
+import math
+import uuid
+import errno
+import random
+import marshal
+import resource
+import runpy
+import shutil
+import tempfile
+import argparse
+import hashlib
+import urllib
+import urlparse
+import BaseHTTPServer
+import SocketServer
+import functools
+import threading
+import traceback
+import types
+from multiprocessing.pool import ThreadPool
+from xml.sax.saxutils import escape
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ceph-backup.py')
+MB = 1024**2
+DAY = 86400
+# Extents of fake images are versions, their bytes are cut from this buffer
+DATA = os.urandom(4*MB)
+# Share of daily changes going to the hot set of an image
+HOT_SHARE = 0.8
+HOT_FRACTION = 0.1
+AIO_THREADS = 16
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark ceph-backup.py on a simulated "
+                                                 "Ceph cluster and OpenStack cloud")
+    parser.add_argument("--script", default=SCRIPT,
+                        help="ceph-backup.py to run (default: %(default)s)")
+    parser.add_argument("--fleet", default="10,100",
+                        help="Comma separated numbers of instances to simulate (default: %(default)s)")
+    parser.add_argument("--days", type=int, default=3,
+                        help="Days of changes with an incremental backup each (default: %(default)s)")
+    parser.add_argument("--inc-type", choices=['inc', 'auto'], default='inc',
+                        help="Backup type of the daily runs after the full one (default: %(default)s)")
+    parser.add_argument("--restores", type=int, default=3,
+                        help="Instances restored to the last backup (default: %(default)s)")
+    parser.add_argument("--disk-size", type=float, default=8,
+                        help="Root disk size in MB (default: %(default)s)")
+    parser.add_argument("--volumes", type=int, default=1,
+                        help="Volumes attached to every instance (default: %(default)s)")
+    parser.add_argument("--volume-size", type=float, default=8,
+                        help="Volume size in MB (default: %(default)s)")
+    parser.add_argument("--used", type=float, default=0.25,
+                        help="Allocated fraction of images (default: %(default)s)")
+    parser.add_argument("--change-rate", type=float, default=0.03,
+                        help="Mean fraction of allocated data rewritten per day (default: %(default)s)")
+    parser.add_argument("--change-skew", type=float, default=1.0,
+                        help="Sigma of the log-normal spread of change rates among images "
+                             "(default: %(default)s)")
+    parser.add_argument("--extent-size", type=int, default=64,
+                        help="Granularity of image changes in KB (default: %(default)s)")
+    parser.add_argument("--rbd-latency", type=float, default=1,
+                        help="Latency of RBD operations in ms (default: %(default)s)")
+    parser.add_argument("--rbd-bandwidth", type=float, default=200,
+                        help="Bandwidth of one RBD read or write stream in MB/s, 0 for "
+                             "unlimited (default: %(default)s)")
+    parser.add_argument("--cluster-bandwidth", type=float, default=2000,
+                        help="Bandwidth of the whole cluster in MB/s, 0 for unlimited "
+                             "(default: %(default)s)")
+    parser.add_argument("--snap-latency", type=float, default=20,
+                        help="Latency of snapshot creation and removal in ms (default: %(default)s)")
+    parser.add_argument("--api-latency", type=float, default=50,
+                        help="Latency of Nova, Cinder and Keystone calls in ms (default: %(default)s)")
+    parser.add_argument("--libvirt-latency", type=float, default=10,
+                        help="Latency of libvirt connections, guest agent calls and "
+                             "freezes in ms (default: %(default)s)")
+    parser.add_argument("--fail-rate", type=float, default=0,
+                        help="Probability of an injected I/O error per RBD read or write "
+                             "(default: %(default)s)")
+    parser.add_argument("--vms-per-host", type=int, default=20,
+                        help="Instances per hypervisor (default: %(default)s)")
+    parser.add_argument("--vms-per-tenant", type=int, default=50,
+                        help="Instances per tenant (default: %(default)s)")
+    parser.add_argument("--s3", action='store_true', default=False,
+                        help="Store backup files in an in-memory S3 stand-in")
+    parser.add_argument("--s3-latency", type=float, default=5,
+                        help="Latency of S3 requests in ms (default: %(default)s)")
+    parser.add_argument("-o", dest='options', action='append', default=[], metavar='KEY=VALUE',
+                        help="Option of the [default] section of the ceph-backup.py config, "
+                             "may be repeated (e.g. -o backup_workers=8)")
+    parser.add_argument("--seed", type=int, default=1,
+                        help="Seed of the fleet and its changes (default: %(default)s)")
+    parser.add_argument("--workdir",
+                        help="Directory for backups and logs (default: a temporary one)")
+    parser.add_argument("--keep", action='store_true', default=False,
+                        help="Keep backups and logs of the runs")
+    parser.add_argument("--json", dest='json_file',
+                        help="Save results to this file")
+    parser.add_argument("--check-resume", action='store_true', default=False,
+                        help="Also fail a backup and a restore of every fleet partway, run them "
+                             "again and check they were resumed and restore the snapshots "
+                             "exactly, exit with an error otherwise")
+    parser.add_argument("--verify", action='store_true', default=False,
+                        help="Check that restored images are the same as their snapshots and "
+                             "nothing failed but steps with injected I/O errors, exit with an "
+                             "error otherwise")
+    parser.add_argument("--baseline",
+                        help="Compare results with ones saved earlier with --json")
+    return parser.parse_args()
+
+class FakeCluster(object):
+    """
+    State of the simulated cluster and cloud: images with their snapshots,
+    instances, volumes and projects. Extents changed by the simulation have
+    a version number and reads return bytes derived from it, extents written
+    through the rbd stand-in (by restores) keep the bytes written. With
+    fail_after set reads and writes of an image fail once that many bytes
+    of it were transferred. Injected errors are counted.
+    """
+    def __init__(self, opts):
+        self.opts = opts
+        self.extent = opts.extent_size*1024
+        # (pool, name) -> [size, {extent: version}, [snapshot, ...]]
+        self.images = {}
+        self.servers = []
+        self.volumes = []
+        self.projects = []
+        # (pool, name) -> daily change rate, hot extents
+        self.rates = {}
+        self.hot = {}
+        self.version = 0
+        self.lock = threading.Lock()
+        self.busy_until = 0.0
+        self.aio = None
+        self.fail_after = None
+        # (pool, name) -> bytes transferred while fail_after is set
+        self.transferred = {}
+        self.injected = 0
+
+    def next_version(self):
+        with self.lock:
+            self.version += 1
+            return self.version
+
+    @staticmethod
+    def delay(ms):
+        if ms > 0:
+            time.sleep(ms/1000.0)
+
+    def transfer(self, nbytes, key=None):
+        # Latency and stream bandwidth of the op, queued behind other ops for cluster bandwidth
+        opts = self.opts
+        wait = opts.rbd_latency/1000.0
+        if opts.rbd_bandwidth > 0:
+            wait += nbytes/(opts.rbd_bandwidth*MB)
+        if opts.cluster_bandwidth > 0:
+            with self.lock:
+                now = time.time()
+                self.busy_until = max(self.busy_until, now) + nbytes/(opts.cluster_bandwidth*MB)
+                wait = max(wait, self.busy_until - now)
+        if wait > 0:
+            time.sleep(wait)
+        if opts.fail_rate and random.random() < opts.fail_rate:
+            with self.lock:
+                self.injected += 1
+            raise RBDIOError("Injected I/O error")
+        if self.fail_after is not None:
+            with self.lock:
+                self.transferred[key] = self.transferred.get(key, 0) + nbytes
+                failing = self.transferred[key] > self.fail_after
+                self.injected += failing
+            if failing:
+                raise RBDIOError("Injected I/O error after %d bytes" % self.fail_after)
+
+    def aio_pool(self):
+        # Created on first use, in the process of the run
+        with self.lock:
+            if self.aio is None:
+                self.aio = ThreadPool(AIO_THREADS)
+            return self.aio
+
+    def server(self, server_id):
+        for info in self.servers:
+            if info['id'] == server_id:
+                return info
+
+    def dump(self, path):
+        with open(path, 'wb') as f:
+            marshal.dump((self.images, self.version, self.servers, self.transferred,
+                          self.injected), f)
+
+    def load(self, path):
+        with open(path, 'rb') as f:
+            self.images, self.version, self.servers, self.transferred, \
+                self.injected = marshal.load(f)
+
+CLUSTER = None
+
+def extent_data(idx, value, step):
+    # Bytes of extent idx, derived from its version or as written
+    if isinstance(value, str):
+        return value
+    start = (idx*7919 + value*104729) % (len(DATA) - step)
+    return DATA[start:start + step]
+
+def image_digest(cluster, key, snap_name=None):
+    # SHA-1 of the content of image or its snapshot, holes read as zeros
+    size, extents, snaps = cluster.images[key]
+    for snap in snaps if snap_name else []:
+        if snap['name'] == snap_name:
+            size, extents = snap['size'], snap['extents']
+    step = cluster.extent
+    zeros = '\0'*step
+    digest = hashlib.sha1()
+    for idx in range((size + step - 1)//step):
+        value = extents.get(idx)
+        data = zeros if value is None else extent_data(idx, value, step)
+        digest.update(data[:min(step, size - idx*step)])
+    return digest.hexdigest()
+
+def build_fleet(cluster, count, rnd):
+    opts = cluster.opts
+    hosts = max(1, count//opts.vms_per_host)
+    tenants = int(math.ceil(count/float(opts.vms_per_tenant)))
+    cluster.projects = [{'id': '%032x' % (n + 1), 'name': 'tenant%d' % n} for n in range(tenants)]
+    for n in range(count):
+        server_id = str(uuid.UUID(int=rnd.getrandbits(128)))
+        tenant_id = cluster.projects[n % tenants]['id']
+        cluster.servers.append({'id': server_id, 'name': 'vm%05d' % n, 'tenant_id': tenant_id,
+                                'image': {'id': 'bench'}, 'status': 'ACTIVE',
+                                'metadata': {'storage': 'rbd:ceph/vms'},
+                                'OS-EXT-STS:power_state': 1,
+                                'OS-EXT-SRV-ATTR:hypervisor_hostname': 'compute%04d' % (n % hosts),
+                                'OS-EXT-SRV-ATTR:instance_name': 'instance-%08x' % n})
+        add_image(cluster, ('vms', server_id + '_disk'), opts.disk_size, rnd)
+        for k in range(opts.volumes):
+            volume_id = str(uuid.UUID(int=rnd.getrandbits(128)))
+            cluster.volumes.append({'id': volume_id, 'name': 'vm%05d-vol%d' % (n, k),
+                                    'os-vol-tenant-attr:tenant_id': tenant_id,
+                                    'size': int(math.ceil(opts.volume_size/1024.0)),
+                                    'attachments': [{'server_id': server_id,
+                                                     'device': '/dev/vd%s' % chr(ord('b') + k)}]})
+            add_image(cluster, ('volumes', 'volume-' + volume_id), opts.volume_size, rnd)
+    cluster.servers.sort(key=lambda info: info['id'])
+    cluster.volumes.sort(key=lambda info: info['id'])
+
+def add_image(cluster, key, size_mb, rnd):
+    opts = cluster.opts
+    size = int(size_mb*MB)
+    count = int(math.ceil(size/float(cluster.extent)))
+    allocated = rnd.sample(xrange(count), int(count*opts.used))
+    version = cluster.next_version()
+    cluster.images[key] = [size, dict((idx, version) for idx in allocated), []]
+    # Log-normal change rates keep most images quiet and a few very busy
+    sigma = opts.change_skew
+    mu = math.log(opts.change_rate) - sigma**2/2 if opts.change_rate > 0 else None
+    cluster.rates[key] = min(1.0, rnd.lognormvariate(mu, sigma)) if mu is not None else 0
+    cluster.hot[key] = allocated[:max(1, int(len(allocated)*HOT_FRACTION))]
+
+def change_images(cluster, rnd):
+    # One day of writes, returns bytes changed
+    changed = 0
+    for key, (size, extents, snaps) in cluster.images.items():
+        if key not in cluster.rates:
+            continue
+        count = int(math.ceil(size/float(cluster.extent)))
+        writes = int(cluster.rates[key]*max(1, len(extents)) + rnd.random())
+        version = cluster.next_version()
+        hot = cluster.hot[key]
+        for n in range(writes):
+            idx = rnd.choice(hot) if hot and rnd.random() < HOT_SHARE else rnd.randrange(count)
+            extents[idx] = version
+        changed += writes*cluster.extent
+    return changed
+
+# Stand-ins for rados and rbd
+
+class RBDError(Exception):
+    pass
+
+class ImageNotFound(RBDError):
+    pass
+
+class ImageExists(RBDError):
+    pass
+
+class RBDIOError(RBDError):
+    pass
+
+class Ioctx(object):
+    def __init__(self, pool):
+        self.pool = pool
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class Rados(object):
+    def __init__(self, conffile=None, **kwargs):
+        pass
+
+    def connect(self):
+        CLUSTER.delay(CLUSTER.opts.rbd_latency)
+
+    def shutdown(self):
+        pass
+
+    def open_ioctx(self, pool):
+        return Ioctx(pool)
+
+    def list_pools(self):
+        return sorted(set(pool for pool, name in CLUSTER.images))
+
+    def mon_command(self, cmd, inbuf, timeout=0):
+        CLUSTER.delay(CLUSTER.opts.rbd_latency)
+        if json.loads(cmd).get('prefix') == 'osd perf':
+            latency = CLUSTER.opts.rbd_latency
+            return 0, json.dumps({'osd_perf_infos': [{'id': 0, 'perf_stats':
+                                  {'commit_latency_ms': latency, 'apply_latency_ms': latency}}]}), ''
+        return -errno.EINVAL, '', 'Command is not simulated'
+
+class RBD(object):
+    def list(self, ioctx):
+        CLUSTER.delay(CLUSTER.opts.rbd_latency)
+        return sorted(name for pool, name in CLUSTER.images.keys() if pool == ioctx.pool)
+
+    def create(self, ioctx, name, size, order=None, old_format=True, features=None, **kwargs):
+        CLUSTER.delay(CLUSTER.opts.rbd_latency)
+        with CLUSTER.lock:
+            if (ioctx.pool, name) in CLUSTER.images:
+                raise ImageExists("Image %s exists" % name)
+            CLUSTER.images[(ioctx.pool, name)] = [size, {}, []]
+
+    def remove(self, ioctx, name):
+        CLUSTER.delay(CLUSTER.opts.rbd_latency)
+        with CLUSTER.lock:
+            if (ioctx.pool, name) not in CLUSTER.images:
+                raise ImageNotFound("Image %s not found" % name)
+            del CLUSTER.images[(ioctx.pool, name)]
+
+    def rename(self, ioctx, src, dest):
+        CLUSTER.delay(CLUSTER.opts.rbd_latency)
+        with CLUSTER.lock:
+            if (ioctx.pool, src) not in CLUSTER.images:
+                raise ImageNotFound("Image %s not found" % src)
+            CLUSTER.images[(ioctx.pool, dest)] = CLUSTER.images.pop((ioctx.pool, src))
+
+class Completion(object):
+    def __init__(self, ret):
+        self.ret = ret
+
+    def get_return_value(self):
+        return self.ret
+
+class Image(object):
+    def __init__(self, ioctx, name, snapshot=None, read_only=False):
+        CLUSTER.delay(CLUSTER.opts.rbd_latency)
+        if (ioctx.pool, name) not in CLUSTER.images:
+            raise ImageNotFound("Image %s not found" % name)
+        self.ioctx = ioctx
+        self.name = name
+        self.state = CLUSTER.images[(ioctx.pool, name)]
+        self.snap = None
+        if snapshot is not None:
+            self.set_snap(snapshot)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        pass
+
+    def flush(self):
+        pass
+
+    def find_snap(self, name):
+        for snap in self.state[2]:
+            if snap['name'] == name:
+                return snap
+        raise ImageNotFound("Snapshot %s of %s not found" % (name, self.name))
+
+    def set_snap(self, name):
+        self.snap = None if name is None else self.find_snap(name)
+
+    def view(self):
+        if self.snap:
+            return self.snap['size'], self.snap['extents']
+        return self.state[0], self.state[1]
+
+    def size(self):
+        return self.view()[0]
+
+    def stat(self):
+        size = self.size()
+        return {'size': size, 'order': 22, 'obj_size': 4*MB, 'num_objs': (size + 4*MB - 1)//(4*MB),
+                'block_name_prefix': 'rbd_data.' + self.name, 'parent_pool': -1, 'parent_name': ''}
+
+    def features(self):
+        return 61
+
+    def old_format(self):
+        return False
+
+    def stripe_unit(self):
+        return 4*MB
+
+    def stripe_count(self):
+        return 1
+
+    def list_lockers(self):
+        return []
+
+    def parent_info(self):
+        raise ImageNotFound("Image %s has no parent" % self.name)
+
+    def list_snaps(self):
+        CLUSTER.delay(CLUSTER.opts.rbd_latency)
+        return [{'id': snap['id'], 'name': snap['name'], 'size': snap['size']}
+                for snap in self.state[2]]
+
+    def create_snap(self, name):
+        CLUSTER.delay(CLUSTER.opts.snap_latency)
+        with CLUSTER.lock:
+            if any(snap['name'] == name for snap in self.state[2]):
+                raise ImageExists("Snapshot %s of %s exists" % (name, self.name))
+        self.state[2].append({'id': CLUSTER.next_version(), 'name': name,
+                              'size': self.state[0], 'extents': dict(self.state[1])})
+
+    def remove_snap(self, name):
+        CLUSTER.delay(CLUSTER.opts.snap_latency)
+        snap = self.find_snap(name)
+        with CLUSTER.lock:
+            self.state[2].remove(snap)
+
+    def resize(self, size):
+        CLUSTER.delay(CLUSTER.opts.rbd_latency)
+        last = (size - 1)//CLUSTER.extent
+        for idx in [idx for idx in self.state[1] if idx > last]:
+            del self.state[1][idx]
+        self.state[0] = size
+
+    def diff_iterate(self, offset, length, from_snapshot, iterate_cb,
+                     include_parent=True, whole_object=False):
+        CLUSTER.delay(CLUSTER.opts.rbd_latency)
+        size, extents = self.view()
+        base = self.find_snap(from_snapshot)['extents'] if from_snapshot else {}
+        step = CLUSTER.extent
+        end = min(offset + length, size)
+        first, last = offset//step, (end - 1)//step
+        runs = []
+        for idx in sorted(set(extents) | set(base)):
+            if idx < first or idx > last or extents.get(idx) == base.get(idx):
+                continue
+            exists = idx in extents
+            if runs and runs[-1][1] == idx and runs[-1][2] == exists:
+                runs[-1][1] = idx + 1
+            else:
+                runs.append([idx, idx + 1, exists])
+        for start, stop, exists in runs:
+            start, stop = max(start*step, offset), min(stop*step, end)
+            iterate_cb(start, stop - start, exists)
+        return 0
+
+    def read(self, offset, length, fadvise_flags=0):
+        size, extents = self.view()
+        length = max(0, min(length, size - offset))
+        CLUSTER.transfer(length, (self.ioctx.pool, self.name))
+        step = CLUSTER.extent
+        out = []
+        pos, end = offset, offset + length
+        while pos < end:
+            idx = pos//step
+            n = min((idx + 1)*step, end) - pos
+            value = extents.get(idx)
+            if value is None:
+                out.append('\0'*n)
+            else:
+                start = pos - idx*step
+                out.append(extent_data(idx, value, step)[start:start + n])
+            pos += n
+        return ''.join(out)
+
+    def write(self, data, offset, fadvise_flags=0):
+        CLUSTER.transfer(len(data), (self.ioctx.pool, self.name))
+        step = CLUSTER.extent
+        extents = self.state[1]
+        pos, end = offset, offset + len(data)
+        # Partially written extents are merged under the lock, aio writes may share them
+        with CLUSTER.lock:
+            while pos < end:
+                idx = pos//step
+                start = pos - idx*step
+                n = min((idx + 1)*step, end) - pos
+                piece = data[pos - offset:pos - offset + n]
+                if n < step:
+                    value = extents.get(idx)
+                    old = '\0'*step if value is None else extent_data(idx, value, step)
+                    piece = old[:start] + piece + old[start + n:]
+                if piece.count('\0') == step:
+                    extents.pop(idx, None)
+                else:
+                    extents[idx] = piece
+                pos += n
+        return len(data)
+
+    def aio_write(self, data, offset, oncomplete, fadvise_flags=0):
+        def run():
+            try:
+                ret = self.write(data, offset)
+            except RBDError:
+                ret = -errno.EIO
+            oncomplete(Completion(ret))
+        CLUSTER.aio_pool().apply_async(run)
+        return Completion(0)
+
+# Stand-ins for libvirt and SSH
+
+class LibvirtError(Exception):
+    pass
+
+class Domain(object):
+    def isActive(self):
+        return True
+
+    def fsFreeze(self, mountpoints=None, flags=0):
+        CLUSTER.delay(CLUSTER.opts.libvirt_latency)
+        return 1
+
+    def fsThaw(self, mountpoints=None, flags=0):
+        CLUSTER.delay(CLUSTER.opts.libvirt_latency)
+        return 1
+
+class LibvirtConnection(object):
+    def lookupByName(self, name):
+        return Domain()
+
+    def isAlive(self):
+        return True
+
+    def close(self):
+        pass
+
+def libvirt_open(uri):
+    CLUSTER.delay(CLUSTER.opts.libvirt_latency)
+    return LibvirtConnection()
+
+def qemu_agent_command(dom, cmd, timeout, flags):
+    CLUSTER.delay(CLUSTER.opts.libvirt_latency)
+    return '{"return": {}}'
+
+class SSHChannel(object):
+    def set_combine_stderr(self, combine):
+        pass
+
+    def exec_command(self, cmd):
+        pass
+
+    def makefile(self, mode):
+        return open(os.devnull, mode)
+
+    def recv_exit_status(self):
+        # Commands on hypervisors are not simulated
+        return 1
+
+    def close(self):
+        pass
+
+class SSHTransport(object):
+    def is_active(self):
+        return True
+
+    def open_session(self):
+        return SSHChannel()
+
+class SSHClient(object):
+    def set_missing_host_key_policy(self, policy):
+        pass
+
+    def connect(self, host, **kwargs):
+        CLUSTER.delay(CLUSTER.opts.libvirt_latency)
+
+    def get_transport(self):
+        return SSHTransport()
+
+    def close(self):
+        pass
+
+# Stand-ins for Nova, Cinder and Keystone
+
+class Resource(object):
+    def __init__(self, manager, info, loaded=True):
+        self.manager = manager
+        self._info = dict(info)
+        self.__dict__.update(info)
+
+    def to_dict(self):
+        return dict(self._info)
+
+class Server(Resource):
+    def set_power(self, status, power_state):
+        CLUSTER.delay(CLUSTER.opts.api_latency)
+        info = CLUSTER.server(self.id)
+        for values in (info, self._info, self.__dict__):
+            values['status'] = status
+            values['OS-EXT-STS:power_state'] = power_state
+
+    def stop(self):
+        self.set_power('SHUTOFF', 4)
+
+    def start(self):
+        self.set_power('ACTIVE', 1)
+
+class Volume(Resource):
+    pass
+
+class Manager(object):
+    def __init__(self, resource_class, objects):
+        self.resource_class = resource_class
+        self.objects = objects
+
+    def list(self, search_opts=None, marker=None, limit=None, **kwargs):
+        CLUSTER.delay(CLUSTER.opts.api_latency)
+        infos = self.objects()
+        if marker:
+            infos = [info for info in infos if info['id'] > marker]
+        return [self.resource_class(self, info) for info in infos[:limit]]
+
+    def get(self, object_id):
+        CLUSTER.delay(CLUSTER.opts.api_latency)
+        for info in self.objects():
+            if info['id'] == object_id:
+                return self.resource_class(self, info)
+
+class NovaClient(object):
+    def __init__(self, version, session=None, **kwargs):
+        self.servers = Manager(Server, lambda: CLUSTER.servers)
+
+class CinderClient(object):
+    def __init__(self, session=None, **kwargs):
+        self.volumes = Manager(Volume, lambda: CLUSTER.volumes)
+
+class Project(object):
+    def __init__(self, info):
+        self.id = info['id']
+        self.name = info['name']
+
+class Projects(object):
+    def list(self):
+        CLUSTER.delay(CLUSTER.opts.api_latency)
+        return [Project(info) for info in CLUSTER.projects]
+
+class KeystoneClient(object):
+    def __init__(self, session=None, **kwargs):
+        self.projects = Projects()
+
+class Session(object):
+    def __init__(self, auth=None, **kwargs):
+        CLUSTER.delay(CLUSTER.opts.api_latency)
+
+class Password(object):
+    def __init__(self, **kwargs):
+        pass
+
+FAKE_MODULES = {
+    'rados': {'Rados': Rados, 'Ioctx': Ioctx, 'Error': RBDError},
+    'rbd': {'RBD': RBD, 'Image': Image, 'Error': RBDError, 'IOError': RBDIOError,
+            'ImageNotFound': ImageNotFound, 'ImageExists': ImageExists},
+    'libvirt': {'open': libvirt_open, 'libvirtError': LibvirtError},
+    'libvirt_qemu': {'qemuAgentCommand': qemu_agent_command},
+    'paramiko': {'SSHClient': SSHClient, 'AutoAddPolicy': object},
+    'novaclient.client': {'Client': NovaClient},
+    'cinderclient.v2.client': {'Client': CinderClient},
+    'keystoneclient.session': {'Session': Session},
+    'keystoneclient.auth.identity.v3': {'Password': Password},
+    'keystoneclient.v3.client': {'Client': KeystoneClient},
+}
+
+def install_fakes():
+    for name, attrs in FAKE_MODULES.items():
+        parts = name.split('.')
+        for n in range(1, len(parts) + 1):
+            package = '.'.join(parts[:n])
+            if package not in sys.modules:
+                sys.modules[package] = types.ModuleType(package)
+            if n > 1:
+                setattr(sys.modules['.'.join(parts[:n - 1])], parts[n - 1], sys.modules[package])
+        sys.modules[name].__dict__.update(attrs)
+
+# Stand-in for RGW/S3
+
+class S3Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Path style S3 requests used by ceph-backup.py: objects, ranged reads,
+    listings, multipart uploads, copies and multi-object deletes. Objects
+    are kept in memory of the bench process, signatures are not checked.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, body='', headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def xml(self, status, root, body):
+        self.reply(status, '<?xml version="1.0" encoding="UTF-8"?><%s>%s</%s>' % (root, body, root),
+                   {'Content-Type': 'application/xml'})
+
+    def parse(self):
+        time.sleep(self.server.latency)
+        url = urlparse.urlsplit(self.path)
+        _, _, key = url.path.lstrip('/').partition('/')
+        query = dict((name, values[0]) for name, values in
+                     urlparse.parse_qs(url.query, keep_blank_values=True).items())
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else ''
+        return urllib.unquote(key), query, body
+
+    def source(self):
+        _, _, key = urllib.unquote(self.headers['x-amz-copy-source']).lstrip('/').partition('/')
+        return self.server.objects.get(key)
+
+    def stored(self, key, data):
+        etag = '"%s"' % hashlib.md5(data).hexdigest()
+        with self.server.lock:
+            self.server.objects[key] = data
+        return etag
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        key, query, _ = self.parse()
+        objects = self.server.objects
+        if not key:
+            prefix, marker = query.get('prefix', ''), query.get('marker', '')
+            names = sorted(name for name in list(objects)
+                           if name.startswith(prefix) and name > marker)
+            contents = ''.join('<Contents><Key>%s</Key><LastModified>2000-01-01T00:00:00.000Z'
+                               '</LastModified><ETag>"%s"</ETag><Size>%d</Size>'
+                               '<StorageClass>STANDARD</StorageClass></Contents>'
+                               % (escape(name), hashlib.md5(objects.get(name, '')).hexdigest(),
+                                  len(objects.get(name, ''))) for name in names[:1000])
+            return self.xml(200, 'ListBucketResult', '<Name>bench</Name><Prefix>%s</Prefix>'
+                            '<IsTruncated>%s</IsTruncated>%s'
+                            % (escape(prefix), 'true' if len(names) > 1000 else 'false', contents))
+        data = objects.get(key)
+        if data is None:
+            return self.xml(404, 'Error', '<Code>NoSuchKey</Code>')
+        headers = {'ETag': '"%s"' % hashlib.md5(data).hexdigest(),
+                   'Last-Modified': 'Sat, 01 Jan 2000 00:00:00 GMT'}
+        if 'Range' in self.headers:
+            start, _, end = self.headers['Range'].split('=')[1].partition('-')
+            start, end = int(start), min(int(end), len(data) - 1)
+            headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end, len(data))
+            self.reply(206, data[start:end + 1], headers)
+        else:
+            self.reply(200, data, headers)
+
+    def do_PUT(self):
+        key, query, body = self.parse()
+        server = self.server
+        if 'uploadId' in query:
+            if query['uploadId'] not in server.uploads:
+                return self.xml(404, 'Error', '<Code>NoSuchUpload</Code>')
+            if 'x-amz-copy-source' in self.headers:
+                start, _, end = self.headers['x-amz-copy-source-range'].split('=')[1].partition('-')
+                body = self.source()[int(start):int(end) + 1]
+            etag = '"%s"' % hashlib.md5(body).hexdigest()
+            server.uploads[query['uploadId']][int(query['partNumber'])] = body
+            if 'x-amz-copy-source' in self.headers:
+                return self.xml(200, 'CopyPartResult', '<ETag>%s</ETag>' % etag)
+            return self.reply(200, '', {'ETag': etag})
+        if 'x-amz-copy-source' in self.headers:
+            data = self.source()
+            if data is None:
+                return self.xml(404, 'Error', '<Code>NoSuchKey</Code>')
+            etag = self.stored(key, data)
+            return self.xml(200, 'CopyObjectResult', '<LastModified>2000-01-01T00:00:00.000Z'
+                            '</LastModified><ETag>%s</ETag>' % etag)
+        self.reply(200, '', {'ETag': self.stored(key, body)})
+
+    def do_POST(self):
+        key, query, body = self.parse()
+        server = self.server
+        if 'delete' in query:
+            names = [urllib.unquote(name) for name in
+                     [part.split('</Key>')[0] for part in body.split('<Key>')[1:]]]
+            with server.lock:
+                for name in names:
+                    server.objects.pop(name, None)
+            return self.xml(200, 'DeleteResult', '')
+        if 'uploads' in query:
+            upload_id = uuid.uuid4().hex
+            server.uploads[upload_id] = {}
+            return self.xml(200, 'InitiateMultipartUploadResult',
+                            '<Bucket>bench</Bucket><Key>%s</Key><UploadId>%s</UploadId>'
+                            % (escape(key), upload_id))
+        parts = server.uploads.pop(query['uploadId'], None)
+        if parts is None:
+            return self.xml(404, 'Error', '<Code>NoSuchUpload</Code>')
+        numbers = [int(part.split('</PartNumber>')[0]) for part in body.split('<PartNumber>')[1:]]
+        etag = self.stored(key, ''.join(parts[n] for n in numbers))
+        self.xml(200, 'CompleteMultipartUploadResult', '<Location>/bench/%s</Location>'
+                 '<Bucket>bench</Bucket><Key>%s</Key><ETag>%s</ETag>'
+                 % (escape(key), escape(key), etag))
+
+    def do_DELETE(self):
+        key, query, _ = self.parse()
+        with self.server.lock:
+            if 'uploadId' in query:
+                self.server.uploads.pop(query['uploadId'], None)
+            else:
+                self.server.objects.pop(key, None)
+        self.reply(204)
+
+class S3Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), S3Handler)
+        self.latency = latency
+        self.objects = {}
+        self.uploads = {}
+        self.lock = threading.Lock()
+
+S3 = None
+
+def start_s3(opts):
+    # Serves the bucket from a thread of the bench, forked runs reach it over TCP
+    server = S3Server(opts.s3_latency/1000.0)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+# Runs
+
+def write_config(path, workdir, cluster, options):
+    lines = ['[default]',
+             'os_username = bench', 'os_password = bench', 'os_auth_url = http://keystone/v3',
+             'os_project_name = admin', 'user_domain_name = Default', 'project_domain_name = Default',
+             'vms_pool = vms', 'volumes_pool = volumes',
+             'backups_top_dir = %s' % os.path.join(workdir, 'backups'),
+             'libvirt_uri = qemu+tcp://%s/system', 'ssh_user = root', 'ssh_key = /dev/null',
+             'log_file = %s' % os.path.join(workdir, 'ceph-backup.log'),
+             'backup_retention_weeks = 2',
+             # Daily runs never find a fresh inventory cache
+             'inventory_cache_ttl = 0',
+             'metrics_jsonl = %s' % os.path.join(workdir, 'metrics.jsonl')]
+    for option in options:
+        key, value = option.split('=', 1)
+        lines.append('%s = %s' % (key.strip(), value.strip()))
+    tenants = ','.join(project['name'] for project in cluster.projects)
+    lines += ['[targets]', 'instances =', 'tenants =', 'instances_with_root_disk =',
+              'tenants_with_root_disk = %s' % tenants, 'volumes =', 'tenants_volumes =',
+              '[schedule]', 'full = sun, 01:00', 'incremental = 01:00']
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+def resident_mb():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1])*resource.getpagesize()/float(MB)
+    except (IOError, OSError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0
+
+def simulated_localtime(localtime, clock, *secs):
+    return localtime(*secs) if secs else localtime(clock)
+
+def run_script(cluster, opts, workdir, args, clock):
+    """
+    Runs ceph-backup.py with given arguments in a forked process, as if
+    the time was `clock`. The cluster state changed by the run is loaded
+    back. Returns wall time, peak and initial memory in MB, the metrics
+    written by the run, the number of I/O errors injected and the error
+    that stopped it, if any.
+    """
+    state = os.path.join(workdir, 'state')
+    metrics_file = os.path.join(workdir, 'metrics.jsonl')
+    offset = os.path.getsize(metrics_file) if os.path.exists(metrics_file) else 0
+    injected = cluster.injected
+    time1 = time.time()
+    pid = os.fork()
+    if pid == 0:
+        code = 1
+        try:
+            rss = resident_mb()
+            output = os.open(os.path.join(workdir, 'output.log'),
+                             os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+            os.dup2(output, 1)
+            os.dup2(output, 2)
+            # A partial, unlike a function, doesn't become a method of logging.Formatter
+            time.localtime = functools.partial(simulated_localtime, time.localtime, clock)
+            random.seed(clock)
+            sys.argv = [opts.script, '-c', os.path.join(workdir, 'ceph-backup.conf')] + args
+            error = None
+            try:
+                runpy.run_path(opts.script, run_name='__main__')
+            except SystemExit as e:
+                if e.code not in (None, 0):
+                    error = 'exit status %s' % e.code
+            except Exception as e:
+                traceback.print_exc()
+                error = '%s: %s' % (e.__class__.__name__, e)
+            cluster.dump(state)
+            with open(state + '.run', 'w') as f:
+                json.dump({'rss': rss, 'error': error}, f)
+            code = 0
+        finally:
+            os._exit(code)
+    pid, status, usage = os.wait4(pid, 0)
+    seconds = time.time() - time1
+    if status != 0:
+        raise Exception("Run %s crashed, see %s" % (' '.join(args), os.path.join(workdir, 'output.log')))
+    cluster.load(state)
+    with open(state + '.run') as f:
+        run = json.load(f)
+    metrics = {}
+    if os.path.exists(metrics_file):
+        with open(metrics_file) as f:
+            f.seek(offset)
+            lines = f.read().splitlines()
+            if lines:
+                metrics = json.loads(lines[-1])
+    return {'seconds': seconds, 'peak_rss_mb': usage.ru_maxrss/1024.0,
+            'rss_mb': run['rss'], 'metrics': metrics, 'injected': cluster.injected - injected,
+            'error': run['error']}
+
+def summarize(fleet, name, runs):
+    # Combines runs of one step (restores of several instances) into one result
+    res = {'fleet': fleet, 'run': name, 'count': len(runs),
+           'seconds': sum(run['seconds'] for run in runs),
+           'peak_rss_mb': max(run['peak_rss_mb'] for run in runs),
+           'rss_growth_mb': max(run['peak_rss_mb'] - run['rss_mb'] for run in runs),
+           'errors': [run['error'] for run in runs if run['error']],
+           'injected': sum(run['injected'] for run in runs),
+           'phases': {}, 'counters': {}, 'ok': 0, 'failed': 0}
+    for run in runs:
+        metrics = run['metrics']
+        for phase, values in metrics.get('phases', {}).items():
+            res['phases'][phase] = res['phases'].get(phase, 0) + values['seconds']
+        for counter, value in metrics.get('counters', {}).items():
+            res['counters'][counter] = res['counters'].get(counter, 0) + value
+        for instance in metrics.get('instances', {}).values():
+            if instance.get('status') == 'ok':
+                res['ok'] += 1
+            elif instance.get('status') == 'failed':
+                res['failed'] += 1
+    nbytes = res['counters'].get('export_bytes', 0) + res['counters'].get('restore_bytes', 0)
+    res['mb'] = nbytes/float(MB)
+    res['throughput_mb_s'] = res['mb']/res['seconds'] if res['seconds'] else 0
+    return res
+
+ROW = "%7s %-8s %9s %9s %8s %9s %8s %9s  %s"
+
+def print_header():
+    print(ROW % ('fleet', 'run', 'wall s', 'MB', 'MB/s', 'peak MB', '+MB', 'ok/fail', 'top phases (s)'))
+
+def print_result(res, baseline=None):
+    phases = sorted(res['phases'].items(), key=lambda item: -item[1])[:4]
+    line = ROW % (res['fleet'], res['run'], '%.2f' % res['seconds'], '%.1f' % res['mb'],
+                  '%.1f' % res['throughput_mb_s'], '%.1f' % res['peak_rss_mb'],
+                  '%.1f' % res['rss_growth_mb'], '%d/%d' % (res['ok'], res['failed']),
+                  ' '.join('%s=%.2f' % phase for phase in phases))
+    print(line)
+    if baseline:
+        print(ROW % ('', '  vs base', change(res['seconds'], baseline['seconds']), '', '',
+                     change(res['peak_rss_mb'], baseline['peak_rss_mb']),
+                     change(res['rss_growth_mb'], baseline['rss_growth_mb']), '', ''))
+    for error in res['errors']:
+        print("        error: %s" % error)
+    for problem in res.get('problems', []):
+        print("        problem: %s" % problem)
+
+def change(value, base):
+    if not base:
+        return '-'
+    return '%+.1f%%' % (100.0*(value - base)/base)
+
+def setup_fleet(opts, fleet, workdir, options):
+    # Builds the fleet and config of ceph-backup.py in workdir, returns the cluster and
+    # random generator of its changes
+    global CLUSTER
+    rnd = random.Random('%s-%s' % (opts.seed, fleet))
+    CLUSTER = cluster = FakeCluster(opts)
+    build_fleet(cluster, fleet, rnd)
+    os.makedirs(os.path.join(workdir, 'backups'))
+    if S3:
+        # Backups of every workdir get their own prefix, zlib as S3 needs compression
+        options = ['s3_endpoint = 127.0.0.1:%s' % S3.server_address[1], 's3_bucket = bench',
+                   's3_access_key = bench', 's3_secret_key = bench',
+                   's3_prefix = %s' % os.path.basename(workdir), 'compression = zlib'] + options
+    write_config(os.path.join(workdir, 'ceph-backup.conf'), workdir, cluster, options)
+    print("# %d instances, %d images, %.1f MB allocated, backups in %s" \
+            % (fleet, len(cluster.images), allocated_bytes(cluster)/float(MB), workdir))
+    return cluster, rnd
+
+def allocated_bytes(cluster, keys=None):
+    return sum(len(cluster.images[key][1]) for key in keys or cluster.images)*cluster.extent
+
+def first_clock(days):
+    # Backups run at 01:00 of consecutive days, the last one yesterday
+    today = time.localtime()
+    return time.mktime((today.tm_year, today.tm_mon, today.tm_mday, 1, 0, 0, 0, 0, -1)) \
+           - (days + 1)*DAY
+
+def simulate(opts, fleet, workdir, baseline):
+    cluster, rnd = setup_fleet(opts, fleet, workdir, opts.options)
+    clock = first_clock(opts.days)
+    results = []
+    for day in range(opts.days + 1):
+        if day:
+            changed = change_images(cluster, rnd)
+            name, args = 'inc%d' % day, ['-b', opts.inc_type]
+        else:
+            changed = 0
+            name, args = 'full', ['-b', 'full']
+        res = summarize(fleet, name, [run_script(cluster, opts, workdir, args, clock + day*DAY)])
+        res['changed_mb'] = changed/float(MB)
+        if opts.verify:
+            res['problems'] = unexpected_failures(res, cluster.injected)
+        results.append(res)
+        print_result(res, baseline.get((fleet, name)))
+    if opts.restores:
+        date = time.strftime('%Y-%m-%d-%H-%M', time.localtime(clock + opts.days*DAY))
+        runs, differing = [], []
+        for info in rnd.sample(cluster.servers, min(opts.restores, fleet)):
+            expected = dict((key, image_digest(cluster, key, date))
+                            for key in instance_images(cluster, info)) if opts.verify else {}
+            runs.append(run_script(cluster, opts, workdir, ['-r', date, '-i', info['name']],
+                                   clock + (opts.days + 1)*DAY))
+            # Failed restores are left half done, they are checked by unexpected_failures()
+            if not runs[-1]['injected'] and not runs[-1]['error']:
+                differing += differing_images(cluster, expected)
+        res = summarize(fleet, 'restore', runs)
+        if opts.verify:
+            res['problems'] = unexpected_failures(res, cluster.injected) + \
+                ["restored image %s differs from its snapshot %s" % (name, date) for name in differing]
+        results.append(res)
+        print_result(res, baseline.get((fleet, 'restore')))
+    return results
+
+def instance_images(cluster, info):
+    keys = [('vms', info['id'] + '_disk')]
+    keys += [('volumes', 'volume-' + volume['id']) for volume in cluster.volumes
+             if any(attachment['server_id'] == info['id'] for attachment in volume['attachments'])]
+    return [key for key in keys if key in cluster.images]
+
+def unexpected_failures(res, injected):
+    # Failed instances and runs are expected only after I/O errors were injected, in this
+    # step or an earlier one which broke backup chains
+    if (res['failed'] or res['errors']) and not injected:
+        return ["%s of %d instances: %d instance(s) failed without injected errors %s"
+                % (res['run'], res['fleet'], res['failed'], res['errors'])]
+    return []
+
+def log_count(workdir, text):
+    with open(os.path.join(workdir, 'ceph-backup.log')) as f:
+        return f.read().count(text)
+
+def differing_images(cluster, expected):
+    # Names of images whose content doesn't have the expected digest
+    return sorted(key[1] for key, digest in expected.items() if image_digest(cluster, key) != digest)
+
+def check_resume(opts, fleet, workdir):
+    """
+    Fails a full backup and then a restore partway with I/O errors injected
+    after half of the bytes of every image and runs them again, which must
+    continue from their checkpoints. Restored images must be the same byte
+    for byte as their snapshots, as after a restore which wasn't interrupted.
+    Returns list of problems found.
+    """
+    # Checkpoints every few extents, so the failed runs leave some behind
+    options = opts.options + ['checkpoint_interval = %d' % (4*opts.extent_size*1024)]
+    cluster, rnd = setup_fleet(opts, fleet, workdir, options)
+    problems = []
+    clock = first_clock(1)
+    date = time.strftime('%Y-%m-%d-%H-%M', time.localtime(clock))
+    cluster.fail_after = min(allocated_bytes(cluster, [key]) for key in cluster.images)//2
+    res = summarize(fleet, 'full', [run_script(cluster, opts, workdir, ['-b', 'full'], clock)])
+    if not res['failed'] and not res['errors']:
+        problems.append("backup with I/O errors after %d bytes didn't fail" % cluster.fail_after)
+    cluster.fail_after = None
+    # Same minute, so the same snapshots
+    res = summarize(fleet, 'full', [run_script(cluster, opts, workdir, ['-b', 'full'], clock + 1)])
+    if res['failed'] or res['errors']:
+        problems.append("backup after the failed one failed: %s" % res['errors'])
+    resumed = log_count(workdir, 'Resuming export')
+    # Exports to S3 can't be continued, they start over
+    if not resumed and not S3:
+        problems.append("no export was resumed from its checkpoint")
+    info = cluster.servers[0]
+    keys = instance_images(cluster, info)
+    expected = dict((key, image_digest(cluster, key, date)) for key in keys)
+    restore = ['-r', date, '-i', info['name']]
+    # Bytes written to every image are counted to fail the next restore halfway, as raw
+    # backups are written in whole chunks, zeros included
+    cluster.fail_after, cluster.transferred = sys.maxint, {}
+    res = summarize(fleet, 'restore', [run_script(cluster, opts, workdir, restore, clock + DAY)])
+    if res['failed'] or res['errors'] or differing_images(cluster, expected):
+        problems.append("restore of %s failed or differs from its snapshots: %s %s"
+                        % (info['name'], res['errors'], differing_images(cluster, expected)))
+    cluster.fail_after = min(cluster.transferred.get(key, 0) for key in keys)//2
+    cluster.transferred = {}
+    res = summarize(fleet, 'restore', [run_script(cluster, opts, workdir, restore, clock + DAY)])
+    if not res['failed'] and not res['errors']:
+        problems.append("restore with I/O errors after %d bytes didn't fail" % cluster.fail_after)
+    if cluster.server(info['id'])['status'] != 'SHUTOFF':
+        problems.append("%s was started after its restore failed" % info['name'])
+    restores = log_count(workdir, 'Resuming restore')
+    fail_after, cluster.fail_after, cluster.transferred = cluster.fail_after, None, {}
+    res = summarize(fleet, 'restore', [run_script(cluster, opts, workdir, restore, clock + DAY)])
+    if log_count(workdir, 'Resuming restore') == restores:
+        problems.append("restore of %s wasn't resumed from its checkpoint" % info['name'])
+    if res['failed'] or res['errors'] or differing_images(cluster, expected):
+        problems.append("resumed restore of %s failed or differs from its snapshots and the "
+                        "uninterrupted restore: %s %s"
+                        % (info['name'], res['errors'], differing_images(cluster, expected)))
+    # Restore failed again and the image used before the rerun, as by a backup of the
+    # instance started anyway, must be restored from scratch
+    cluster.fail_after = fail_after
+    run_script(cluster, opts, workdir, restore, clock + DAY)
+    cluster.fail_after, cluster.transferred = None, {}
+    state = cluster.images[keys[0]]
+    state[2].append({'id': cluster.next_version(), 'name': 'used', 'size': state[0],
+                     'extents': dict(state[1])})
+    res = summarize(fleet, 'restore', [run_script(cluster, opts, workdir, restore, clock + DAY)])
+    if log_count(workdir, 'was used since its restore') != 1:
+        problems.append("restore of %s resumed on an image used since it failed" % info['name'])
+    if res['failed'] or res['errors'] or differing_images(cluster, expected):
+        problems.append("restore of %s over a used image failed or differs from its "
+                        "snapshots: %s %s"
+                        % (info['name'], res['errors'], differing_images(cluster, expected)))
+    print("# resume check of %d instances: %d exports resumed, %s" \
+            % (fleet, resumed, '; '.join(problems) or 'ok'))
+    return problems
+
+def fresh_workdir(top, name):
+    workdir = os.path.join(top, name)
+    if os.path.exists(workdir):
+        shutil.rmtree(workdir)
+    os.makedirs(workdir)
+    return workdir
+
+def main():
+    global S3
+    opts = parse_args()
+    for option in opts.options:
+        if '=' not in option:
+            sys.exit("Option %s is not in KEY=VALUE form" % option)
+    baseline = {}
+    if opts.baseline:
+        with open(opts.baseline) as f:
+            for res in json.load(f)['results']:
+                baseline[(res['fleet'], res['run'])] = res
+    install_fakes()
+    if opts.s3:
+        S3 = start_s3(opts)
+    top = opts.workdir or tempfile.mkdtemp(prefix='ceph-backup-bench.')
+    results = []
+    problems = []
+    print_header()
+    try:
+        for fleet in [int(count) for count in opts.fleet.split(',')]:
+            workdir = fresh_workdir(top, 'fleet-%d' % fleet)
+            try:
+                fleet_results = simulate(opts, fleet, workdir, baseline)
+                results.extend(fleet_results)
+                problems.extend(problem for res in fleet_results for problem in res.get('problems', []))
+            finally:
+                if not opts.keep:
+                    shutil.rmtree(workdir)
+            if opts.check_resume:
+                workdir = fresh_workdir(top, 'resume-%d' % fleet)
+                try:
+                    problems.extend(check_resume(opts, fleet, workdir))
+                finally:
+                    if not opts.keep:
+                        shutil.rmtree(workdir)
+    finally:
+        if not opts.keep and not opts.workdir:
+            shutil.rmtree(top)
+        if opts.json_file:
+            with open(opts.json_file, 'w') as f:
+                json.dump({'options': vars(opts), 'results': results}, f, indent=2, sort_keys=True)
+    if problems:
+        sys.exit("%d problem(s) found:\n%s" % (len(problems), '\n'.join(problems)))
+
+if __name__ == '__main__':
+    main()
@@ -2,29 +2,85 @@
 from __future__ import print_function
 import os
 import sys
-import libvirt
-import rados
-import rbd
 import shutil
 import subprocess
+import tempfile
 import argparse
 import re
 import ConfigParser
 import logging as LOG
 import signal
+import errno
+import struct
 import multiprocessing
+import threading
 import traceback
-from libvirt_qemu import qemuAgentCommand 
-from novaclient import client as novaclient
-from cinderclient.v2 import client as cinderclient
-from keystoneclient import session
-from keystoneclient.auth.identity import v3
-from keystoneclient.v3 import client as keystoneclient
+import Queue
+import zlib
+import bz2
+import hashlib
+import sqlite3
+import json
+import bisect
+import BaseHTTPServer
+import SocketServer
+import socket
+import mmap
+import random
+import importlib
 from pprint import pprint
-from time import localtime, strftime, strptime, sleep
+from cStringIO import StringIO
+from time import localtime, strftime, strptime, sleep, mktime
+import _strptime  # strptime() is not thread-safe until imported
 from glob import glob
-from fabric import api as fabric
 from datetime import datetime
+from multiprocessing.pool import ThreadPool
+from collections import deque
+from contextlib import contextmanager
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame as lz4frame
+except ImportError:
+    lz4frame = None
+
+class LazyModule(object):
+    """
+    Module imported on first use of its attributes. Ceph, libvirt and
+    OpenStack client libraries are slow to import and actions working
+    with local backups only don't need them.
+    """
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+libvirt = LazyModule('libvirt')
+libvirt_qemu = LazyModule('libvirt_qemu')
+rados = LazyModule('rados')
+rbd = LazyModule('rbd')
+paramiko = LazyModule('paramiko')
+novaclient = LazyModule('novaclient.client')
+cinderclient = LazyModule('cinderclient.v2.client')
+keystone_session = LazyModule('keystoneclient.session')
+keystone_identity = LazyModule('keystoneclient.auth.identity.v3')
+keystoneclient = LazyModule('keystoneclient.v3.client')
+boto = LazyModule('boto')
+boto_s3_connection = LazyModule('boto.s3.connection')
+boto_s3_multipart = LazyModule('boto.s3.multipart')
 
 # Time format used for naming backup and snapshot
 TIME_FORMAT = '%Y-%m-%d-%H-%M'
@@ -36,6 +92,7 @@ TENANT_LEN      = 40
 DATE_LEN        = 18
 TYPE_LEN        = 5
 SIZE_LEN        = 9
+USED_LEN        = 9
 STATUS_LEN      = 7
 d               = "| "
 header          = "+".join(("",
@@ -44,6 +101,7 @@ header          = "+".join(("",
                   "-"*(DATE_LEN+1),      \
                   "-"*(TYPE_LEN+1),      \
                   "-"*(SIZE_LEN+1),      \
+                  "-"*(USED_LEN+1),      \
                   "-"*(STATUS_LEN+1),    \
                   ""))
 
@@ -58,6 +116,49 @@ END     = '\033[0m'
 STATUS_OK = 'OK'
 STATUS_ERROR = 'ERROR'
 
+# Daemon mode: default priorities of queued jobs, lower runs first
+PRIORITY_RESTORE = 0
+PRIORITY_ADHOC = 10
+PRIORITY_SCHEDULED = 20
+
+# Native export engine: size of a single RBD read and number of chunks
+# which may be read ahead of the backup file writer
+EXPORT_CHUNK_SIZE = 4*1024**2
+EXPORT_PREFETCH = 8
+# Export checkpoints keep CRC32 of the last block of the partial backup file,
+# checked when the export is resumed
+CHECKPOINT_CRC_BLOCK = 4*1024**2
+
+# Native restore: number of writes to the target image in flight
+RESTORE_INFLIGHT = 16
+
+# Header of RBD export-diff stream (format v1, same as "rbd export-diff")
+RBD_DIFF_BANNER = 'rbd diff v1\n'
+
+# Compressed backup files: codec name is appended to the file name and the
+# content is a sequence of independently compressed frames of up to
+# COMPRESS_BLOCK_SIZE bytes, so compression can run in parallel and restore
+# can decompress while streaming
+COMPRESSED_MAGIC = 'CBKZ'
+COMPRESS_BLOCK_SIZE = 4*1024**2
+COMPRESSION_CODECS = { 'zlib': 6, 'bz2': 9, 'lzma': 6, 'zstd': 3, 'lz4': 0 }
+
+# Deduplicated backups: the backup file is replaced by a manifest listing
+# SHA-256 hashes of its blocks, the blocks are kept once in CHUNK_STORE_DIR
+MANIFEST_SUFFIX = 'manifest'
+MANIFEST_HEADER = '# ceph-backup manifest v1'
+# Backup files have CRC32 of every block of logical content in .<name>.sums
+SUMS_BLOCK_SIZE = 4*1024**2
+SUMS_HEADER = '# ceph-backup sums v1'
+ZERO_BLOCK = '\0'*SUMS_BLOCK_SIZE
+# lseek() whence to find data and holes in sparse files, not exported by Python 2 os
+SEEK_DATA = 3
+SEEK_HOLE = 4
+# Raw backup files are verified in ranges of that many blocks in parallel
+VERIFY_RANGE = 256
+BACKUP_FILE_RE = re.compile(r'^(full|inc)_(.+?)(?:\.(%s))?$' \
+                    % '|'.join(COMPRESSION_CODECS.keys() + [MANIFEST_SUFFIX]))
+
 def parse_args_and_config():
     config = ConfigParser.ConfigParser()
     conf_parser = argparse.ArgumentParser(add_help=False, 
@@ -72,9 +173,10 @@ def parse_args_and_config():
     parser = argparse.ArgumentParser(parents=[conf_parser])
     group = parser.add_mutually_exclusive_group()
     group.add_argument( "-b", 
-                        choices=['full', 'inc'],
+                        choices=['full', 'inc', 'auto'],
                         dest='backup_type',
-                        help="Backup type: full (full backup) or inc (incremental)")
+                        help="Backup type: full (full backup), inc (incremental) or auto "
+                             "(chosen per instance from measured change rates)")
     group.add_argument( "-l",
                         dest='list_backups',
                         action='store_true',
@@ -84,17 +186,69 @@ def parse_args_and_config():
                         dest='restore_date',
                         help="Restore list of instances inplace to given date (backup will"
                              " replace the existing instances)")
+    group.add_argument( "--synthesize-full",
+                        dest='synthesize_full',
+                        action='store_true',
+                        default=False,
+                        help="Build full backups of instances from their latest full and "
+                             "incremental backups, without reading from the cluster")
+    group.add_argument( "--reindex",
+                        dest='reindex',
+                        action='store_true',
+                        default=False,
+                        help="Rebuild the backup catalog from backup files on disk")
+    group.add_argument( "--verify",
+                        dest='verify',
+                        action='store_true',
+                        default=False,
+                        help="Check backup files of instances (all backups without -i) "
+                             "against their block checksums")
+    group.add_argument( "--daemon",
+                        dest='daemon',
+                        action='store_true',
+                        default=False,
+                        help="Run backups on the configured schedule and accept queued "
+                             "backups and restores on the control socket")
+    parser.add_argument("--queue",
+                        dest='queue',
+                        action='store_true',
+                        default=False,
+                        help="Queue backup (-b) or restore (-r) in the running daemon instead "
+                             "of running it here, without them show the queue of the daemon")
+    parser.add_argument("--priority",
+                        dest='priority',
+                        type=int,
+                        help="With --queue priority of the jobs, lower runs first (default: "
+                             "%s for restores, %s for backups)" % (PRIORITY_RESTORE, PRIORITY_ADHOC))
+    parser.add_argument("--verify-sample",
+                        dest='verify_sample',
+                        type=int,
+                        default=0,
+                        help="With --verify also compare that many randomly chosen chunks "
+                             "of every backup with its snapshot if it still exists")
     parser.add_argument("-i",
                         dest='instances',
                         nargs="+",
                         default='', 
                         help="Comma separated list of instances (IDs or names) to backup")
+    parser.add_argument("-v",
+                        dest='volumes',
+                        nargs="+",
+                        default='',
+                        help="Comma separated list of volumes (IDs or names) to backup on "
+                             "their own")
+    parser.add_argument("--dry-run",
+                        dest='dry_run',
+                        action='store_true',
+                        default=False,
+                        help="With -b auto only report backup types and data volume "
+                             "the policy would choose")
     parser.add_argument("--with-root-disks",
                         dest='backup_root_disks',
                         action='store_true',
                         default=False,
                         help="Backup root disks of instances also (default: False)")
-    args = parser.parse_args(remaining_argv)
+    args = parser.parse_args(remaining_argv, namespace=args)
     return args, config
 
 def check_directory_is_writeable(dir):
@@ -130,18 +284,18 @@ def looks_like_uuid(string):
     return True if like_uuid or like_id else False
 
 def get_keystone_session():
-    auth = v3.Password( auth_url=OS_AUTH_URL,
+    auth = keystone_identity.Password( auth_url=OS_AUTH_URL,
                         username=OS_USERNAME,
                         password=OS_PASSWORD,
                         project_name=OS_PROJECT_NAME,
                         user_domain_name=USER_DOMAIN_NAME,
                         project_domain_name=PROJECT_DOMAIN_NAME)
-    context = session.Session(auth=auth)
+    context = keystone_session.Session(auth=auth)
     client = keystoneclient.Client(session=context)
     return context, client
 
 def instance_is_running(instance):
-    instance = nova.servers.get(instance.id)
+    instance = CLOUD.nova.servers.get(instance.id)
     if getattr(instance, 'OS-EXT-STS:power_state') == 1 and \
         instance.status == 'ACTIVE':
         return True
@@ -159,13 +313,190 @@ def execute(cmd, host=None):
     return (out, rc)
 
 def execute_remote_cmd(cmd, host):
-    with fabric.settings(fabric.hide('warnings', 'running', 'stdout', 'stderr'),
-                            host_string=host,
-                            key_filename=SSH_KEY,
-                            user=SSH_USER,
-                            warn_only=True):
-        out = fabric.run(cmd)
-    return (out, out.return_code)
+    with SSH_CONNS.use(host) as client:
+        channel = client.get_transport().open_session()
+        try:
+            channel.set_combine_stderr(True)
+            channel.exec_command(cmd)
+            out = channel.makefile('rb').read().rstrip('\n')
+            return (out, channel.recv_exit_status())
+        finally:
+            channel.close()
+
+def ssh_connect(host):
+    client = paramiko.SSHClient()
+    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    client.connect(host, username=SSH_USER, key_filename=SSH_KEY)
+    return client
+
+def ssh_is_alive(client):
+    transport = client.get_transport()
+    return transport is not None and transport.is_active()
+
+class HostConnections(object):
+    """
+    One connection per hypervisor host shared by all jobs working on it.
+    Connections are health-checked before use and closed after being idle
+    for idle_timeout seconds. At most max_users jobs use the connection
+    of one host at the same time.
+    """
+    def __init__(self, kind, connect, is_alive, max_users, idle_timeout):
+        self.kind = kind
+        self.connect = connect
+        self.is_alive = is_alive
+        self.max_users = max_users
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.conns = {}     # host: [connection, users, last_used]
+        self.host_locks = {}
+        self.slots = {}
+        self.connects = self.reuses = self.broken = self.evicted = 0
+        self.connect_time = 0.0
+
+    def _host_lock(self, host):
+        with self.lock:
+            if host not in self.host_locks:
+                self.host_locks[host] = threading.Lock()
+                self.slots[host] = threading.BoundedSemaphore(self.max_users)
+            return self.host_locks[host]
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except Exception as msg:
+            LOG.warning("Error closing connection: %s" % msg)
+
+    def evict_idle(self):
+        now = datetime.now()
+        with self.lock:
+            idle = [host for host, (conn, users, last_used) in self.conns.items() \
+                    if not users and timedelta(now, last_used) > self.idle_timeout]
+            idle = [(host, self.conns.pop(host)[0]) for host in idle]
+            self.evicted += len(idle)
+        for host, conn in idle:
+            self._close(conn)
+
+    def _acquire(self, host):
+        self.evict_idle()
+        with self._host_lock(host):
+            # Referenced under the lock, so evict_idle() can't close it meanwhile
+            with self.lock:
+                entry = self.conns.get(host)
+                if entry:
+                    entry[1] += 1
+                    entry[2] = datetime.now()
+            if entry and not self.is_alive(entry[0]):
+                LOG.warning("%s connection to %s is broken, reconnecting" % (self.kind, host))
+                with self.lock:
+                    self.broken += 1
+                    entry[1] -= 1
+                    if self.conns.get(host) is entry:
+                        del self.conns[host]
+                    unused = not entry[1]
+                if unused:
+                    self._close(entry[0])
+                entry = None
+            if entry is None:
+                time1 = datetime.now()
+                entry = [self.connect(host), 1, time1]
+                elapsed = timedelta(datetime.now(), time1)
+                METRICS.observe('%s_connect' % self.kind.lower(), elapsed)
+                with self.lock:
+                    self.connects += 1
+                    self.connect_time += elapsed
+                    self.conns[host] = entry
+            else:
+                with self.lock:
+                    self.reuses += 1
+            return entry
+
+    @contextmanager
+    def use(self, host):
+        self._host_lock(host)
+        with self.slots[host]:
+            entry = self._acquire(host)
+            try:
+                yield entry[0]
+            finally:
+                with self.lock:
+                    entry[1] -= 1
+                    entry[2] = datetime.now()
+                    # Dropped as broken while in use, last user closes it
+                    dropped = self.conns.get(host) is not entry and not entry[1]
+                if dropped:
+                    self._close(entry[0])
+
+    def close_all(self):
+        with self.lock:
+            conns = [entry[0] for entry in self.conns.values()]
+            self.conns = {}
+        for conn in conns:
+            self._close(conn)
+
+    def summary(self):
+        return "%s connections: %s opened in %.2f sec, %s reused, %s broken, %s evicted idle" \
+                % (self.kind, self.connects, self.connect_time, self.reuses, self.broken, self.evicted)
+
+class CloudHandles(object):
+    """
+    Ceph cluster, pool and OpenStack API handles, created on first use.
+    Listing backups or working with backup files only never waits for
+    the cluster or Keystone.
+    """
+    def __init__(self, ceph_conf, openstack):
+        self.ceph_conf = ceph_conf
+        self.openstack = openstack
+        self.lock = threading.RLock()
+        self.cluster = None
+        self.ioctxs = {}
+        self.clients = None
+
+    def ceph(self):
+        with self.lock:
+            if self.cluster is None:
+                with METRICS.timer('ceph_connect'):
+                    cluster = rados.Rados(conffile=self.ceph_conf)
+                    cluster.connect()
+                self.cluster = cluster
+            return self.cluster
+
+    def ioctx(self, pool):
+        with self.lock:
+            if pool not in self.ioctxs:
+                self.ioctxs[pool] = self.ceph().open_ioctx(pool)
+            return self.ioctxs[pool]
+
+    def _clients(self):
+        with self.lock:
+            if self.clients is None:
+                with METRICS.timer('openstack_connect'):
+                    session, keystone = self.openstack()
+                    self.clients = { 'keystone': keystone,
+                                     'nova': novaclient.Client(2, session=session),
+                                     'cinder': cinderclient.Client(session=session) }
+            return self.clients
+
+    @property
+    def keystone(self):
+        return self._clients()['keystone']
+
+    @property
+    def nova(self):
+        return self._clients()['nova']
+
+    @property
+    def cinder(self):
+        return self._clients()['cinder']
+
+    def close(self):
+        with self.lock:
+            for ioctx in self.ioctxs.values():
+                ioctx.close()
+            self.ioctxs = {}
+            if self.cluster is not None:
+                self.cluster.shutdown()
+                self.cluster = None
 
 def detect_pool(rbd_name):
     if rbd_name.endswith('_disk') or rbd_name.endswith('_disk.bak'):
@@ -175,7 +506,7 @@ def detect_pool(rbd_name):
 
 def get_pool_ioctx(rbd_name):
     pool = detect_pool(rbd_name)
-    return VMS_POOL_IOCTX if pool==VMS_POOL else VOLUMES_POOL_IOCTX
+    return CLOUD.ioctx(VMS_POOL if pool==VMS_POOL else VOLUMES_POOL)
 
 def get_rbd_image_obj(rbd_name):
     ioctx = get_pool_ioctx(rbd_name)
@@ -187,11 +518,14 @@ def delete_rbd_by_name(rbd_name):
     with rbd.Image(ioctx, rbd_name) as rbd_img:
         remove_all_snapshots([rbd_img])
     rbd_inst.remove(ioctx, rbd_name)
+    SNAPSHOTS.forget(rbd_name)
 
 def rename_rbd(rbd_name, new_name):
     ioctx = get_pool_ioctx(rbd_name)
     rbd_inst = rbd.RBD()
     rbd_inst.rename(ioctx, rbd_name, new_name)
+    SNAPSHOTS.forget(rbd_name)
+    SNAPSHOTS.forget(new_name)
 
 def rbd_image_exists(rbd_name):
     ioctx = get_pool_ioctx(rbd_name)
@@ -208,7 +542,7 @@ def rbd_snap_create(rbd_name, snap_name):
     ioctx = get_pool_ioctx(rbd_name)
     with rbd.Image(ioctx, rbd_name) as rbd_img:
         rbd_img.flush()
-        rbd_img.create_snap(snap_name)
+        SNAPSHOTS.create(rbd_img, snap_name)
 
 def exec_with_timeout(func, args=(), timeout=60):
     p = multiprocessing.Process(target=func, args=args)
@@ -242,90 +576,220 @@ def take_simple_snapshots(rbd_list, instance_name):
         LOG.info("-- Snapshoting %s (+0.00 sec)" % rbd_name)
         rbd_image.flush()
         exec_with_timeout(rbd_image.create_snap, (curr_time,))
+        # Snapshot was taken by a child process, list it again next time
+        SNAPSHOTS.forget(rbd_image.name)
         time2 = datetime.now()
         LOG.info("-- Done snapshoting %s (+%s sec)" % \
                 (rbd_name, timedelta(time2, time1)))
 
-def take_rbd_snapshots(dom, rbd_list, instance_name):
-    curr_time = current_time()
-    if dom.isActive() and guest_agent_available(dom):
+def remove_snapshots(rbd_list, snap_name):
+    for rbd_image in rbd_list:
+        if snap_name in snapshots_list(rbd_image):
+            SNAPSHOTS.remove(rbd_image, snap_name)
+
+def create_snapshots(pool, rbd_list, snap_name):
+    """
+    Creates snapshot of all images at the same time, one thread per image.
+    If they don't complete in SNAPSHOT_TIMEOUT the ones created are removed,
+    as they aren't consistent with each other, and the ones still running
+    remove theirs when they complete.
+    """
+    time1 = datetime.now()
+    lock = threading.Lock()
+    timed_out = []
+    def create(rbd_image):
+        SNAPSHOTS.create(rbd_image, snap_name)
+        with lock:
+            if not timed_out:
+                return
         try:
-            time1 = datetime.now()
-            LOG.info("Freezing %s (+0.00000 sec)" % instance_name)
-            freeze_vm(dom)
-            sleep(2)
-            LOG.info("Taking RBD snapshots of %s (+%s sec)" \
-                    % (instance_name, timedelta(datetime.now(), time1)))
-            for rbd_image in rbd_list:
-                rbd_name = "%s/%s" % (detect_pool(rbd_image.name), rbd_image.name)
-                sleep(2)
-                LOG.info("-- Snapshoting %s" % rbd_name)
-                if curr_time not in snapshots_list(rbd_image):
-                    rbd_image.flush()
-                    cmd = 'rbd snap create %s --snap %s' % (rbd_name, curr_time)
-                    exec_with_timeout(execute, (cmd,))
-                    #exec_with_timeout(rbd_image.create_snap, (curr_time,))
-                else:
-                    continue
-            LOG.info("Thawing %s (+%s sec)" \
-                    % (instance_name, timedelta(datetime.now(), time1)))
-            thaw_vm(dom)
-            LOG.info("Snapshots finished (+%s sec)" \
-                    % timedelta(datetime.now(), time1))
-        except libvirt.libvirtError as msg:
-            LOG.warning("Error occured while freezing/thawing instance: %s" % msg)
-            LOG.warning("Falling back to non-quiesced snapshots!")
-            for rbd_image in rbd_list:
-                sleep(5)
-                rbd_name = "%s/%s" % (detect_pool(rbd_image.name), rbd_image.name)
-                if curr_time not in snapshots_list(rbd_image):
-                    rbd_image.flush()
-                    cmd = 'rbd snap create %s --snap %s' % (rbd_name, curr_time)
-                    exec_with_timeout(execute, (cmd,))
-                else:
-                    continue
+            remove_snapshots([rbd_image], snap_name)
         except Exception as msg:
-            LOG.exception(msg)
-    else:
-        if not dom.isActive():
-            LOG.info("Instance is powered off, quiescing not needed!")
-        elif not guest_agent_available(dom):
-            LOG.warning("QEMU guest agent not available, quiescing disabled!")
-        for rbd_image in rbd_list:
-            sleep(5)
-            rbd_name = "%s/%s" % (detect_pool(rbd_image.name), rbd_image.name)
-            if curr_time not in snapshots_list(rbd_image):
-                rbd_image.flush()
-                cmd = 'rbd snap create %s --snap %s' % (rbd_name, curr_time)
-                exec_with_timeout(execute, (cmd,))
-            else:
-                continue
+            LOG.error("Error removing snapshot %s of %s completed after the timeout: %s" \
+                    % (snap_name, rbd_image.name, msg))
+    result = pool.map_async(create, rbd_list)
+    try:
+        result.get(SNAPSHOT_TIMEOUT)
+    except multiprocessing.TimeoutError:
+        with lock:
+            timed_out.append(True)
+        remove_snapshots(rbd_list, snap_name)
+        METRICS.add('snapshot_timeouts')
+        raise Exception("Timed out waiting for snapshot completion, snapshots taken are removed!")
+    for rbd_image in rbd_list:
+        LOG.info("-- Snapshot %s/%s@%s created" % (detect_pool(rbd_image.name), rbd_image.name, snap_name))
+    elapsed = timedelta(datetime.now(), time1)
+    METRICS.observe('snapshot', elapsed)
+    METRICS.add('snapshots_created', len(rbd_list))
+    return elapsed
+
+def freeze_and_snapshot(dom, pool, rbd_list, snap_name, instance_name):
+    """
+    Freezes guest filesystems, snapshots all images concurrently and thaws
+    the guest right away. If snapshots take longer than MAX_FREEZE_SECONDS
+    the guest is thawed anyway and the backup is aborted: snapshots which
+    completed are removed as they are not quiesced. Returns time the guest
+    was frozen.
+    """
+    lock = threading.Lock()
+    thawed = []
+    def thaw(reason):
+        with lock:
+            if thawed:
+                return
+            thawed.extend([timedelta(datetime.now(), time1), reason])
+        try:
+            thaw_vm(dom)
+        finally:
+            LOG.info("Thawed %s after %.3f sec (%s)" % (instance_name, thawed[0], reason))
+    time1 = datetime.now()
+    freeze_vm(dom)
+    watchdog = threading.Timer(MAX_FREEZE_SECONDS, thaw, ("freeze limit exceeded",))
+    watchdog.start()
+    try:
+        create_snapshots(pool, rbd_list, snap_name)
+    finally:
+        watchdog.cancel()
+        thaw("snapshots done")
+    METRICS.observe('freeze', thawed[0])
+    if thawed[1] != "snapshots done":
+        remove_snapshots(rbd_list, snap_name)
+        METRICS.add('freeze_aborts')
+        raise Exception("%s was frozen longer than %s sec and thawed before all snapshots "
+                        "completed, snapshots are removed as they are not quiesced"
+                        % (instance_name, MAX_FREEZE_SECONDS))
+    return thawed[0]
+
+def take_rbd_snapshots(dom, rbd_list, instance_name):
+    curr_time = current_time()
+    # Everything except the snapshots themselves is done before freezing
+    rbd_list = [rbd_image for rbd_image in rbd_list if curr_time not in snapshots_list(rbd_image)]
+    for rbd_image in rbd_list:
+        rbd_image.flush()
+    # Detached volumes have no domain
+    active = dom is not None and dom.isActive()
+    quiesce = active and guest_agent_available(dom)
+    if dom is None:
+        LOG.info("Volumes are detached, quiescing not needed!")
+    elif not active:
+        LOG.info("Instance is powered off, quiescing not needed!")
+    elif not quiesce:
+        LOG.warning("QEMU guest agent not available, quiescing disabled!")
+    pool = ThreadPool(max(1, len(rbd_list)))
+    try:
+        if quiesce:
+            try:
+                LOG.info("Freezing %s and taking RBD snapshots" % instance_name)
+                freeze_and_snapshot(dom, pool, rbd_list, curr_time, instance_name)
+                rbd_list = []
+            except libvirt.libvirtError as msg:
+                LOG.warning("Error occured while freezing/thawing instance: %s" % msg)
+                LOG.warning("Falling back to non-quiesced snapshots!")
+                rbd_list = [rbd_image for rbd_image in rbd_list \
+                            if curr_time not in snapshots_list(rbd_image)]
+        if rbd_list:
+            LOG.info("Taking RBD snapshots of %s" % instance_name)
+            create_snapshots(pool, rbd_list, curr_time)
+    except Exception as msg:
+        LOG.exception(msg)
+        return False
+    finally:
+        pool.close()
     LOG.info("Snapshots finished for %s" % instance_name)
+    return True
 
 def guest_agent_available(dom):
     cmd = '{"execute":"guest-ping"}'
     try:
-        out = qemuAgentCommand(dom, cmd, 30, 0)
+        with METRICS.timer('guest_agent_ping'):
+            out = libvirt_qemu.qemuAgentCommand(dom, cmd, 30, 0)
     except libvirt.libvirtError:
         return False
     return True
 
+class SnapshotCache(object):
+    """
+    Dated snapshots of images for the duration of a run. Snapshots of an
+    image are listed from the cluster once, with names parsed once, and
+    kept up to date as long as snapshots are created and removed through
+    create() and remove(). Images renamed or removed must be forgotten.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.images = {}
+
+    @staticmethod
+    def key(rbd_name):
+        return detect_pool(rbd_name), rbd_name
+
+    @staticmethod
+    def parse(snaps):
+        # Returns list of (time, id, name) of dated snapshots sorted by time
+        parsed = []
+        for snap in snaps:
+            try:
+                parsed.append((strptime(snap['name'], TIME_FORMAT), int(snap['id']), snap['name']))
+            except ValueError:
+                pass
+        return sorted(parsed)
+
+    def _store(self, rbd_name, snaps):
+        snaps = self.parse(snaps)
+        if sorted(snaps, key=lambda snap: snap[1]) != snaps:
+            LOG.warning("Snapshots list of %s is not ordered correctly, please check!" % rbd_name)
+        with self.lock:
+            self.images[self.key(rbd_name)] = snaps
+
+    def load_pool(self, ioctx):
+        # Lists snapshots of all images of pool in one pass
+        for rbd_name in rbd.RBD().list(ioctx):
+            try:
+                with rbd.Image(ioctx, rbd_name, read_only=True) as rbd_image:
+                    self._store(rbd_name, rbd_image.list_snaps())
+            except rbd.ImageNotFound:
+                pass
+
+    def snapshots(self, rbd_image):
+        with self.lock:
+            snaps = self.images.get(self.key(rbd_image.name))
+        if snaps is None:
+            self._store(rbd_image.name, rbd_image.list_snaps())
+            with self.lock:
+                snaps = self.images[self.key(rbd_image.name)]
+        return [snap[2] for snap in snaps]
+
+    def create(self, rbd_image, snap_name):
+        rbd_image.create_snap(snap_name)
+        with self.lock:
+            snaps = self.images.get(self.key(rbd_image.name))
+            if snaps is not None:
+                next_id = max([snap[1] for snap in snaps] or [0]) + 1
+                snaps.extend(self.parse([{'name': snap_name, 'id': next_id}]))
+                snaps.sort()
+
+    def remove(self, rbd_image, snap_name):
+        rbd_image.remove_snap(snap_name)
+        with self.lock:
+            snaps = self.images.get(self.key(rbd_image.name))
+            if snaps is not None:
+                snaps[:] = [snap for snap in snaps if snap[2] != snap_name]
+
+    def forget(self, rbd_name):
+        with self.lock:
+            self.images.pop(self.key(rbd_name), None)
+
+    def clear(self):
+        with self.lock:
+            self.images = {}
+
 def snapshots_list(rbd_image):
-    snap_list = [snap for snap in list(rbd_image.list_snaps()) if looks_like_date(snap['name'])]
-    sorted_by_time = [ snap['name'] for snap in sorted(snap_list, \
-                        key=lambda f: strptime(f['name'], TIME_FORMAT)) ]
-    sorted_by_id   = [ snap['name'] for snap in sorted(snap_list, \
-                        key=lambda f: int(f['id']))]
-    if sorted_by_time != sorted_by_id:
-        LOG.warning("Snapshots list of %s is not ordered correctly, please check!" 
-                % rbd_image.name)
-    return sorted_by_time
+    return SNAPSHOTS.snapshots(rbd_image)
 
 def remove_all_snapshots(rbd_list):
     for rbd_image in rbd_list:
         LOG.info("Removing all snapshots from %s" % rbd_image.name)
         for snap in reversed(snapshots_list(rbd_image)):
-            rbd_image.remove_snap(snap)
+            SNAPSHOTS.remove(rbd_image, snap)
 
 def is_clone(rbd_image):
     try:    
@@ -358,308 +822,3265 @@ def remove_empty_subdirs(directory):
                 except:
                     pass
 
-def export_diff(instance, rbd_list, full_backup=False):
-    res = 0
-    dest_dir = None
-    curr_time = current_time()
-    for rbd_image in rbd_list:
-        snaps_list = snapshots_list(rbd_image)
-        if not snaps_list:
-            LOG.error("No proper snapshots found for image %s ! Backup is not possible!" % rbd_image.name)
-            dest_dir = "/".join((backup_folder(instance), curr_time))
-            ensure_dir(dest_dir)
-            res += 1
-            continue
-        snap = snaps_list[-1]
-        pool = detect_pool(rbd_image.name)
-        dest_dir = "/".join((backup_folder(instance), snap))
-        ensure_dir(dest_dir)
-        if full_backup:
-            LOG.info("Export RBD image %s" % rbd_image.name)
-            filename = "full_" + rbd_image.name
-            cmd = "rbd export --no-progress %s/%s --snap %s " \
-                    % (pool, rbd_image.name, snap)
-        else:
-            if len(snaps_list)==1:
-                LOG.error("Only one snapshot found for image %s ! Incremental backup is not possible!" % rbd_image.name)
-                dest_dir = "/".join((backup_folder(instance), curr_time))
-                ensure_dir(dest_dir)
-                res += 1
-                continue
-            LOG.info("Export-diff RBD image %s" % rbd_image.name)
-            filename = "inc_" + rbd_image.name
-            from_snap = None
-            # Find the latest snapshot for which backup of any type is available
-            # In normal conditions this snapshot must be the first one
-            # We must start from the second from the end (-2 index)
-            for n in range(2, len(snaps_list)+1):
-                if backup_is_available(instance, snaps_list[-n], rbd_image.name):
-                    from_snap = snaps_list[-n]
-                    break
-            if not from_snap:
-                LOG.error("DANGER! No previous backups found for current RBD snapshots! Backup chain is likely to be broken")
-                res+=1
-                continue
-            cmd = "rbd export-diff --no-progress %s/%s --snap %s --from-snap %s " \
-                    % (pool, rbd_image.name, snap, from_snap)
-        dest_file = os.path.join(dest_dir, filename)
-        cmd += dest_file
-        out, rc = execute(cmd)
-        if rc==0: 
-            if full_backup:
-                LOG.info("Full backup of %s successfully finished." % rbd_image.name)
-            else:
-                LOG.info("Incremental backup of %s successfully finished." % rbd_image.name)
-            map(rbd_image.remove_snap, snaps_list[:-1])
-            continue
+def rbd_extents(rbd_image, from_snap=None):
+    """
+    Returns list of (offset, length, exists) extents of image changed since
+    from_snap, or all allocated extents if from_snap is None. Adjacent
+    extents of the same kind are merged.
+    """
+    extents = []
+    def cb(offset, length, exists):
+        if extents and extents[-1][2] == exists and \
+                extents[-1][0] + extents[-1][1] == offset:
+            extents[-1] = (extents[-1][0], extents[-1][1] + length, exists)
         else:
-            res += 1
-            LOG.error("RBD export failed: %s" % out)
-    if dest_dir:
-        status_file = os.path.join(dest_dir, 'status')
-        with open(status_file, "w+") as f:
-            f.write(str(res) + '\n')
-    remove_empty_subdirs(backup_folder(instance))
-    if full_backup and res == 0:
-        backups = get_backups(instance)
-        full_backup_dates = [d for d in sorted(backups.keys()) if backups[d].get('type') == 'full']
-        if len(backups) > 7*(BACKUP_RETENTION_WEEKS+1) and len(full_backup_dates)>=2:
-            date1, date2 = full_backup_dates[0], full_backup_dates[1]
-            upper_dir = os.path.join(dest_dir, '..')
-            for root, dirs, files in os.walk(upper_dir):
-                for dir in dirs:
-                    if date1 <= dir < date2:
-                        shutil.rmtree(os.path.join(root, dir))
-    return res
-
-def rbd_import(rbd_image, filepath):
-    pool = detect_pool(rbd_image)
-    cmd = "rbd import  --no-progress %s %s/%s" % (filepath, pool, rbd_image)
-    out, rc = execute(cmd)
-    if rc!=0:
-        #TODO Correct error LOG
-        LOG.error(out)
+            extents.append((offset, length, exists))
+    rbd_image.diff_iterate(0, rbd_image.size(), from_snap, cb)
+    return extents
 
-def import_diff(rbd_image, filepath):
-    pool = detect_pool(rbd_image)
-    cmd = "rbd import-diff --no-progress %s %s/%s" % (filepath, pool, rbd_image)
-    out, rc = execute(cmd)
-    if rc!=0:
-        #TODO Correct error LOG
-        LOG.error(out)
+def read_extents(rbd_image, extents):
+    """
+    Generator yielding (offset, length, data) for given extents, data is None
+    for zeroed extents. Image is read in chunks of EXPORT_CHUNK_SIZE by a
+    separate thread which stays up to EXPORT_PREFETCH chunks ahead of the
+    consumer, so reads from the cluster overlap with writes of the backup.
+    """
+    queue = Queue.Queue(EXPORT_PREFETCH)
+    stop = threading.Event()
+    fadvise = getattr(rados, 'LIBRADOS_OP_FLAG_FADVISE_SEQUENTIAL', 0)
+    pool, host = detect_pool(rbd_image.name), getattr(JOB, 'host', None)
 
-def full_backup_available(instance):
-    backups = get_backups(instance).values()
-    if not backups or all([backup.get('type')!='full' for backup in backups]):
+    def put(item):
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=1)
+                return True
+            except Queue.Full:
+                pass
         return False
-    else:
-        return True
 
-def instance_backup(instance, dom, rbd_list, full_backup=False):
-    LOG.info("="*80)
-    if full_backup:
-        LOG.info("Taking full backup of instance %s" % instance.name)
-        remove_all_snapshots(rbd_list)
-    else:
-        # If no full backup found - take full backup instead of incremental
-        if not full_backup_available(instance):
-            full_backup = True
-            LOG.info("No previous full backup found of %s" % instance.name) 
-            LOG.info("Taking full backup of instance %s" % instance.name)
-        else:
-            LOG.info("Taking incremental backup of instance %s" % instance.name)
-    take_rbd_snapshots(dom, rbd_list, instance.name)
-    res = export_diff(instance, rbd_list, full_backup=full_backup)
-    if res == 0:
-        LOG.info("Done")
-    LOG.info("="*80)
+    def reader():
+        try:
+            for offset, length, exists in extents:
+                if not exists:
+                    if not put((offset, length, None)):
+                        return
+                    continue
+                end = offset + length
+                while offset < end:
+                    chunk = min(EXPORT_CHUNK_SIZE, end - offset)
+                    THROTTLE.consume(chunk, pool, host)
+                    data = rbd_image.read(offset, chunk, fadvise)
+                    if not put((offset, chunk, data)):
+                        return
+                    offset += chunk
+            put(None)
+        except Exception as e:
+            put(e)
 
-def restore_instance_inplace(instance, dest_date):
-    LOG.info("Performing inplace restore of instance %s to date %s" % (instance.name, dest_date))
-    if instance_is_running(instance):
-        LOG.info("Powering off instance.", end="")
-        instance.stop()
-        while instance_is_running(instance):
-            print('.', end='')
-            sleep(2)
-        print("\nDone")
-    else:
-        LOG.info("Instance is already powered off")
-    root_rbd_id = str(instance.id + "_disk")
-    volume_ids = [str('volume-' + vol.id) for vol in nova.volumes.get_server_volumes(instance.id)]
-    backups = get_backups(instance)
-    if dest_date not in backups.keys():
-        LOG.error("Invalid restore date was specified")
-        return
-    for date in backups.copy():
-        if date > dest_date:
-            backups.pop(date)
+    thread = threading.Thread(target=reader, name=threading.current_thread().name + '-reader')
+    thread.daemon = True
+    thread.start()
     try:
-        for date in sorted(backups.keys()):
-            if backups[date]['type']=='full':
-                for file in backups[date]['files']:
-                    if root_rbd_id in file:
-                        if rbd_image_exists(root_rbd_id + ".bak"):
-                            delete_rbd_by_name(root_rbd_id + ".bak")
-                        rename_rbd(root_rbd_id, root_rbd_id + ".bak")
-                        rbd_import(root_rbd_id, file)
-                        rbd_snap_create(root_rbd_id, str(date))
-                    else:
-                        for volume in volume_ids:
-                            if volume in file:
-                                if rbd_image_exists(volume + ".bak"):
-                                    delete_rbd_by_name(volume + ".bak")
-                                rename_rbd(volume, volume + ".bak")
-                                rbd_import(volume, file)
-                                rbd_snap_create(volume, str(date))
-            elif backups[date]['type']=='inc':
-                for file in backups[date]['files']:
-                    if root_rbd_id in file:
-                        import_diff(root_rbd_id, file)
-                    else:
-                        for volume in volume_ids:
-                            if volume in file:
-                                import_diff(volume, file)
-    except:
-        raise
+        while True:
+            item = queue.get()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
     finally:
-        LOG.info("Starting instance after the restore")
-        instance.start()
+        stop.set()
+        thread.join()
 
-def get_backups(instance):
-    backups = {}
-    backup_dir = backup_folder(instance)
-    if os.path.exists(backup_dir):
-        dates = [dir for dir in os.listdir(backup_dir) if os.path.isdir(os.path.join(backup_dir, dir))]
-        for date in dates:
-            status_file = os.path.join(backup_dir, date, 'status')
-            status = STATUS_ERROR
-            if os.path.exists(status_file):
-                with open(status_file) as f:
-                    status = f.read().strip()
-            if status == '0':
-                status = STATUS_OK
-            os.chdir(os.path.join(backup_dir, date))
-            backups[date] = {}
-            full_root_backups = map(os.path.realpath, glob('./full_*_disk'))
-            inc_root_backups  = map(os.path.realpath, glob('./inc_*_disk'))
-            full_vol_backups  = map(os.path.realpath, glob('./full_volume-*'))
-            inc_vol_backups   = map(os.path.realpath, glob('./inc_volume-*'))
-            if (full_root_backups or full_vol_backups) and not (inc_root_backups or inc_vol_backups):
-                backups[date] = { 'type': 'full', 
-                                  'files': full_root_backups + full_vol_backups,
-                                  'status': status }
-            if (inc_root_backups or inc_vol_backups) and not (full_root_backups or full_vol_backups):
-                backups[date] = { 'type': 'inc', 
-                                  'files': inc_root_backups + inc_vol_backups,
-                                  'status': status }
-    return backups
+def write_diff_record(f, tag, *values):
+    f.write(tag + struct.pack('<' + 'Q'*len(values), *values))
 
-def backup_is_available(instance, date, rbd_name):
-    backup_dir = "/".join((backup_folder(instance), date))
-    if not os.path.isdir(backup_dir) or not os.listdir(backup_dir):
-        return False
-    if any([rbd_name in file for file in os.listdir(backup_dir)]):
-        return True
-    else:
-        return False
+def is_zero(data):
+    return data.count('\0') == len(data)
 
-def p(width, date):
-    w = '{:%s}' % width
-    return w.format(date)
+def codec_available(codec):
+    return { 'zlib': zlib, 'bz2': bz2, 'lzma': lzma,
+             'zstd': zstandard, 'lz4': lz4frame }.get(codec) is not None
 
-def print_backup_list_header():
-    INSTANCE = p(INSTANCE_LEN, 'INSTANCE')
-    TENANT = p(TENANT_LEN, 'PROJECT')
-    DATE = p(DATE_LEN, 'DATE')
-    TYPE = p(TYPE_LEN, 'TYPE')
-    SIZE = p(SIZE_LEN, 'SIZE(GB)')
-    STATUS = p(STATUS_LEN, 'STATUS')
-    print(d.join(("", INSTANCE, TENANT, DATE, TYPE, SIZE, STATUS, "")))
+def compress_block(codec, level, data):
+    if level is None:
+        level = COMPRESSION_CODECS[codec]
+    if codec == 'zlib':
+        return zlib.compress(data, level)
+    elif codec == 'bz2':
+        return bz2.compress(data, level)
+    elif codec == 'lzma':
+        return lzma.compress(data, preset=level)
+    elif codec == 'zstd':
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    elif codec == 'lz4':
+        return lz4frame.compress(data, compression_level=level)
+    raise ValueError("Unknown compression codec %s" % codec)
 
-def display_date(date):
-    date = date.split('-')
-    time = ":".join((date[3], date[4]))
-    date = "-".join((date[2], date[1], date[0]))
-    return " ".join((date, time))
+def decompress_block(codec, data):
+    if codec == 'zlib':
+        return zlib.decompress(data)
+    elif codec == 'bz2':
+        return bz2.decompress(data)
+    elif codec == 'lzma':
+        return lzma.decompress(data)
+    elif codec == 'zstd':
+        return zstandard.ZstdDecompressor().decompress(data)
+    elif codec == 'lz4':
+        return lz4frame.decompress(data)
+    raise ValueError("Unknown compression codec %s" % codec)
 
-def format_user_date(date):
-    date = date.split(' ')
-    time = date[1].replace(':', '-')
-    date = '-'.join(date[0].split('-')[::-1])
-    return '-'.join((date, time))
+def backup_file_format(path):
+    # None for raw files, otherwise codec name or MANIFEST_SUFFIX
+    match = BACKUP_FILE_RE.match(os.path.basename(path))
+    return match.group(3) if match else None
 
-def display_backups(instance):
-    def print_line(instance, tenant, date, backup_type, size, status):
-        print(d.join(("", p(INSTANCE_LEN, instance), p(TENANT_LEN, tenant), p(DATE_LEN, date), \
-                p(TYPE_LEN, backup_type), p(SIZE_LEN, str(size)), p(STATUS_LEN+9, status), "")))
-    bs = get_backups(instance)
-    tenant = get_tenant_name_by_id(instance.tenant_id, instance.id)
-    if bs:
-        backup_dir = backup_folder(instance)
-        for i, b in enumerate(sorted(bs.keys())):
-            size = float(0)
-            files = bs[b].get('files')
-            if not files:
-                files = []
-            for file in files:
-                file_size, rc = execute("du -k %s | cut -f1" % file)
-                size += round(float(file_size)/1048576.0, 2)
-            status = bs[b].get('status')
-            status = GREEN + STATUS_OK + END if status == STATUS_OK \
-                    else RED + STATUS_ERROR + END
-            backup_type = bs[b].get('type')
-            if i == 0 and backup_type:
-                print_line(instance.name, tenant, display_date(b), backup_type, size, status)
-            elif i == 0 and not backup_type:
-                print_line(instance.name, tenant, display_date(b), '---', '---', status)
-            elif backup_type:
-                print_line("", "", display_date(b), backup_type, size, status)
-            elif len(bs)>1 and i!=0:
-                print_line("", "", display_date(b), '---', '---', status)
-            else:
-                print_line(instance.name, tenant, display_date(b), '---', '---', status)
-    else:
-        l = '{:^%s}' % (DATE_LEN + TYPE_LEN + SIZE_LEN + STATUS_LEN + len(YELLOW) + len(END) + 6)
-        if not instance_in_ceph(instance):
-            print(d.join(("", p(INSTANCE_LEN, instance.name), p(TENANT_LEN, tenant), \
-                    l.format(YELLOW + "-- Nothing to backup --" + END ), "")))
+def backup_file_codec(path):
+    fmt = backup_file_format(path)
+    return fmt if fmt in COMPRESSION_CODECS else None
+
+def compress_pool():
+    global COMPRESS_POOL
+    with COMPRESS_POOL_LOCK:
+        if COMPRESS_POOL is None:
+            COMPRESS_POOL = multiprocessing.Pool(COMPRESSION_WORKERS)
+        return COMPRESS_POOL
+
+class RawBackupWriter(object):
+    """
+    Writes logical content of a backup to a plain file. Skipped ranges
+    are left as holes, so full image backups are sparse.
+    """
+    def __init__(self, path, resume=None):
+        if resume:
+            self.f = open(path, 'r+b')
+            self.f.truncate(resume['length'])
+            self.pos = resume['pos']
+            self.f.seek(self.pos)
         else:
-            print(d.join(("", p(INSTANCE_LEN, instance.name), p(TENANT_LEN, tenant), \
-                    l.format(RED + "-- No backups found --" + END ), "")))
+            self.f = open(path, 'wb')
+            self.pos = 0
 
-def instance_in_ceph(instance):
-    if instance.metadata.get('storage')=='rbd:ceph/vms':
-        return True
-    elif not LIST_BACKUPS:
-        LOG.warning("Instance %s is not stored in Ceph, its root disk will not be backed up (volumes will be)!" \
-                % instance.name)
-        return False
+    def write(self, data):
+        self.f.write(data)
+        self.pos += len(data)
 
-def get_instance_list(instance_list=None, tenant_list=None):
-    res = []
-    if instance_list:
-        for instance_name in instance_list.split(','):
-            instance_name = instance_name.strip()
-            instance = instances = None
-            if looks_like_uuid(instance_name):
-                instance = nova.servers.get(instance_name)
-                if not instance:
-                    LOG.warning("Cannot find instance with ID %s" % instance_name)
-                elif instance_name in (instance.name, instance.id):
-                    res.append(instance)
-            else:
-                instances = nova.servers.list(search_opts={ 'name': instance_name, 'all_tenants': True })
-                instances = [inst for inst in instances if inst.name == instance_name]
-                if not instances:
-                    LOG.warning("Cannot find instance with name %s" % instance_name)
-                else:
-                    res.extend(instances)
-    if tenant_list:
-        for tenant_id in get_tenant_id_list(tenant_list):
-            instances = nova.servers.list(search_opts={ 'tenant_id': tenant_id , 'all_tenants': True })
-            if not instances:
-                LOG.warning("No instances found in tenant %s" % tenant_id)
+    def skip(self, length):
+        self.pos += length
+        self.f.seek(self.pos)
+
+    def checkpoint(self):
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        return {'pos': self.pos, 'length': os.fstat(self.f.fileno()).st_size}
+
+    def abort(self):
+        self.f.close()
+
+    def close(self):
+        self.f.truncate(self.pos)
+        self.f.close()
+
+class CompressedBackupWriter(object):
+    """
+    Writes logical content of a backup compressed with given codec. Blocks
+    are compressed on the shared process pool, up to COMPRESSION_WORKERS*2
+    blocks of one writer may be in flight at the same time. Frames are
+    written in order: 'D' <le32 raw length> <le32 length> <data> for data
+    and 'H' <le64 length> for skipped ranges which are zeros.
+    """
+    def __init__(self, path, codec, level=None, resume=None):
+        self.codec = codec
+        self.level = level
+        self.buf = []
+        self.buf_len = 0
+        self.pending = deque()
+        if resume:
+            self.f = open(path, 'r+b')
+            self.f.truncate(resume['length'])
+            self.f.seek(resume['length'])
+            self.pos = resume['pos']
+        else:
+            self.f = open_backup_output(path)
+            self.pos = 0
+            self.f.write(COMPRESSED_MAGIC + struct.pack('<B', len(codec)) + codec)
+
+    def _drain(self, limit):
+        while len(self.pending) > limit:
+            item = self.pending.popleft()
+            if isinstance(item, tuple):
+                self.f.write('H' + struct.pack('<Q', item[1]))
+                continue
+            raw_len, data = item.get()
+            self.f.write('D' + struct.pack('<II', raw_len, len(data)))
+            self.f.write(data)
+
+    def _flush(self):
+        if not self.buf_len:
+            return
+        data = ''.join(self.buf)
+        self.buf = []
+        self.buf_len = 0
+        self.pending.append(compress_pool().apply_async(
+                                compress_frame, (self.codec, self.level, data)))
+        self._drain(COMPRESSION_WORKERS*2)
+
+    def write(self, data):
+        self.pos += len(data)
+        while data:
+            chunk = data[:COMPRESS_BLOCK_SIZE - self.buf_len]
+            data = data[len(chunk):]
+            self.buf.append(chunk)
+            self.buf_len += len(chunk)
+            if self.buf_len == COMPRESS_BLOCK_SIZE:
+                self._flush()
+
+    def skip(self, length):
+        if not length:
+            return
+        self._flush()
+        self.pos += length
+        self.pending.append(('H', length))
+
+    def checkpoint(self):
+        self._flush()
+        self._drain(0)
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        return {'pos': self.pos, 'length': self.f.tell()}
+
+    def abort(self):
+        self.pending.clear()
+        if isinstance(self.f, S3Upload):
+            self.f.abort()
+        else:
+            self.f.close()
+
+    def close(self):
+        self._flush()
+        self._drain(0)
+        self.f.write('E')
+        self.f.close()
+
+def compress_frame(codec, level, data):
+    return len(data), compress_block(codec, level, data)
+
+class ChunkStore(object):
+    """
+    Content-addressed store of backup blocks. Every block is kept once under
+    <path>/<first 2 hex digits>/<sha256>[.<codec>] and has a reference counter
+    in <path>/refs.db. A block is removed when its last manifest is released.
+    """
+    def __init__(self, path):
+        self.path = path
+        ensure_dir(path)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(os.path.join(path, 'refs.db'), check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS refs "
+                        "(chunk TEXT PRIMARY KEY, count INTEGER NOT NULL)")
+        self.db.commit()
+
+    def chunk_path(self, chunk):
+        return os.path.join(self.path, chunk[:2], chunk)
+
+    def _incref(self, chunk):
+        cur = self.db.execute("UPDATE refs SET count = count + 1 WHERE chunk = ?", (chunk,))
+        return cur.rowcount > 0
+
+    def put(self, digest, data, codec=None):
+        """
+        Stores block (if not stored yet) and takes a reference to it.
+        Returns name of the chunk and number of bytes newly stored.
+        """
+        chunk = digest + ('.' + codec if codec else '')
+        with self.lock:
+            if self._incref(chunk):
+                return chunk, 0
+        path = self.chunk_path(chunk)
+        ensure_dir(os.path.dirname(path))
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as f:
+            data = compress_block(codec, COMPRESSION_LEVEL, data) if codec else data
+            f.write(data)
+        with self.lock:
+            if self._incref(chunk):
+                os.remove(tmp)
+                return chunk, 0
+            os.rename(tmp, path)
+            self.db.execute("INSERT INTO refs VALUES (?, 1)", (chunk,))
+        return chunk, len(data)
+
+    def get(self, chunk):
+        with open(self.chunk_path(chunk), 'rb') as f:
+            data = f.read()
+        codec = chunk.partition('.')[2]
+        return decompress_block(codec, data) if codec else data
+
+    def commit(self):
+        with self.lock:
+            self.db.commit()
+
+    def release(self, manifest):
+        """
+        Drops references of all blocks listed in manifest, removing blocks
+        which are not referenced anymore.
+        """
+        return self.release_chunks([chunk for length, chunk in read_manifest(manifest) if chunk])
+
+    def release_chunks(self, chunks):
+        with self.lock:
+            self.db.executemany("UPDATE refs SET count = count - 1 WHERE chunk = ?",
+                                [(chunk,) for chunk in chunks])
+            unused = [row[0] for row in self.db.execute(
+                            "SELECT chunk FROM refs WHERE count <= 0")]
+            for chunk in unused:
+                try:
+                    os.remove(self.chunk_path(chunk))
+                except OSError:
+                    pass
+            self.db.execute("DELETE FROM refs WHERE count <= 0")
+            self.db.commit()
+        return len(unused)
+
+def read_manifest(path):
+    """
+    Generator yielding (length, chunk) entries of manifest, chunk is None for
+    holes.
+    """
+    with open(path) as f:
+        if not f.readline().startswith(MANIFEST_HEADER):
+            raise IOError("%s is not a backup manifest" % path)
+        for line in f:
+            if line.startswith('#'):
+                continue
+            chunk, length = line.split()
+            yield int(length), None if chunk == '-' else chunk
+
+def manifest_sizes(path):
+    """
+    Returns logical size of deduplicated backup and size of the blocks it
+    added to the chunk store, both recorded in the last line of manifest.
+    """
+    with open(path) as f:
+        f.seek(max(0, os.path.getsize(path) - 128))
+        last = f.read().splitlines()[-1].split()
+    if last[:2] != ['#', 'size']:
+        return sum([length for length, chunk in read_manifest(path)]), 0
+    return int(last[2]), int(last[4])
+
+class DedupBackupWriter(object):
+    """
+    Writes logical content of a backup into the chunk store and its list of
+    blocks into the manifest at path. Blocks are aligned to multiples of
+    DEDUP_BLOCK_SIZE of the logical offset, so unchanged regions of an image
+    produce the same blocks in every full backup.
+    """
+    def __init__(self, path, store, codec=None, resume=None):
+        self.path = path
+        self.store = store
+        self.codec = codec
+        self.tmp = partial_backup_path(path)
+        self.buf = []
+        self.buf_len = 0
+        self.hole = 0
+        # Chunks referenced since the last checkpoint, released on abort
+        self.taken = []
+        if resume:
+            self.f = open(self.tmp, 'r+')
+            self.f.truncate(resume['length'])
+            self.f.seek(resume['length'])
+            self.pos = resume['pos']
+            self.stored = resume['stored']
+            self.ckpt_length = resume['length']
+        else:
+            self.f = open(self.tmp, 'w')
+            self.f.write("%s codec=%s block_size=%s\n" % (MANIFEST_HEADER, codec, DEDUP_BLOCK_SIZE))
+            self.pos = 0
+            self.stored = 0
+            self.ckpt_length = 0
+
+    def _flush(self):
+        if not self.buf_len:
+            return
+        data = ''.join(self.buf)
+        self.buf = []
+        self.buf_len = 0
+        if is_zero(data):
+            self.hole += len(data)
+            return
+        self._flush_hole()
+        chunk, stored = self.store.put(hashlib.sha256(data).hexdigest(), data, self.codec)
+        self.stored += stored
+        self.taken.append(chunk)
+        self.f.write("%s %s\n" % (chunk, len(data)))
+
+    def _flush_hole(self):
+        if self.hole:
+            self.f.write("- %s\n" % self.hole)
+            self.hole = 0
+
+    def write(self, data):
+        while data:
+            chunk = data[:DEDUP_BLOCK_SIZE - self.pos % DEDUP_BLOCK_SIZE]
+            data = data[len(chunk):]
+            self.buf.append(chunk)
+            self.buf_len += len(chunk)
+            self.pos += len(chunk)
+            if self.pos % DEDUP_BLOCK_SIZE == 0:
+                self._flush()
+
+    def skip(self, length):
+        self._flush()
+        self.hole += length
+        self.pos += length
+
+    def checkpoint(self):
+        self._flush()
+        self._flush_hole()
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.store.commit()
+        self.taken = []
+        self.ckpt_length = self.f.tell()
+        return {'pos': self.pos, 'length': self.ckpt_length, 'stored': self.stored}
+
+    def abort(self):
+        # Cuts the manifest back to the last checkpoint, or drops it without one
+        self.store.release_chunks(self.taken)
+        self.taken = []
+        self.f.truncate(self.ckpt_length)
+        self.f.close()
+        if not self.ckpt_length:
+            os.remove(self.tmp)
+
+    def close(self):
+        self._flush()
+        self._flush_hole()
+        self.f.write("# size %s stored %s\n" % (self.pos, self.stored))
+        self.f.close()
+        # References must be durable before the manifest appears
+        self.store.commit()
+        os.rename(self.tmp, self.path)
+
+class S3Store(object):
+    """
+    Backup files kept in a bucket of RGW or another S3 service instead of
+    BACKUPS_TOP_DIR, under the same paths relative to it. Status files,
+    checksums and the catalog stay in BACKUPS_TOP_DIR too. Every thread
+    (and process of the verify pool) uses its own connection, kept open
+    between requests. Part uploads and read-ahead of all files share one
+    pool of workers.
+    """
+    def __init__(self, endpoint, bucket, access_key, secret_key, prefix='', secure=False,
+                 workers=16):
+        host, _, port = endpoint.partition(':')
+        self.host = host
+        self.port = int(port) if port else None
+        self.bucket_name = bucket
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.prefix = prefix.strip('/') + '/' if prefix.strip('/') else ''
+        self.secure = secure
+        self.workers = workers
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.pool = None
+        self.pool_pid = None
+
+    def bucket(self):
+        local = self.local
+        if getattr(local, 'pid', None) != os.getpid():
+            conn = boto.connect_s3(aws_access_key_id=self.access_key,
+                                   aws_secret_access_key=self.secret_key,
+                                   host=self.host, port=self.port, is_secure=self.secure,
+                                   calling_format=boto_s3_connection.OrdinaryCallingFormat())
+            local.bucket = conn.get_bucket(self.bucket_name, validate=False)
+            local.pid = os.getpid()
+        return local.bucket
+
+    def run(self, func, args):
+        # Runs func on the worker pool, returns its AsyncResult
+        with self.lock:
+            if self.pool is None or self.pool_pid != os.getpid():
+                self.pool = ThreadPool(self.workers)
+                self.pool_pid = os.getpid()
+            return self.pool.apply_async(func, args)
+
+    def key(self, path):
+        return self.prefix + os.path.relpath(path, BACKUPS_TOP_DIR)
+
+    def size(self, path):
+        key = self.bucket().get_key(self.key(path))
+        if key is None:
+            raise IOError(errno.ENOENT, "No such object", self.key(path))
+        return key.size
+
+    def get(self, key, start=None, end=None):
+        # Returns object or its bytes start..end-1 with a ranged GET
+        headers = {'Range': 'bytes=%s-%s' % (start, end - 1)} if start is not None else None
+        with METRICS.timer('s3_get'):
+            return self.bucket().new_key(key).get_contents_as_string(headers=headers)
+
+    def put(self, key, data):
+        with METRICS.timer('s3_put'):
+            self.bucket().new_key(key).set_contents_from_string(data)
+
+    def upload_part(self, key, upload_id, part_num, data):
+        upload = boto_s3_multipart.MultiPartUpload(self.bucket())
+        upload.key_name = key
+        upload.id = upload_id
+        for attempt in range(3):
+            try:
+                with METRICS.timer('s3_upload_part'):
+                    part = upload.upload_part_from_file(StringIO(data), part_num, size=len(data))
+                return part_num, part.etag
+            except Exception as msg:
+                if attempt == 2:
+                    raise
+                LOG.warning("Upload of part %s of %s failed, retrying: %s" % (part_num, key, msg))
+                sleep(1 + attempt)
+
+    def complete(self, key, upload_id, parts):
+        xml = '<CompleteMultipartUpload>%s</CompleteMultipartUpload>' \
+              % ''.join(['<Part><PartNumber>%s</PartNumber><ETag>%s</ETag></Part>' % part
+                         for part in sorted(parts)])
+        self.bucket().complete_multipart_upload(key, upload_id, xml)
+
+    def cancel(self, key, upload_id):
+        self.bucket().cancel_multipart_upload(key, upload_id)
+
+    def move(self, src, dst):
+        # Server side copy, in ranges of 1 GB for objects over the 5 GB limit of a copy
+        src_key, dst_key = self.key(src), self.key(dst)
+        bucket = self.bucket()
+        size = self.size(src)
+        if size <= 5*1024**3:
+            bucket.copy_key(dst_key, self.bucket_name, src_key)
+        else:
+            upload = bucket.initiate_multipart_upload(dst_key)
+            try:
+                for n, start in enumerate(range(0, size, 1024**3), 1):
+                    upload.copy_part_from_key(self.bucket_name, src_key, n, start,
+                                              min(start + 1024**3, size) - 1)
+                upload.complete_upload()
+            except:
+                upload.cancel_upload()
+                raise
+        bucket.delete_key(src_key)
+
+    def remove(self, path):
+        self.bucket().delete_key(self.key(path))
+
+    def remove_prefix(self, path):
+        # Removes all objects under directory path
+        bucket = self.bucket()
+        keys = [key.name for key in bucket.list(prefix=self.key(path) + '/')]
+        for i in range(0, len(keys), 1000):
+            bucket.delete_keys(keys[i:i+1000], quiet=True)
+
+    def walk(self):
+        # Returns {folder: {date: [names]}} of objects of backups in the bucket
+        res = {}
+        for key in self.bucket().list(prefix=self.prefix):
+            parts = key.name[len(self.prefix):].split('/')
+            if len(parts) != 3 or any([part.startswith('.') for part in parts]):
+                continue
+            folder, date, name = parts
+            res.setdefault(folder, {}).setdefault(date, []).append(name)
+        return res
+
+class S3Upload(object):
+    """
+    Write-only file streaming to an object with a multipart upload. Data is
+    cut into parts uploaded in parallel by workers of the store, at most
+    S3_UPLOAD_INFLIGHT parts of one upload are buffered in memory. Parts
+    are S3_PART_SIZE, doubled every 1000 parts to stay within the limit of
+    10000 parts. Objects smaller than a part are stored with a single PUT.
+    The object appears only when the upload is closed.
+    """
+    def __init__(self, store, path):
+        self.store = store
+        self.key = store.key(path)
+        self.buf = []
+        self.buf_len = 0
+        self.length = 0
+        self.upload_id = None
+        self.part_num = 0
+        self.pending = deque()
+        self.parts = []
+
+    def part_size(self):
+        return S3_PART_SIZE << (self.part_num // 1000)
+
+    def _upload_part(self, data):
+        if self.upload_id is None:
+            self.upload_id = self.store.bucket().initiate_multipart_upload(self.key).id
+        self.part_num += 1
+        while len(self.pending) >= S3_UPLOAD_INFLIGHT:
+            self.parts.append(self.pending.popleft().get())
+        self.pending.append(self.store.run(self.store.upload_part,
+                                           (self.key, self.upload_id, self.part_num, data)))
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            # Names from JSON are unicode, a file would encode them too
+            data = data.encode('ascii')
+        self.length += len(data)
+        self.buf.append(data)
+        self.buf_len += len(data)
+        if self.buf_len >= self.part_size():
+            data = ''.join(self.buf)
+            while len(data) >= self.part_size():
+                part_size = self.part_size()
+                self._upload_part(data[:part_size])
+                data = data[part_size:]
+            self.buf = [data]
+            self.buf_len = len(data)
+
+    def tell(self):
+        return self.length
+
+    def close(self):
+        data = ''.join(self.buf)
+        self.buf = []
+        try:
+            if self.upload_id is None:
+                self.store.put(self.key, data)
+            else:
+                if data:
+                    self._upload_part(data)
+                while self.pending:
+                    self.parts.append(self.pending.popleft().get())
+                self.store.complete(self.key, self.upload_id, self.parts)
+        except:
+            self.abort()
+            raise
+        METRICS.add('s3_upload_bytes', self.length)
+
+    def abort(self):
+        while self.pending:
+            self.pending.popleft().wait()
+        if self.upload_id is not None:
+            self.store.cancel(self.key, self.upload_id)
+            self.upload_id = None
+
+class S3Reader(object):
+    """
+    Read-only file over an object. Sequential reads, also ones skipping less
+    than a range, are served from ranges of S3_READ_SIZE, the next
+    S3_READ_AHEAD ranges are fetched in parallel meanwhile. Other reads
+    fetch just what is asked for.
+    """
+    def __init__(self, store, path):
+        self.store = store
+        self.key = store.key(path)
+        self.size = store.size(path)
+        self.pos = 0
+        self.buf_start = 0
+        self.buf = ''
+        self.ahead = {}
+        self.downloaded = 0
+
+    def _fetch(self, start, end):
+        return self.store.get(self.key, start, end)
+
+    def _window(self, pos):
+        # Makes the range holding pos the buffer, taken from read-ahead if it
+        # was fetched already, and schedules the following ranges
+        starts = [start for start in self.ahead if start <= pos < start + S3_READ_SIZE]
+        if starts:
+            start = starts[0]
+            data = self.ahead.pop(start).get()
+        else:
+            start = pos
+            data = self._fetch(start, min(start + S3_READ_SIZE, self.size))
+        for passed in [passed for passed in self.ahead if passed < start]:
+            del self.ahead[passed]
+        for n in range(1, S3_READ_AHEAD + 1):
+            ahead = start + n*S3_READ_SIZE
+            if ahead < self.size and ahead not in self.ahead:
+                self.ahead[ahead] = self.store.run(self._fetch, (ahead, min(ahead + S3_READ_SIZE,
+                                                                             self.size)))
+        self.buf_start, self.buf = start, data
+        self.downloaded += len(data)
+
+    def read(self, n=-1):
+        end = self.size if n < 0 else min(self.pos + n, self.size)
+        res = []
+        while self.pos < end:
+            buf_end = self.buf_start + len(self.buf)
+            if self.buf_start <= self.pos < buf_end:
+                data = self.buf[self.pos - self.buf_start:end - self.buf_start]
+            elif self.buf and buf_end <= self.pos < buf_end + S3_READ_SIZE:
+                # Sequential, possibly skipping a few headers
+                self._window(self.pos)
+                continue
+            else:
+                data = self._fetch(self.pos, end)
+                self.downloaded += len(data)
+                self.buf_start, self.buf = self.pos, data
+                self.ahead.clear()
+            res.append(data)
+            self.pos += len(data)
+        return ''.join(res)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.pos
+        elif whence == os.SEEK_END:
+            offset += self.size
+        self.pos = offset
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        for result in self.ahead.values():
+            result.wait()
+        self.ahead = {}
+        METRICS.add('s3_download_bytes', self.downloaded)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def in_object_store(path):
+    # Backup files go to S3 if it's configured, everything else stays local
+    return S3_STORE is not None and BACKUP_FILE_RE.match(os.path.basename(path)) is not None
+
+def open_backup_output(path):
+    return S3Upload(S3_STORE, path) if in_object_store(path) else open(path, 'wb')
+
+def open_backup_input(path):
+    return S3Reader(S3_STORE, path) if in_object_store(path) else open(path, 'rb')
+
+def backup_file_length(path):
+    return S3_STORE.size(path) if in_object_store(path) else os.path.getsize(path)
+
+def move_backup_file(src, dst):
+    if in_object_store(src):
+        S3_STORE.move(src, dst)
+    else:
+        os.rename(src, dst)
+
+def remove_backup_file(path):
+    if in_object_store(path):
+        S3_STORE.remove(path)
+    else:
+        os.remove(path)
+
+def remove_backup_dir(path):
+    # Releases blocks of deduplicated backups before removing the directory
+    for file in glob(os.path.join(path, '.*.ckpt')):
+        discard_checkpoint(file)
+    for file in os.listdir(path):
+        if backup_file_format(file) == MANIFEST_SUFFIX:
+            CHUNK_STORE.release(os.path.join(path, file))
+    if S3_STORE:
+        S3_STORE.remove_prefix(path)
+    shutil.rmtree(path)
+    path = os.path.normpath(path)
+    CATALOG.remove(os.path.basename(os.path.dirname(path)), os.path.basename(path))
+
+def open_backup_writer(path, resume=None):
+    """
+    Opens writer of backup file of the format given by its name. With resume
+    (writer state saved by checkpoint()) the partial file is cut back to the
+    checkpoint and writing continues from there.
+    """
+    if backup_file_format(path) == MANIFEST_SUFFIX:
+        writer = DedupBackupWriter(path, CHUNK_STORE, None if COMPRESSION == 'none' else COMPRESSION,
+                                   resume)
+    elif backup_file_codec(path):
+        writer = CompressedBackupWriter(path, backup_file_codec(path), COMPRESSION_LEVEL, resume)
+    else:
+        writer = RawBackupWriter(path, resume)
+    if resume and 'sums' not in resume:
+        # Checkpoint taken without block checksums, they can't be continued
+        return writer
+    return SummedWriter(writer, BlockSums(sums_path(path), resume and resume['sums']))
+
+def sums_path(path):
+    return os.path.join(os.path.dirname(path), '.%s.sums' % os.path.basename(path))
+
+def crc_zeros(length, crc=0):
+    while length:
+        chunk = min(length, len(ZERO_BLOCK))
+        crc = zlib.crc32(buffer(ZERO_BLOCK, 0, chunk), crc)
+        length -= chunk
+    return crc
+
+def zero_crc(length):
+    return '%08x' % (crc_zeros(length) & 0xffffffff)
+
+class BlockSums(object):
+    """
+    CRC32 of every SUMS_BLOCK_SIZE block of logical content of a backup file,
+    fed by the same write() and skip() calls as the backup writer. Blocks of
+    holes only are recorded as '-' and never hashed. With path, sums are
+    written to <path>.tmp as blocks complete and moved to path on close,
+    otherwise they are collected in memory.
+    """
+    def __init__(self, path=None, resume=None, block_size=None):
+        self.path = path
+        self.block_size = block_size or SUMS_BLOCK_SIZE
+        self.sums = []
+        self.crc = 0
+        self.filled = 0
+        self.zeros = 0
+        self.data = False
+        self.pos = 0
+        self.ckpt_length = 0
+        if path is None:
+            return
+        if resume:
+            self.f = open(path + '.tmp', 'r+')
+            self.f.truncate(resume['length'])
+            self.f.seek(resume['length'])
+            self.ckpt_length = resume['length']
+            for key in ('crc', 'filled', 'zeros', 'data', 'pos'):
+                setattr(self, key, resume[key])
+        else:
+            self.f = open(path + '.tmp', 'w')
+            self.f.write("%s crc32 block_size=%s\n" % (SUMS_HEADER, self.block_size))
+
+    def _advance(self, length):
+        self.pos += length
+        self.filled += length
+        if self.filled == self.block_size:
+            self._emit()
+
+    def _emit(self):
+        value = '%08x' % (self.crc & 0xffffffff) if self.data else '-'
+        if self.path:
+            self.f.write(value + '\n')
+        else:
+            self.sums.append(value)
+        self.crc = 0
+        self.filled = 0
+        self.zeros = 0
+        self.data = False
+
+    def write(self, data):
+        offset = 0
+        while offset < len(data):
+            length = min(self.block_size - self.filled, len(data) - offset)
+            if self.zeros:
+                self.crc = crc_zeros(self.zeros, self.crc)
+                self.zeros = 0
+            self.crc = zlib.crc32(buffer(data, offset, length), self.crc)
+            self.data = True
+            self._advance(length)
+            offset += length
+
+    def skip(self, length):
+        while length:
+            chunk = min(self.block_size - self.filled, length)
+            if self.data:
+                self.crc = crc_zeros(chunk, self.crc)
+            else:
+                self.zeros += chunk
+            self._advance(chunk)
+            length -= chunk
+
+    def checkpoint(self):
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.ckpt_length = self.f.tell()
+        return {'length': self.ckpt_length, 'crc': self.crc, 'filled': self.filled,
+                'zeros': self.zeros, 'data': self.data, 'pos': self.pos}
+
+    def abort(self):
+        self.f.close()
+        if not self.ckpt_length:
+            os.remove(self.path + '.tmp')
+
+    def close(self):
+        if self.filled:
+            self._emit()
+        if self.path is None:
+            return self.sums
+        self.f.write("# size %s\n" % self.pos)
+        self.f.close()
+        os.rename(self.path + '.tmp', self.path)
+
+def read_sums(path):
+    """
+    Returns (block size, logical size, list of block checksums) of backup
+    file or None if it has no checksums.
+    """
+    if not os.path.exists(sums_path(path)):
+        return None
+    with open(sums_path(path)) as f:
+        lines = f.read().splitlines()
+    if not lines or not lines[0].startswith(SUMS_HEADER) or not lines[-1].startswith('# size'):
+        raise IOError("%s is not a complete checksums file" % sums_path(path))
+    block_size = int(lines[0].rpartition('block_size=')[2])
+    return block_size, int(lines[-1].split()[2]), lines[1:-1]
+
+class SummedWriter(object):
+    # Backup writer which also records block checksums of what it writes
+    def __init__(self, writer, sums):
+        self.writer = writer
+        self.sums = sums
+
+    @property
+    def pos(self):
+        return self.writer.pos
+
+    def write(self, data):
+        self.sums.write(data)
+        self.writer.write(data)
+
+    def skip(self, length):
+        self.sums.skip(length)
+        self.writer.skip(length)
+
+    def checkpoint(self):
+        state = self.writer.checkpoint()
+        state['sums'] = self.sums.checkpoint()
+        return state
+
+    def abort(self):
+        self.writer.abort()
+        self.sums.abort()
+
+    def close(self):
+        self.writer.close()
+        self.sums.close()
+
+def partial_backup_path(path):
+    # Deduplicated backups are written to a temporary manifest, others in place
+    if backup_file_format(path) == MANIFEST_SUFFIX:
+        return os.path.join(os.path.dirname(path), '.%s.tmp' % os.path.basename(path))
+    return path
+
+def checkpoint_path(path):
+    return os.path.join(os.path.dirname(path), '.%s.ckpt' % os.path.basename(path))
+
+def file_crc(path, start, end, crc=0):
+    # CRC32 of bytes start..end of file continuing from crc
+    with open(path, 'rb') as f:
+        f.seek(start)
+        while start < end:
+            data = f.read(min(COMPRESS_BLOCK_SIZE, end - start))
+            if not data:
+                break
+            crc = zlib.crc32(data, crc)
+            start += len(data)
+    return crc & 0xffffffff
+
+class CrcFile(object):
+    """
+    File being written which keeps CRC32 of the CHECKPOINT_CRC_BLOCK block
+    its content ends in, computed from the data passing through. Ranges
+    seeked over are holes of zeros. Other methods go to the file.
+    """
+    def __init__(self, f, length=0, crc=0):
+        self.f = f
+        self.offset = f.tell()
+        self.length = length
+        self.crc = crc
+
+    def _feed(self, length, data=None):
+        # Extends content by data, or zeros, block by block
+        done = 0
+        while done < length:
+            if self.length % CHECKPOINT_CRC_BLOCK == 0:
+                self.crc = 0
+            chunk = min(length - done, CHECKPOINT_CRC_BLOCK - self.length % CHECKPOINT_CRC_BLOCK)
+            if data is None:
+                self.crc = crc_zeros(chunk, self.crc)
+            else:
+                self.crc = zlib.crc32(buffer(data, done, chunk), self.crc)
+            self.length += chunk
+            done += chunk
+
+    def write(self, data):
+        if self.offset < self.length:
+            raise IOError("Backup file %s is overwritten at %s" % (self.f.name, self.offset))
+        if self.offset > self.length:
+            # Blocks of a hole before the one it ends in don't count
+            self.length = max(self.length,
+                              self.offset//CHECKPOINT_CRC_BLOCK*CHECKPOINT_CRC_BLOCK)
+            self._feed(self.offset - self.length)
+        self._feed(len(data), data)
+        self.f.write(data)
+        self.offset += len(data)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        self.f.seek(offset, whence)
+        self.offset = self.f.tell()
+
+    def __getattr__(self, name):
+        return getattr(self.f, name)
+
+def save_json(path, data):
+    # Replaces file atomically, so it's either the old or the new content
+    tmp = path + '.new'
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp, path)
+
+class ExportCheckpoint(object):
+    """
+    Progress of an export kept in .<backup file>.ckpt next to the backup file:
+    image offset up to which everything is written, state of the writer and
+    CRC32 of the last CHECKPOINT_CRC_BLOCK block of the partial file, kept
+    up to date by the writer's file as it writes. Export of the same
+    snapshots continues from the last checkpoint if the partial file still
+    matches it.
+    """
+    def __init__(self, dest_file, snap, from_snap, size):
+        self.path = checkpoint_path(dest_file)
+        self.partial = partial_backup_path(dest_file)
+        self.key = {'snap': snap, 'from_snap': from_snap, 'size': size}
+        # Uploads to S3 are not resumed
+        self.interval = 0 if in_object_store(dest_file) else CHECKPOINT_INTERVAL
+        self.crc = 0
+        self.length = 0
+        self.since = 0
+        self.file = None
+
+    def load(self):
+        if not os.path.isfile(self.path):
+            return None
+        with open(self.path) as f:
+            state = json.load(f)
+        if any([state.get(k) != v for k, v in self.key.items()]):
+            LOG.info("Checkpoint %s is of other snapshots, starting over" % self.path)
+            discard_checkpoint(self.path)
+            return None
+        length = state['writer']['length']
+        block = (length - 1)//CHECKPOINT_CRC_BLOCK*CHECKPOINT_CRC_BLOCK if length else 0
+        if not os.path.isfile(self.partial) or os.path.getsize(self.partial) < length \
+                or file_crc(self.partial, block, length) != state.get('tail_crc'):
+            LOG.warning("%s doesn't match checkpoint, starting over" % self.partial)
+            discard_checkpoint(self.path, release=False)
+            return None
+        self.crc = state['tail_crc']
+        self.length = length
+        return state
+
+    def track(self, writer):
+        # Partial file of writer computes the CRC as it is written
+        if self.interval <= 0:
+            return
+        inner = getattr(writer, 'writer', writer)
+        if not self.length and inner.f.tell():
+            # Header written by a new writer, not more than a line
+            inner.f.flush()
+            self.length = inner.f.tell()
+            self.crc = file_crc(self.partial, 0, self.length)
+        inner.f = self.file = CrcFile(inner.f, self.length, self.crc)
+
+    def update(self, writer, offset, nbytes):
+        # Saves a checkpoint every CHECKPOINT_INTERVAL bytes read from image
+        self.since += nbytes
+        if self.interval <= 0 or self.since < self.interval:
+            return
+        self.since = 0
+        state = writer.checkpoint()
+        if self.file.length != state['length']:
+            raise IOError("%s has %s bytes, %s written" \
+                    % (self.partial, state['length'], self.file.length))
+        save_json(self.path, dict(self.key, offset=offset, writer=state,
+                                  tail_crc=self.file.crc & 0xffffffff))
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+def discard_checkpoint(path, release=True):
+    """
+    Removes export checkpoint with the partial backup file it belongs to.
+    References of a partial deduplicated backup are dropped unless its
+    content can't be trusted, leaking blocks is safer than losing them.
+    """
+    dest_file = os.path.join(os.path.dirname(path), os.path.basename(path)[1:-len('.ckpt')])
+    partial = partial_backup_path(dest_file)
+    if os.path.exists(sums_path(dest_file) + '.tmp'):
+        os.remove(sums_path(dest_file) + '.tmp')
+    if os.path.exists(partial):
+        if release and partial != dest_file:
+            with open(path) as f:
+                length = json.load(f)['writer']['length']
+            with open(partial, 'r+') as f:
+                f.truncate(length)
+            CHUNK_STORE.release(partial)
+        os.remove(partial)
+    os.remove(path)
+
+def clip_extents(extents, start):
+    # Drops extents, or parts of them, below offset start
+    clipped = []
+    for offset, length, exists in extents:
+        if offset + length <= start:
+            continue
+        if offset < start:
+            length -= start - offset
+            offset = start
+        clipped.append((offset, length, exists))
+    return clipped
+
+def compressed_logical_size(path):
+    # Walks frame headers of compressed backup file without decompressing
+    size = 0
+    with open_backup_input(path) as f:
+        f.seek(len(COMPRESSED_MAGIC))
+        f.seek(struct.unpack('<B', f.read(1))[0], os.SEEK_CUR)
+        while True:
+            # Frame headers are read at once, each is a single request in S3
+            head = f.read(9)
+            if head[:1] == 'D':
+                raw_len, length = struct.unpack('<II', head[1:])
+                f.seek(length, os.SEEK_CUR)
+                size += raw_len
+            elif head[:1] == 'H':
+                size += struct.unpack('<Q', head[1:])[0]
+            else:
+                return size
+
+def diff_parent(path):
+    # Returns the "from snapshot" of export-diff stream in backup file
+    head = ''
+    for length, data in read_backup_file(path):
+        head += data or '\0'*length
+        if len(head) >= len(RBD_DIFF_BANNER) + 5 + 256:
+            break
+    offset = len(RBD_DIFF_BANNER)
+    if not head.startswith(RBD_DIFF_BANNER) or head[offset:offset+1] != 'f':
+        return None
+    length = struct.unpack('<I', head[offset+1:offset+5])[0]
+    return head[offset+5:offset+5+length]
+
+def read_backup_file(path):
+    """
+    Generator yielding (length, data) pieces of logical content of a backup
+    file, decompressing it on the fly if needed. Data is None for holes
+    which must be treated as zeros.
+    """
+    if backup_file_format(path) == MANIFEST_SUFFIX:
+        for length, chunk in read_manifest(path):
+            yield length, CHUNK_STORE.get(chunk) if chunk else None
+        return
+    with open_backup_input(path) as f:
+        if not backup_file_codec(path):
+            while True:
+                data = f.read(COMPRESS_BLOCK_SIZE)
+                if not data:
+                    return
+                yield len(data), data
+        magic = f.read(len(COMPRESSED_MAGIC))
+        if magic != COMPRESSED_MAGIC:
+            raise IOError("%s is not a compressed backup file" % path)
+        codec = f.read(struct.unpack('<B', f.read(1))[0])
+        while True:
+            tag = f.read(1)
+            if tag == 'D':
+                raw_len, length = struct.unpack('<II', f.read(8))
+                data = decompress_block(codec, f.read(length))
+                if len(data) != raw_len:
+                    raise IOError("Corrupted frame in %s" % path)
+                yield raw_len, data
+            elif tag == 'H':
+                yield struct.unpack('<Q', f.read(8))[0], None
+            elif tag == 'E':
+                return
+            else:
+                raise IOError("Unexpected end of compressed backup file %s" % path)
+
+def export_rbd_native(rbd_name, snap, dest_file, from_snap=None):
+    """
+    Exports RBD snapshot to dest_file using librbd directly. Without from_snap
+    the file is a raw image like produced by "rbd export", otherwise it is
+    an "rbd export-diff" stream of changes between from_snap and snap.
+    Raw images are written as sparse files: only allocated extents of the
+    image are read, everything else is left as holes in the file.
+    Progress is checkpointed, a failed export of the same snapshots
+    continues where the last checkpoint was taken.
+    """
+    ioctx = get_pool_ioctx(rbd_name)
+    with rbd.Image(ioctx, rbd_name, snapshot=snap, read_only=True) as rbd_image:
+        size = rbd_image.size()
+        ckpt = ExportCheckpoint(dest_file, snap, from_snap, size)
+        state = ckpt.load() if ckpt.interval > 0 else None
+        start = state['offset'] if state else 0
+        if state:
+            LOG.info("Resuming export of %s@%s at %.2f GB" % (rbd_name, snap, start/1024.0**3))
+        writer = open_backup_writer(dest_file, state and state['writer'])
+        try:
+            ckpt.track(writer)
+            if from_snap is None:
+                extents = [e for e in clip_extents(rbd_extents(rbd_image), start) if e[2]]
+                for offset, length, data in read_extents(rbd_image, extents):
+                    writer.skip(offset - writer.pos)
+                    if is_zero(data):
+                        writer.skip(length)
+                    else:
+                        writer.write(data)
+                    ckpt.update(writer, offset + length, length)
+                writer.skip(size - writer.pos)
+            else:
+                if not state:
+                    writer.write(RBD_DIFF_BANNER)
+                    writer.write('f' + struct.pack('<I', len(from_snap)) + from_snap)
+                    writer.write('t' + struct.pack('<I', len(snap)) + snap)
+                    write_diff_record(writer, 's', size)
+                extents = clip_extents(rbd_extents(rbd_image, from_snap), start)
+                for offset, length, data in read_extents(rbd_image, extents):
+                    if data is None:
+                        write_diff_record(writer, 'z', offset, length)
+                    else:
+                        write_diff_record(writer, 'w', offset, length)
+                        writer.write(data)
+                    ckpt.update(writer, offset + length, length if data else 0)
+                writer.write('e')
+        except:
+            writer.abort()
+            raise
+        writer.close()
+        ckpt.remove()
+    METRICS.add('export_bytes', sum([length for offset, length, exists in extents if exists]))
+    METRICS.add('export_extents', len(extents))
+
+def export_rbd(rbd_name, snap, dest_file, from_snap=None):
+    if EXPORT_ENGINE == 'native':
+        try:
+            export_rbd_native(rbd_name, snap, dest_file, from_snap)
+        except Exception:
+            return (traceback.format_exc(), 1)
+        return ('', 0)
+    pool = detect_pool(rbd_name)
+    # Throttled exports are streamed to be able to pace them
+    stream = backup_file_format(dest_file) is not None or THROTTLE.enabled()
+    if from_snap is None:
+        cmd = "rbd export --no-progress %s/%s --snap %s %s" \
+                % (pool, rbd_name, snap, '-' if stream else dest_file)
+    else:
+        cmd = "rbd export-diff --no-progress %s/%s --snap %s --from-snap %s %s" \
+                % (pool, rbd_name, snap, from_snap, '-' if stream else dest_file)
+    if not stream:
+        return execute(cmd)
+    try:
+        return export_stream(cmd, dest_file, pool)
+    except Exception:
+        return (traceback.format_exc(), 1)
+
+def export_stream(cmd, dest_file, pool=None):
+    # Pipe output of rbd CLI through the compressing or deduplicating writer,
+    # the backup file is finalized only if the export succeeded
+    err = tempfile.TemporaryFile()
+    p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=err)
+    writer = open_backup_writer(dest_file)
+    host = getattr(JOB, 'host', None)
+    nbytes = 0
+    try:
+        while True:
+            data = p.stdout.read(COMPRESS_BLOCK_SIZE)
+            if not data:
+                break
+            THROTTLE.consume(len(data), pool, host)
+            writer.write(data)
+            nbytes += len(data)
+    except:
+        try:
+            p.kill()
+        except OSError:
+            pass
+        p.wait()
+        discard_backup_writer(writer, dest_file)
+        raise
+    rc = p.wait()
+    if rc != 0:
+        discard_backup_writer(writer, dest_file)
+    else:
+        writer.close()
+        METRICS.add('export_bytes', nbytes)
+    err.seek(0)
+    return (err.read(), rc)
+
+def discard_backup_writer(writer, path):
+    # Drops partial backup written without checkpoints and chunk references it took
+    writer.abort()
+    if not in_object_store(path) and os.path.exists(path):
+        os.remove(path)
+
+def export_diff(instance, rbd_list, full_backup=False, resume=False):
+    res = 0
+    exported = 0
+    dest_dir = None
+    catalog_files = []
+    curr_time = current_time()
+    for rbd_image in rbd_list:
+        snaps_list = snapshots_list(rbd_image)
+        if not snaps_list:
+            LOG.error("No proper snapshots found for image %s ! Backup is not possible!" % rbd_image.name)
+            dest_dir = "/".join((backup_folder(instance), curr_time))
+            ensure_dir(dest_dir)
+            res += 1
+            continue
+        snap = snaps_list[-1]
+        pool = detect_pool(rbd_image.name)
+        dest_dir = "/".join((backup_folder(instance), snap))
+        ensure_dir(dest_dir)
+        if resume and backup_is_available(instance, snap, rbd_image.name):
+            LOG.info("Backup of %s at %s is already done" % (rbd_image.name, snap))
+            continue
+        from_snap = None
+        if full_backup:
+            LOG.info("Export RBD image %s" % rbd_image.name)
+            filename = "full_" + rbd_image.name + BACKUP_FILE_SUFFIX
+        else:
+            if len(snaps_list)==1:
+                LOG.error("Only one snapshot found for image %s ! Incremental backup is not possible!" % rbd_image.name)
+                dest_dir = "/".join((backup_folder(instance), curr_time))
+                ensure_dir(dest_dir)
+                res += 1
+                continue
+            LOG.info("Export-diff RBD image %s" % rbd_image.name)
+            filename = "inc_" + rbd_image.name + BACKUP_FILE_SUFFIX
+            # Find the latest snapshot for which backup of any type is available
+            # In normal conditions this snapshot must be the first one
+            # We must start from the second from the end (-2 index)
+            for n in range(2, len(snaps_list)+1):
+                if backup_is_available(instance, snaps_list[-n], rbd_image.name):
+                    from_snap = snaps_list[-n]
+                    break
+            if not from_snap:
+                LOG.error("DANGER! No previous backups found for current RBD snapshots! Backup chain is likely to be broken")
+                res+=1
+                continue
+        dest_file = os.path.join(dest_dir, filename)
+        with SCHEDULER.pool_slot(pool), METRICS.timer('export'):
+            out, rc = export_rbd(rbd_image.name, snap, dest_file, from_snap)
+        if rc==0: 
+            exported += backup_file_length(dest_file)
+            size, used = file_sizes(dest_file)
+            METRICS.add('backup_files')
+            METRICS.add('backup_used_bytes', used)
+            catalog_files.append((snap, filename, rbd_image.name, 'full' if full_backup else 'inc',
+                                  size, used, from_snap))
+            if full_backup:
+                LOG.info("Full backup of %s successfully finished." % rbd_image.name)
+            else:
+                LOG.info("Incremental backup of %s successfully finished." % rbd_image.name)
+            PRUNER.prune(rbd_image.name, snaps_list[:-1])
+            continue
+        else:
+            res += 1
+            LOG.error("RBD export failed: %s" % out)
+    if dest_dir:
+        status_file = os.path.join(dest_dir, 'status')
+        with open(status_file, "w+") as f:
+            f.write(str(res) + '\n')
+        if S3_STORE:
+            # The catalog can be rebuilt from the bucket alone
+            S3_STORE.put(S3_STORE.key(status_file), str(res) + '\n')
+    CATALOG.record(os.path.basename(backup_folder(instance)),
+                   os.path.basename(dest_dir) if dest_dir else None, res, catalog_files)
+    remove_empty_subdirs(backup_folder(instance))
+    if full_backup and res == 0:
+        prune_backups(instance)
+    return res, exported
+
+def prune_backups(instance):
+    # Removes the oldest full backup with its incrementals when over retention
+    backups = get_backups(instance)
+    full_backup_dates = [d for d in sorted(backups.keys()) if backups[d].get('type') == 'full']
+    if len(backups) > 7*(BACKUP_RETENTION_WEEKS+1) and len(full_backup_dates)>=2:
+        date1, date2 = full_backup_dates[0], full_backup_dates[1]
+        upper_dir = backup_folder(instance)
+        for root, dirs, files in os.walk(upper_dir):
+            for dir in dirs:
+                if date1 <= dir < date2:
+                    remove_backup_dir(os.path.join(root, dir))
+
+def import_stream(cmd, filepath, pool=None):
+    # Feed decompressed or reassembled backup to stdin of rbd CLI. If reading
+    # the backup fails rbd is killed, so it doesn't commit a truncated image
+    p = subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE,
+                         stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    host = getattr(JOB, 'host', None)
+
+    def feed(data):
+        # False once rbd exited early, its output tells why
+        try:
+            p.stdin.write(data)
+            return True
+        except IOError as msg:
+            if msg.errno != errno.EPIPE:
+                raise
+            LOG.error("Error streaming %s: %s" % (filepath, msg))
+            return False
+
+    try:
+        for length, data in read_backup_file(filepath):
+            if data is None:
+                fed = True
+                while length and fed:
+                    chunk = min(length, COMPRESS_BLOCK_SIZE)
+                    fed = feed('\0'*chunk)
+                    length -= chunk
+            else:
+                THROTTLE.consume(len(data), pool, host)
+                fed = feed(data)
+            if not fed:
+                break
+    except:
+        try:
+            p.kill()
+        except OSError:
+            pass
+        p.wait()
+        raise
+    finally:
+        try:
+            p.stdin.close()
+        except IOError:
+            pass
+    out = p.stdout.read()
+    rc = p.wait()
+    return (out, rc)
+
+def rbd_import(rbd_image, filepath):
+    pool = detect_pool(rbd_image)
+    if backup_file_format(filepath) or THROTTLE.enabled():
+        cmd = "rbd import --no-progress - %s/%s" % (pool, rbd_image)
+        out, rc = import_stream(cmd, filepath, pool)
+    else:
+        cmd = "rbd import  --no-progress %s %s/%s" % (filepath, pool, rbd_image)
+        out, rc = execute(cmd)
+    if rc!=0:
+        raise IOError("Import of %s to %s/%s failed: %s" % (filepath, pool, rbd_image, out))
+
+def import_diff(rbd_image, filepath):
+    pool = detect_pool(rbd_image)
+    if backup_file_format(filepath) or THROTTLE.enabled():
+        cmd = "rbd import-diff --no-progress - %s/%s" % (pool, rbd_image)
+        out, rc = import_stream(cmd, filepath, pool)
+    else:
+        cmd = "rbd import-diff --no-progress %s %s/%s" % (filepath, pool, rbd_image)
+        out, rc = execute(cmd)
+    if rc!=0:
+        raise IOError("Import of diff %s to %s/%s failed: %s" % (filepath, pool, rbd_image, out))
+
+def full_backup_available(instance):
+    backups = get_backups(instance).values()
+    if not backups or all([backup.get('type')!='full' for backup in backups]):
+        return False
+    else:
+        return True
+
+def unfinished_backup(instance, rbd_list, full_backup=False):
+    """
+    Returns (date, full_backup) of the latest backup of instance which failed
+    leaving export checkpoints behind, if it can be continued: its snapshot
+    is still the latest one of every image and it's full if a full backup is
+    requested. Other checkpoints are discarded with their partial files.
+    """
+    found = None
+    latest = set()
+    for rbd_image in rbd_list:
+        snaps = snapshots_list(rbd_image)
+        latest.add(snaps[-1] if snaps else None)
+    for path in sorted(glob(os.path.join(backup_folder(instance), '*', '.*.ckpt'))):
+        with open(path) as f:
+            full = json.load(f).get('from_snap') is None
+        date = os.path.basename(os.path.dirname(path))
+        if latest == set([date]) and (full or not full_backup):
+            found = (date, full_backup or full)
+        else:
+            LOG.info("Discarding checkpoint %s" % path)
+            discard_checkpoint(path)
+    return found
+
+def plan_backup(instance, rbd_list, full_backup):
+    """
+    Chooses between resuming an unfinished backup, a full and an incremental
+    one. Returns (unfinished, full_backup), unfinished is None or the date
+    of the backup to resume.
+    """
+    unfinished = unfinished_backup(instance, rbd_list, full_backup)
+    if unfinished:
+        date, full_backup = unfinished
+        LOG.info("Resuming %s backup of %s %s taken at %s" \
+                % ('full' if full_backup else 'incremental', target_kind(instance),
+                   instance.name, date))
+    elif full_backup:
+        # Older snapshots are pruned after the export, until then they
+        # anchor incremental backups in case the full one fails
+        LOG.info("Taking full backup of %s %s" % (target_kind(instance), instance.name))
+    else:
+        # If no full backup found - take full backup instead of incremental
+        if not full_backup_available(instance):
+            full_backup = True
+            LOG.info("No previous full backup found of %s" % instance.name) 
+            LOG.info("Taking full backup of %s %s" % (target_kind(instance), instance.name))
+        else:
+            LOG.info("Taking incremental backup of %s %s" % (target_kind(instance), instance.name))
+    return unfinished and unfinished[0], full_backup
+
+def instance_backup(instance, dom, rbd_list, full_backup=False):
+    LOG.info("="*80)
+    unfinished, full_backup = plan_backup(instance, rbd_list, full_backup)
+    if not unfinished and not take_rbd_snapshots(dom, rbd_list, instance.name):
+        # Without fresh snapshots the last ones would be exported again
+        LOG.error("Snapshots of %s failed, backup is not possible!" % instance.name)
+        LOG.info("="*80)
+        return 1, 0
+    res, exported = export_diff(instance, rbd_list, full_backup=full_backup,
+                                resume=bool(unfinished))
+    if res == 0:
+        LOG.info("Done")
+    LOG.info("="*80)
+    return res, exported
+
+def instance_host(instance):
+    if isinstance(instance, VolumeTarget):
+        # Detached volumes are not tied to any host
+        return instance_host(instance.server) if instance.server else None
+    return getattr(instance, 'OS-EXT-SRV-ATTR:hypervisor_hostname')
+
+def instance_rbd_images(instance, with_root=None):
+    if isinstance(instance, VolumeTarget):
+        return [rbd.Image(CLOUD.ioctx(VOLUMES_POOL), instance.rbd_name)]
+    rbd_list = []
+    if with_root is None:
+        with_root = (args.backup_root_disks and instance_in_ceph(instance)) or \
+                    instance in INSTANCES_WITH_ROOT
+    # Check instance was launched from image, otherwise skip Nova RBD disks lookup
+    if instance.image and with_root:
+        rbd_id = str(instance.id + "_disk")
+        rbd_list.append(rbd.Image(CLOUD.ioctx(VMS_POOL), rbd_id))
+    volumes_attached = INVENTORY.server_volumes(instance.id)
+    if volumes_attached:
+        for volume in volumes_attached:
+            vol_id = str('volume-' + volume.id)
+            rbd_list.append(rbd.Image(CLOUD.ioctx(VOLUMES_POOL), vol_id))
+    return rbd_list
+
+def backup_instance_job(instance, full_backup=False, auto=False, with_root=None):
+    rbd_list = instance_rbd_images(instance, with_root)
+    if not rbd_list:
+        # Instances with root disks not chosen for backup and having no
+        # volumes attached or with root disk not in Ceph have nothing to backup
+        LOG.warning("Nothing to backup for instance %s" % instance.name)
+        return None, 0
+    #for rbd_img in rbd_list:
+    #    if is_clone(rbd_img):
+    #        LOG.info("Flattening RBD image %s/%s" % \
+    #                (detect_pool(rbd_img.name), rbd_img.name))
+    #        rbd_img.flatten()
+    host = instance_host(instance)
+    virsh_name = getattr(instance, 'OS-EXT-SRV-ATTR:instance_name')
+    synth = False
+    try:
+        if auto:
+            full_backup, synth = apply_backup_policy(instance, rbd_list)
+        with SCHEDULER.host_slot(host), LIBVIRT_CONNS.use(host) as libvirt_conn:
+            dom = libvirt_conn.lookupByName(virsh_name)
+            res, exported = instance_backup(instance, dom, rbd_list, full_backup=full_backup)
+    finally:
+        for rbd_image in rbd_list:
+            rbd_image.close()
+    if synth and res == 0:
+        res = synthesize_full(instance)[0] or 0
+    return res, exported
+
+def apply_backup_policy(instance, rbd_list):
+    # Returns (full_backup, synth) chosen by the policy from measured changes
+    changes = measure_changes(instance, rbd_list)
+    backup_type, predicted, reason = choose_backup_type(instance, changes)
+    LOG.info("Policy chose %s backup of %s (%s), %.2f GB to read" \
+            % (backup_type, instance.name, reason, predicted/1024.0**3))
+    CATALOG.record_changes(os.path.basename(backup_folder(instance)),
+                           current_time(), changes)
+    return backup_type == 'full', backup_type == 'synth'
+
+def measure_changes(instance, rbd_list):
+    """
+    Measures images with diff_iterate before export: bytes changed since
+    the latest snapshot having a backup (None if there is no such snapshot)
+    and allocated bytes. Returns {rbd_name: (changed, allocated)}.
+    """
+    res = {}
+    for rbd_image in rbd_list:
+        from_snap = None
+        for snap in reversed(snapshots_list(rbd_image)):
+            if backup_is_available(instance, snap, rbd_image.name):
+                from_snap = snap
+                break
+        allocated = sum([length for offset, length, exists in rbd_extents(rbd_image) if exists])
+        changed = None
+        if from_snap:
+            changed = sum([length for offset, length, exists \
+                            in rbd_extents(rbd_image, from_snap) if exists])
+        res[rbd_image.name] = (changed, allocated)
+    return res
+
+def cycle_cost(full_cost, changed, allocated, days):
+    # Average daily cost of one full backup followed by days-1 incrementals:
+    # bytes read from the cluster plus weighted bytes read by a restore
+    moved = full_cost + (days - 1) * changed
+    restore = allocated + changed * (days - 1) / 2.0
+    return moved / float(days) + POLICY_RESTORE_WEIGHT * restore
+
+def choose_backup_type(instance, changes):
+    """
+    Picks 'full', 'inc' or 'synth' (incremental followed by synthetic full)
+    backup for instance. The daily change rate from history gives the
+    cycle length between full backups with the lowest average cost, full
+    backups are never further apart than retention allows to prune. Returns
+    (backup type, bytes to read from the cluster, reason).
+    """
+    allocated = sum([a for c, a in changes.values()])
+    if not full_backup_available(instance) or None in [c for c, a in changes.values()]:
+        return 'full', allocated, "no base for incremental"
+    changed = sum([c for c, a in changes.values()])
+    if changed >= allocated:
+        return 'full', allocated, "incremental not smaller than full"
+    backups = get_backups(instance)
+    chain_len = chain_bytes = 0
+    for date in sorted(backups.keys(), reverse=True):
+        if backups[date].get('type') == 'full':
+            break
+        elif backups[date].get('type') == 'inc':
+            chain_len += 1
+            chain_bytes += backups[date].get('size', 0)
+    history = CATALOG.change_history(os.path.basename(backup_folder(instance)), POLICY_HISTORY)
+    rate = (sum(history) + changed) / float(len(history) + 1)
+    cycles = [(cycle_cost(min(allocated, rate + POLICY_LOCAL_WEIGHT * (2*allocated + (n-1)*rate)),
+                          rate, allocated, n), n) for n in range(1, POLICY_MAX_CHAIN + 2)]
+    best_cycle = min(cycles)[1]
+    if chain_len + 1 < best_cycle:
+        return 'inc', changed, "%s of %s in cycle, %.1f%% changed daily" \
+                % (chain_len + 1, best_cycle, 100.0 * rate / allocated if allocated else 0)
+    # Synthetic full reads only the changes from the cluster, but merges the
+    # whole chain on the backup host
+    if allocated <= changed + POLICY_LOCAL_WEIGHT * (2*allocated + chain_bytes + changed):
+        return 'full', allocated, "cycle of %s complete" % best_cycle
+    return 'synth', changed, "cycle of %s complete" % best_cycle
+
+def policy_report(instances):
+    """
+    Prints backup type the policy would choose for every instance with
+    predicted amount of data read from the cluster. Nothing is changed.
+    """
+    totals = {'full': 0, 'inc': 0, 'synth': 0}
+    print(d.join(("", p(INSTANCE_LEN, 'INSTANCE'), p(TYPE_LEN, 'TYPE'), p(SIZE_LEN, 'READ(GB)'),
+                  p(SIZE_LEN, 'ALLOC(GB)'), 'REASON')))
+    for instance in remove_duplicates(instances):
+        rbd_list = instance_rbd_images(instance)
+        if not rbd_list:
+            continue
+        try:
+            changes = measure_changes(instance, rbd_list)
+        finally:
+            for rbd_image in rbd_list:
+                rbd_image.close()
+        backup_type, predicted, reason = choose_backup_type(instance, changes)
+        totals[backup_type] += predicted
+        allocated = sum([a for c, a in changes.values()])
+        print(d.join(("", p(INSTANCE_LEN, instance.name), p(TYPE_LEN, backup_type),
+                      p(SIZE_LEN, str(round(predicted/1024.0**3, 2))),
+                      p(SIZE_LEN, str(round(allocated/1024.0**3, 2))), reason)))
+    print("Predicted data to read: %.2f GB (full %.2f GB, inc %.2f GB, synth %.2f GB)" \
+            % (sum(totals.values())/1024.0**3, totals['full']/1024.0**3,
+               totals['inc']/1024.0**3, totals['synth']/1024.0**3))
+
+class BackupScheduler(object):
+    """
+    Runs backup jobs of many instances on a bounded pool of worker threads.
+    Besides the total number of workers, the number of instances processed
+    at the same time on one hypervisor host and the number of exports
+    running at the same time from one Ceph pool are limited separately.
+    """
+    def __init__(self, workers, per_host, per_pool):
+        self.workers = workers
+        self.per_host = per_host
+        self.per_pool = per_pool
+        self.lock = threading.Lock()
+        self.host_slots = {}
+        self.pool_slots = {}
+
+    def _slot(self, slots, key, limit):
+        with self.lock:
+            if key not in slots:
+                slots[key] = threading.BoundedSemaphore(limit)
+            return slots[key]
+
+    def host_slot(self, host):
+        return self._slot(self.host_slots, host, self.per_host)
+
+    def pool_slot(self, pool):
+        return self._slot(self.pool_slots, pool, self.per_pool)
+
+    def order_by_host(self, instances):
+        # Interleave instances of different hosts so that workers don't pile
+        # up waiting for the slots of a single hypervisor
+        by_host = {}
+        for instance in instances:
+            by_host.setdefault(instance_host(instance), []).append(instance)
+        queues = [by_host[host] for host in sorted(by_host.keys(), key=str)]
+        res = []
+        while queues:
+            for queue in queues:
+                res.append(queue.pop(0))
+            queues = [queue for queue in queues if queue]
+        return res
+
+    def run_job(self, job):
+        func, instance = job
+        kind = target_kind(instance)
+        threading.current_thread().name = instance.name
+        JOB.host = instance_host(instance)
+        time1 = datetime.now()
+        try:
+            res, exported = func(instance)
+        except Exception as msg:
+            LOG.exception("Backup of %s %s failed: %s" % (kind, instance.name, msg))
+            res, exported = 1, 0
+        elapsed = timedelta(datetime.now(), time1)
+        METRICS.instance(instance.name, id=instance.id, bytes=exported, seconds=elapsed,
+                         status='skipped' if res is None else 'failed' if res else 'ok')
+        if res is None:
+            LOG.info("%s %s: nothing to backup" % (kind.capitalize(), instance.name))
+        elif res == 0:
+            LOG.info("%s %s: backup OK, %.2f GB in %.2f sec" \
+                    % (kind.capitalize(), instance.name, exported/1024.0**3, elapsed))
+        else:
+            LOG.error("%s %s: backup FAILED with %s error(s) in %.2f sec" \
+                    % (kind.capitalize(), instance.name, res, elapsed))
+        return instance, res, exported, elapsed
+
+    def run(self, func, instances):
+        time1 = datetime.now()
+        instances = remove_duplicates(instances)
+        jobs = [(func, instance) for instance in self.order_by_host(instances)]
+        pool = ThreadPool(max(1, min(self.workers, len(jobs))))
+        try:
+            results = pool.map(self.run_job, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        elapsed = timedelta(datetime.now(), time1)
+        failed = [r[0].name for r in results if r[1]]
+        exported = sum([r[2] for r in results])
+        kind = target_kind(instances[0]) if instances else 'instance'
+        LOG.info("Backup of %s %ss finished in %.2f sec: %s OK, %s failed" \
+                % (len(results), kind, elapsed, len(results) - len(failed), len(failed)))
+        if failed:
+            LOG.error("Failed %ss: %s" % (kind, ", ".join(failed)))
+        LOG.info("Exported %.2f GB, throughput %.2f MB/s" \
+                % (exported/1024.0**3, exported/1024.0**2/elapsed if elapsed else 0))
+        return results
+
+class Pruner(object):
+    """
+    Removes snapshots and images on a pool of threads in the background of
+    backups, with at most per_pool removals running at the same time in
+    one Ceph pool. Snapshots of an image are removed one after another,
+    different images in parallel. The latest snapshot of an image which is
+    kept is never removed: it's the anchor of the next incremental backup.
+    """
+    def __init__(self, workers, per_pool):
+        self.workers = workers
+        self.per_pool = per_pool
+        self.lock = threading.Lock()
+        self.pool_slots = {}
+        self.threads = None
+        self.jobs = []
+        self.snapshots = 0
+        self.images = 0
+        self.failed = 0
+        self.time1 = None
+        self.time2 = None
+
+    def _slot(self, pool):
+        with self.lock:
+            if pool not in self.pool_slots:
+                self.pool_slots[pool] = threading.BoundedSemaphore(self.per_pool)
+            return self.pool_slots[pool]
+
+    def _count(self, snapshots=0, images=0, failed=0):
+        METRICS.add('pruned_snapshots', snapshots)
+        METRICS.add('pruned_images', images)
+        METRICS.add('prune_failures', failed)
+        with self.lock:
+            self.snapshots += snapshots
+            self.images += images
+            self.failed += failed
+            self.time2 = datetime.now()
+
+    def _prune(self, rbd_name, snaps, remove_image):
+        ioctx = get_pool_ioctx(rbd_name)
+        with self._slot(detect_pool(rbd_name)), METRICS.timer('prune'):
+            try:
+                with rbd.Image(ioctx, rbd_name) as rbd_image:
+                    if remove_image:
+                        snaps = [snap['name'] for snap in rbd_image.list_snaps()]
+                    else:
+                        anchor = snapshots_list(rbd_image)[-1:]
+                        snaps = [snap for snap in snaps if snap not in anchor]
+                    for snap in snaps:
+                        try:
+                            SNAPSHOTS.remove(rbd_image, snap)
+                            self._count(snapshots=1)
+                        except rbd.ImageNotFound:
+                            pass
+                        except Exception as msg:
+                            LOG.error("Removing snapshot %s@%s failed: %s" % (rbd_name, snap, msg))
+                            self._count(failed=1)
+                if remove_image:
+                    rbd.RBD().remove(ioctx, rbd_name)
+                    SNAPSHOTS.forget(rbd_name)
+                    self._count(images=1)
+            except rbd.ImageNotFound:
+                pass
+            except Exception as msg:
+                LOG.error("Pruning %s failed: %s" % (rbd_name, msg))
+                self._count(failed=1)
+
+    def prune(self, rbd_name, snaps=None, remove_image=False):
+        """
+        Removes given snapshots of image in the background, or all snapshots
+        and the image itself with remove_image.
+        """
+        with self.lock:
+            if self.threads is None:
+                self.threads = ThreadPool(self.workers)
+            if self.time1 is None:
+                self.time1 = datetime.now()
+            self.jobs.append(self.threads.apply_async(self._prune,
+                                                      (rbd_name, snaps, remove_image)))
+
+    def wait(self):
+        while self.jobs:
+            self.jobs.pop(0).wait()
+
+    def close(self):
+        self.wait()
+        if self.threads:
+            self.threads.close()
+            self.threads.join()
+            self.threads = None
+
+    def reset(self):
+        # Counts removals anew, for the next run of the daemon
+        with self.lock:
+            self.snapshots = self.images = self.failed = 0
+            self.time1 = self.time2 = None
+
+    def summary(self):
+        elapsed = timedelta(self.time2 or self.time1, self.time1)
+        return "Pruned %s snapshots and %s images in %.2f sec (%.1f snapshots/s), %s failed" \
+                % (self.snapshots, self.images, elapsed, self.snapshots / max(elapsed, 0.001),
+                   self.failed)
+
+class Metrics(object):
+    """
+    Timers of phases of a run, counters and outcomes of instances. Phase
+    times are summed over all threads. Written at the end of the run as
+    Prometheus textfile and one JSON line, and optionally served over HTTP
+    while the run goes on. Counters are updated once per image or job,
+    never from inner loops.
+    """
+    PREFIX = 'ceph_backup'
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = datetime.now()
+        self.mode = None
+        self.phases = {}
+        self.counters = {}
+        self.instances = {}
+
+    def reset(self, mode=None):
+        # Starts metrics of the next run of the daemon
+        with self.lock:
+            self.start = datetime.now()
+            self.mode = mode
+            self.phases = {}
+            self.counters = {}
+            self.instances = {}
+
+    @contextmanager
+    def timer(self, phase):
+        time1 = datetime.now()
+        try:
+            yield
+        finally:
+            self.observe(phase, timedelta(datetime.now(), time1))
+
+    def observe(self, phase, seconds):
+        with self.lock:
+            stats = self.phases.setdefault(phase, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds)
+
+    def add(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def instance(self, name, **values):
+        with self.lock:
+            self.instances.setdefault(name, {}).update(values)
+
+    def snapshot(self):
+        # Returns all metrics of the run as a dict
+        with self.lock:
+            duration = timedelta(datetime.now(), self.start)
+            return {'start': self.start.strftime('%Y-%m-%d %H:%M:%S'),
+                    'mode': self.mode,
+                    'duration': duration,
+                    'phases': dict([(phase, {'count': count, 'seconds': seconds, 'max': longest})
+                                    for phase, (count, seconds, longest) in self.phases.items()]),
+                    'counters': dict(self.counters),
+                    'export_throughput_mb_s': self.counters.get('export_bytes', 0)/1024.0**2/duration
+                                              if duration else 0,
+                    'instances': dict([(name, dict(values))
+                                       for name, values in self.instances.items()])}
+
+    @staticmethod
+    def labels(**labels):
+        return '{%s}' % ','.join(['%s="%s"' % (key, str(value).replace('\\', '\\\\')
+                                                 .replace('"', '\\"').replace('\n', '\\n'))
+                                  for key, value in sorted(labels.items())])
+
+    def prometheus(self):
+        # Renders metrics in Prometheus text exposition format
+        data = self.snapshot()
+        mode = data['mode'] or 'none'
+        lines = []
+        def metric(name, kind, help, samples):
+            name = '%s_%s' % (self.PREFIX, name)
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for labels, value in samples:
+                lines.append('%s%s %s' % (name, self.labels(mode=mode, **labels), value))
+        metric('run_start_time_seconds', 'gauge', 'Start of the run as Unix time',
+               [({}, '%.0f' % mktime(self.start.timetuple()))])
+        metric('run_duration_seconds', 'gauge', 'Duration of the run so far',
+               [({}, '%.3f' % data['duration'])])
+        phases = sorted(data['phases'].items())
+        metric('phase_seconds_total', 'counter', 'Time spent in phase, summed over threads',
+               [({'phase': phase}, '%.3f' % stats['seconds']) for phase, stats in phases])
+        metric('phase_calls_total', 'counter', 'Number of times phase ran',
+               [({'phase': phase}, stats['count']) for phase, stats in phases])
+        metric('phase_max_seconds', 'gauge', 'Longest single run of phase',
+               [({'phase': phase}, '%.3f' % stats['max']) for phase, stats in phases])
+        for name, value in sorted(data['counters'].items()):
+            metric(name + '_total', 'counter', name.replace('_', ' ').capitalize(), [({}, value)])
+        instances = sorted(data['instances'].items())
+        metric('instance_success', 'gauge', 'Whether the last job of instance succeeded',
+               [({'instance': name, 'id': values.get('id')}, int(values.get('status') != 'failed'))
+                for name, values in instances])
+        metric('instance_bytes', 'gauge', 'Bytes exported for instance',
+               [({'instance': name, 'id': values.get('id')}, values.get('bytes', 0))
+                for name, values in instances])
+        metric('instance_seconds', 'gauge', 'Duration of the job of instance',
+               [({'instance': name, 'id': values.get('id')}, '%.3f' % values.get('seconds', 0))
+                for name, values in instances])
+        return '\n'.join(lines) + '\n'
+
+    def write(self, textfile_dir=None, jsonl=None):
+        """
+        Writes ceph_backup_<mode>.prom into textfile_dir of node exporter
+        (atomically, as the collector may read it any time) and appends
+        metrics of the run to JSON lines file jsonl.
+        """
+        if textfile_dir:
+            path = os.path.join(textfile_dir, '%s_%s.prom' % (self.PREFIX, self.mode))
+            with open(path + '.tmp', 'w') as f:
+                f.write(self.prometheus())
+            os.rename(path + '.tmp', path)
+        if jsonl:
+            with open(jsonl, 'a') as f:
+                f.write(json.dumps(self.snapshot(), sort_keys=True) + '\n')
+
+    def serve(self, address, port):
+        # Serves metrics at http://address:port/metrics in a daemon thread
+        metrics = self
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+        server = BaseHTTPServer.HTTPServer((address, port), Handler)
+        thread = threading.Thread(target=server.serve_forever, name='metrics')
+        thread.daemon = True
+        thread.start()
+        return server
+
+class TokenBucket(object):
+    """
+    Lets through `rate` units per second on average, with bursts of up to a
+    second worth of units. Consumers over the limit go into debt and sleep
+    until it is paid off. Rate 0 means no limit.
+    """
+    def __init__(self, rate=0):
+        self.lock = threading.Lock()
+        self.rate = rate
+        self.tokens = rate
+        self.last = datetime.now()
+
+    def consume(self, amount, scale=1.0):
+        rate = self.rate * scale
+        if rate <= 0:
+            return
+        with self.lock:
+            now = datetime.now()
+            self.tokens = min(rate, self.tokens + timedelta(now, self.last) * rate) - amount
+            self.last = now
+            wait = -self.tokens / rate
+        if wait > 0:
+            sleep(wait)
+
+class Throttle(object):
+    """
+    Bandwidth and IOPS limits of exports from and imports to the cluster:
+    for the whole process, for every pool and for every hypervisor host.
+    Limits come from the config file (and control file if set), they are
+    reloaded on SIGHUP or when the control file changes. If
+    throttle_latency_ms is set, limits are scaled down while average OSD
+    commit latency from `ceph osd perf` stays above it.
+    """
+    LIMITS = ('bandwidth', 'iops', 'pool_bandwidth', 'pool_iops', 'host_bandwidth', 'host_iops')
+
+    def __init__(self, config_files, control_file=None):
+        self.config_files = config_files
+        self.control_file = control_file
+        self.control_mtime = None
+        self.checked = datetime.now()
+        self.reload_requested = False
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.scale = 1.0
+        self.feedback = None
+        self.reload()
+
+    def reload(self):
+        self.reload_requested = False
+        config = ConfigParser.ConfigParser()
+        files = self.config_files[:]
+        if self.control_file and os.path.isfile(self.control_file):
+            self.control_mtime = os.path.getmtime(self.control_file)
+            files.append(self.control_file)
+        config.read(files)
+        settings = dict(config.items('default')) if config.has_section('default') else {}
+        limits = {}
+        for name in self.LIMITS:
+            value = float(settings.get('throttle_' + name, 0))
+            limits[name] = value * 1024**2 if name.endswith('bandwidth') else value
+        with self.lock:
+            self.limits = limits
+            for (name, key), bucket in self.buckets.items():
+                bucket.rate = limits[name]
+        self.latency_ms = float(settings.get('throttle_latency_ms', 0))
+        self.sample_interval = float(settings.get('throttle_sample_interval', 10))
+        if any(limits.values()):
+            LOG.info("Throttling: %s" % ", ".join(["%s %s" % (name.replace('_', ' '), \
+                     "%.0f MB/s" % (value/1024**2) if name.endswith('bandwidth') else value) \
+                     for name, value in sorted(limits.items()) if value]))
+
+    def request_reload(self, *args):
+        # Called from signal handler, actual reload is done by next consumer
+        self.reload_requested = True
+
+    def check_reload(self):
+        if self.reload_requested:
+            self.reload()
+        elif self.control_file and timedelta(datetime.now(), self.checked) >= 1:
+            self.checked = datetime.now()
+            if os.path.isfile(self.control_file) and \
+                    os.path.getmtime(self.control_file) != self.control_mtime:
+                LOG.info("Control file %s changed, reloading limits" % self.control_file)
+                self.reload()
+
+    def enabled(self):
+        return any(self.limits.values())
+
+    def bucket(self, name, key):
+        with self.lock:
+            if (name, key) not in self.buckets:
+                self.buckets[(name, key)] = TokenBucket(self.limits[name])
+            return self.buckets[(name, key)]
+
+    def consume(self, nbytes, pool=None, host=None):
+        self.check_reload()
+        for name, key, amount in (('bandwidth', '', nbytes), ('iops', '', 1),
+                                  ('pool_bandwidth', pool, nbytes), ('pool_iops', pool, 1),
+                                  ('host_bandwidth', host, nbytes), ('host_iops', host, 1)):
+            if self.limits[name] and key is not None:
+                self.bucket(name, key).consume(amount, self.scale)
+
+    def osd_latency(self):
+        ret, out, err = CLOUD.ceph().mon_command(json.dumps({'prefix': 'osd perf',
+                                                             'format': 'json'}), '')
+        if ret != 0:
+            LOG.warning("osd perf failed: %s" % err)
+            return None
+        perf = json.loads(out)
+        infos = perf.get('osdstats', perf).get('osd_perf_infos', [])
+        latencies = [info['perf_stats']['commit_latency_ms'] for info in infos]
+        return sum(latencies) / float(len(latencies)) if latencies else None
+
+    def feedback_loop(self):
+        while True:
+            sleep(self.sample_interval)
+            if self.latency_ms <= 0:
+                continue
+            try:
+                latency = self.osd_latency()
+            except Exception as msg:
+                LOG.warning("Cannot sample OSD latency: %s" % msg)
+                continue
+            if latency is None:
+                continue
+            if latency > self.latency_ms and self.scale > 0.05:
+                self.scale = max(0.05, self.scale / 2)
+                LOG.info("OSD latency %.1f ms above %.0f ms, limits scaled to %.0f%%" \
+                        % (latency, self.latency_ms, self.scale * 100))
+            elif latency <= self.latency_ms and self.scale < 1:
+                self.scale = min(1.0, self.scale + 0.1)
+                if self.scale == 1.0:
+                    LOG.info("OSD latency %.1f ms back under %.0f ms, limits restored" \
+                            % (latency, self.latency_ms))
+
+    def start_feedback(self):
+        if self.latency_ms <= 0 or self.feedback:
+            return
+        if not self.enabled():
+            LOG.warning("throttle_latency_ms has no effect without bandwidth or IOPS limits")
+        self.feedback = threading.Thread(target=self.feedback_loop, name='throttle-feedback')
+        self.feedback.daemon = True
+        self.feedback.start()
+
+class BackupSource(object):
+    """
+    Random access to logical content of a backup file of any format. For
+    compressed files and manifests an index of frames or blocks is built
+    when the file is opened, the last decompressed frame or block is cached.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.fmt = backup_file_format(path)
+        self.f = None
+        self.segments = []
+        self.cached = (None, None)
+        if self.fmt is None:
+            self.f = open(path, 'rb')
+            self.size = os.path.getsize(path)
+            return
+        pos = 0
+        if self.fmt == MANIFEST_SUFFIX:
+            for length, chunk in read_manifest(path):
+                self.segments.append((pos, length, chunk))
+                pos += length
+        else:
+            self.f = open_backup_input(path)
+            self.f.seek(len(COMPRESSED_MAGIC))
+            self.codec = self.f.read(struct.unpack('<B', self.f.read(1))[0])
+            while True:
+                head = self.f.read(9)
+                if head[:1] == 'D':
+                    raw_len, length = struct.unpack('<II', head[1:])
+                    self.segments.append((pos, raw_len, (self.f.tell(), length)))
+                    self.f.seek(length, os.SEEK_CUR)
+                    pos += raw_len
+                elif head[:1] == 'H':
+                    length = struct.unpack('<Q', head[1:])[0]
+                    self.segments.append((pos, length, None))
+                    pos += length
+                else:
+                    break
+        self.size = pos
+        self.offsets = [segment[0] for segment in self.segments]
+
+    def extents(self):
+        # (offset, length) of regions which may contain data
+        if self.fmt is None:
+            return data_ranges(self.f.fileno(), self.size)
+        return [(offset, length) for offset, length, key in self.segments if key]
+
+    def _load(self, key):
+        if self.cached[0] != key:
+            if self.fmt == MANIFEST_SUFFIX:
+                data = CHUNK_STORE.get(key)
+            else:
+                self.f.seek(key[0])
+                data = decompress_block(self.codec, self.f.read(key[1]))
+            self.cached = (key, data)
+        return self.cached[1]
+
+    def read(self, offset, length):
+        if self.fmt is None:
+            self.f.seek(offset)
+            return self.f.read(length)
+        res = []
+        i = bisect.bisect_right(self.offsets, offset) - 1
+        end = min(offset + length, self.size)
+        while offset < end:
+            start, seg_len, key = self.segments[i]
+            chunk = min(start + seg_len, end) - offset
+            if key is None:
+                res.append('\0'*chunk)
+            else:
+                res.append(self._load(key)[offset-start:offset-start+chunk])
+            offset += chunk
+            i += 1
+        return ''.join(res)
+
+    def close(self):
+        if self.f:
+            self.f.close()
+
+def parse_diff(source):
+    """
+    Generator over records of export-diff stream in backup source: yields
+    ('t', snap), ('s', size), ('w', offset, length, position of data in the
+    stream) and ('z', offset, length).
+    """
+    if source.read(0, len(RBD_DIFF_BANNER)) != RBD_DIFF_BANNER:
+        raise IOError("%s is not an export-diff stream" % source.path)
+    pos = len(RBD_DIFF_BANNER)
+    while True:
+        tag = source.read(pos, 1)
+        pos += 1
+        if tag in ('f', 't'):
+            length = struct.unpack('<I', source.read(pos, 4))[0]
+            name = source.read(pos + 4, length)
+            pos += 4 + length
+            if tag == 't':
+                yield ('t', name)
+        elif tag == 's':
+            yield ('s', struct.unpack('<Q', source.read(pos, 8))[0])
+            pos += 8
+        elif tag in ('w', 'z'):
+            offset, length = struct.unpack('<QQ', source.read(pos, 16))
+            pos += 16
+            if tag == 'w':
+                yield ('w', offset, length, pos)
+                pos += length
+            else:
+                yield ('z', offset, length)
+        elif tag == 'e':
+            return
+        else:
+            raise IOError("Unexpected end of export-diff stream %s" % source.path)
+
+class ExtentMap(object):
+    """
+    Non-overlapping extents (start, end, source, source offset) of an image,
+    an added extent replaces whatever it overlaps. Source None means zeros.
+    """
+    def __init__(self):
+        self.starts = []
+        self.extents = []
+
+    def add(self, start, length, source, source_offset=0):
+        end = start + length
+        i = max(0, bisect.bisect_right(self.starts, start) - 1)
+        if i < len(self.extents) and self.extents[i][1] <= start:
+            i += 1
+        j = i
+        while j < len(self.extents) and self.extents[j][0] < end:
+            j += 1
+        new = []
+        if i < j and self.extents[i][0] < start:
+            s, e, src, so = self.extents[i]
+            new.append((s, start, src, so))
+        new.append((start, end, source, source_offset))
+        if i < j and self.extents[j-1][1] > end:
+            s, e, src, so = self.extents[j-1]
+            new.append((end, e, src, so + end - s if src else 0))
+        self.extents[i:j] = new
+        self.starts[i:j] = [extent[0] for extent in new]
+
+    def truncate(self, size):
+        i = bisect.bisect_left(self.starts, size)
+        del self.extents[i:]
+        del self.starts[i:]
+        if self.extents and self.extents[-1][1] > size:
+            s, e, src, so = self.extents[-1]
+            self.extents[-1] = (s, size, src, so)
+
+    def __iter__(self):
+        return iter(self.extents)
+
+def restore_files(backups, rbd_name, dest_date):
+    """
+    Returns the chain of backup files restoring rbd_name to dest_date: the
+    latest full backup up to dest_date followed by incremental backups.
+    """
+    chain = []
+    for date in sorted(backups.keys()):
+        if date > dest_date or not backups[date].get('type'):
+            continue
+        files = [f for f in backups[date]['files'] \
+                    if BACKUP_FILE_RE.match(os.path.basename(f)).group(2) == rbd_name]
+        if not files:
+            continue
+        if backups[date]['type'] == 'full':
+            chain = [(date, files[0])]
+        elif chain:
+            chain.append((date, files[0]))
+    return chain
+
+def plan_restore(chain):
+    """
+    Collapses full backup and incremental backups into a single extent map,
+    the newest write wins. Only positions of data are kept in memory, the
+    data itself stays in the backup files. Returns (size, extent map, list
+    of opened sources).
+    """
+    extent_map = ExtentMap()
+    sources = []
+    size = 0
+    for n, (date, path) in enumerate(chain):
+        source = BackupSource(path)
+        sources.append(source)
+        if n == 0:
+            size = source.size
+            for offset, length in source.extents():
+                extent_map.add(offset, length, source, offset)
+            continue
+        for record in parse_diff(source):
+            if record[0] == 's':
+                size = record[1]
+                extent_map.truncate(size)
+            elif record[0] == 'w':
+                extent_map.add(record[1], record[2], source, record[3])
+            elif record[0] == 'z':
+                extent_map.add(record[1], record[2], None)
+    return size, extent_map, sources
+
+def write_extent_map(rbd_image, extent_map, start=0, ckpt=None):
+    """
+    Writes every extent of the map from offset start on to the (new, zeroed)
+    image exactly once. Up to RESTORE_INFLIGHT writes run at the same time,
+    through librbd async writes if available or a pool of threads otherwise.
+    With ckpt, writes are drained and flushed every CHECKPOINT_INTERVAL bytes
+    and the offset below which everything is written is saved.
+    """
+    slots = threading.Semaphore(RESTORE_INFLIGHT)
+    errors = []
+    written = [0]
+    rbd_pool, host = detect_pool(rbd_image.name), getattr(JOB, 'host', None)
+    pool = None if hasattr(rbd_image, 'aio_write') else ThreadPool(RESTORE_INFLIGHT)
+
+    def done(completion):
+        if completion.get_return_value() < 0:
+            errors.append(completion.get_return_value())
+        slots.release()
+
+    def write(data, offset):
+        try:
+            rbd_image.write(data, offset)
+        except Exception as msg:
+            errors.append(msg)
+        finally:
+            slots.release()
+
+    def drain():
+        for i in range(RESTORE_INFLIGHT):
+            slots.acquire()
+
+    try:
+        for extent_start, end, source, source_offset in extent_map:
+            if source is None or end <= start:
+                continue
+            offset = max(start, extent_start)
+            while offset < end and not errors:
+                length = min(EXPORT_CHUNK_SIZE, end - offset)
+                data = source.read(source_offset + offset - extent_start, length)
+                offset += length
+                if is_zero(data):
+                    continue
+                THROTTLE.consume(len(data), rbd_pool, host)
+                slots.acquire()
+                written[0] += len(data)
+                if pool:
+                    pool.apply_async(write, (data, offset - length))
+                else:
+                    rbd_image.aio_write(data, offset - length, done)
+                if ckpt and ckpt.due(len(data)):
+                    drain()
+                    if not errors:
+                        rbd_image.flush()
+                        ckpt.save(offset, rbd_image)
+                    for i in range(RESTORE_INFLIGHT):
+                        slots.release()
+        drain()
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    if errors:
+        raise IOError("Writing to %s failed: %s" % (rbd_image.name, errors[0]))
+    rbd_image.flush()
+    return written[0]
+
+def move_rbd_aside(rbd_name):
+    if rbd_image_exists(rbd_name + ".bak"):
+        delete_rbd_by_name(rbd_name + ".bak")
+    rename_rbd(rbd_name, rbd_name + ".bak")
+
+def create_restore_target(rbd_name, size):
+    # Moves existing image aside to <name>.bak and creates an empty one alike
+    ioctx = get_pool_ioctx(rbd_name)
+    kwargs = {}
+    if rbd_image_exists(rbd_name):
+        with rbd.Image(ioctx, rbd_name, read_only=True) as rbd_img:
+            kwargs = { 'old_format': False, 'features': rbd_img.features(),
+                       'order': rbd_img.stat()['order'] }
+        move_rbd_aside(rbd_name)
+    rbd.RBD().create(ioctx, rbd_name, size, **kwargs)
+    SNAPSHOTS.forget(rbd_name)
+
+def write_synthetic_full(chain, path):
+    """
+    Merges full backup and its incrementals into a new full backup file.
+    Data is streamed in order of image offsets one chunk at a time, so
+    memory use doesn't depend on the size of the image.
+    """
+    size, extent_map, sources = plan_restore(chain)
+    try:
+        writer = open_backup_writer(path)
+        for start, end, source, source_offset in extent_map:
+            writer.skip(start - writer.pos)
+            offset = start
+            while source and offset < end:
+                length = min(EXPORT_CHUNK_SIZE, end - offset)
+                data = source.read(source_offset + offset - start, length)
+                if is_zero(data):
+                    writer.skip(length)
+                else:
+                    writer.write(data)
+                offset += length
+        writer.skip(size - writer.pos)
+        writer.close()
+    finally:
+        for source in sources:
+            source.close()
+    return size
+
+def synthesize_full(instance):
+    """
+    Turns the latest incremental backup of instance into a full one built
+    from the previous full backup and its incrementals on the backup host,
+    without reading anything from the cluster. RBD snapshots are kept, so
+    the next incremental backup continues from the same snapshot.
+    """
+    backups = get_backups(instance)
+    dates = [date for date in sorted(backups.keys()) if backups[date].get('type')]
+    if not dates:
+        LOG.warning("No backups of instance %s found" % instance.name)
+        return None, 0
+    date = dates[-1]
+    if backups[date]['type'] == 'full':
+        LOG.info("Latest backup of instance %s is already full" % instance.name)
+        return None, 0
+    if backups[date]['status'] != STATUS_OK:
+        LOG.error("Latest backup of instance %s has errors, cannot synthesize full backup" \
+                % instance.name)
+        return 1, 0
+    LOG.info("Synthesizing full backup of instance %s for %s" % (instance.name, date))
+    date_dir = os.path.join(backup_folder(instance), date)
+    tmp_dir = os.path.join(date_dir, '.synth')
+    ensure_dir(tmp_dir)
+    written = []
+    try:
+        for path in backups[date]['files']:
+            rbd_name = BACKUP_FILE_RE.match(os.path.basename(path)).group(2)
+            chain = restore_files(backups, rbd_name, date)
+            if len(chain) < 2 or chain[-1][1] != path:
+                LOG.error("No full backup found for %s, cannot synthesize full backup" % rbd_name)
+                return 1, 0
+            filename = "full_" + rbd_name + BACKUP_FILE_SUFFIX
+            time1 = datetime.now()
+            with METRICS.timer('synthesize'):
+                write_synthetic_full(chain, os.path.join(tmp_dir, filename))
+            size, used = file_sizes(os.path.join(tmp_dir, filename))
+            LOG.info("-- %s merged from %s backups (+%s sec)" \
+                    % (filename, len(chain), timedelta(datetime.now(), time1)))
+            written.append((path, (date, filename, rbd_name, 'full', size, used, None)))
+        for path, file in written:
+            move_backup_file(os.path.join(tmp_dir, file[1]), os.path.join(date_dir, file[1]))
+            os.rename(sums_path(os.path.join(tmp_dir, file[1])),
+                      sums_path(os.path.join(date_dir, file[1])))
+            if backup_file_format(path) == MANIFEST_SUFFIX:
+                CHUNK_STORE.release(path)
+            remove_backup_file(path)
+            if os.path.exists(sums_path(path)):
+                os.remove(sums_path(path))
+        CATALOG.replace_files(os.path.basename(backup_folder(instance)), date,
+                              [os.path.basename(path) for path, file in written],
+                              [file for path, file in written])
+    finally:
+        for file in os.listdir(tmp_dir):
+            if backup_file_format(file) == MANIFEST_SUFFIX:
+                CHUNK_STORE.release(os.path.join(tmp_dir, file))
+        if S3_STORE:
+            S3_STORE.remove_prefix(tmp_dir)
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    prune_backups(instance)
+    return 0, sum([file[5] for path, file in written])
+
+class RestoreCheckpoint(object):
+    """
+    Progress of restore of one image kept in .restore_<rbd_name>.ckpt of the
+    instance backup folder: the chain being restored and image offset below
+    which all extents are written. Restore of the same chain continues from
+    there instead of creating the image again, unless the image was used
+    since: it has other snapshots than when the checkpoint was saved, or
+    watchers.
+    """
+    def __init__(self, rbd_name, chain, size):
+        folder = os.path.dirname(os.path.dirname(chain[0][1]))
+        self.path = os.path.join(folder, '.restore_%s.ckpt' % rbd_name)
+        self.key = json.loads(json.dumps({'chain': chain, 'size': size}))
+        self.since = 0
+
+    def load(self):
+        if CHECKPOINT_INTERVAL <= 0 or not os.path.isfile(self.path):
+            return None
+        with open(self.path) as f:
+            state = json.load(f)
+        if any([state.get(k) != v for k, v in self.key.items()]):
+            return None
+        return state
+
+    def due(self, nbytes):
+        self.since += nbytes
+        return CHECKPOINT_INTERVAL > 0 and self.since >= CHECKPOINT_INTERVAL
+
+    def save(self, offset, rbd_image, done=False):
+        self.since = 0
+        if CHECKPOINT_INTERVAL > 0:
+            snapshots = sorted([snap['id'] for snap in rbd_image.list_snaps()])
+            save_json(self.path, dict(self.key, offset=offset, done=done, snapshots=snapshots))
+
+    def untouched(self, rbd_name, state):
+        if not rbd_image_exists(rbd_name):
+            return False
+        with rbd.Image(get_pool_ioctx(rbd_name), rbd_name, read_only=True) as rbd_image:
+            if sorted([snap['id'] for snap in rbd_image.list_snaps()]) != state.get('snapshots'):
+                return False
+            # Read-only opens don't watch, librbd lists watchers since Nautilus
+            if hasattr(rbd_image, 'watchers_list') and list(rbd_image.watchers_list()):
+                return False
+        return True
+
+def restore_rbd_native(rbd_name, chain):
+    time1 = datetime.now()
+    size, extent_map, sources = plan_restore(chain)
+    ckpt = RestoreCheckpoint(rbd_name, chain, size)
+    state = ckpt.load()
+    try:
+        if state and not ckpt.untouched(rbd_name, state):
+            LOG.warning("%s was used since its restore was interrupted, restoring it again" \
+                    % rbd_name)
+            state = None
+        if state and state['done']:
+            LOG.info("%s is already restored to %s" % (rbd_name, chain[-1][0]))
+            return
+        if state:
+            start = state['offset']
+            LOG.info("Resuming restore of %s at %.2f GB" % (rbd_name, start/1024.0**3))
+        else:
+            start = 0
+            create_restore_target(rbd_name, size)
+        with rbd.Image(get_pool_ioctx(rbd_name), rbd_name) as rbd_img:
+            written = write_extent_map(rbd_img, extent_map, start, ckpt)
+            if str(chain[-1][0]) not in snapshots_list(rbd_img):
+                SNAPSHOTS.create(rbd_img, str(chain[-1][0]))
+            ckpt.save(size, rbd_img, done=True)
+    finally:
+        for source in sources:
+            source.close()
+    elapsed = timedelta(datetime.now(), time1)
+    METRICS.add('restore_bytes', written)
+    LOG.info("Restored %s from %s backup(s): %.2f GB written in %.2f sec" \
+            % (rbd_name, len(chain), written/1024.0**3, elapsed))
+
+def restore_rbd(rbd_name, chain):
+    if RESTORE_ENGINE == 'native':
+        return restore_rbd_native(rbd_name, chain)
+    for n, (date, file) in enumerate(chain):
+        if n == 0:
+            if rbd_image_exists(rbd_name):
+                move_rbd_aside(rbd_name)
+            rbd_import(rbd_name, file)
+            rbd_snap_create(rbd_name, str(date))
+        else:
+            import_diff(rbd_name, file)
+
+def restore_instance_inplace(instance, dest_date):
+    LOG.info("Performing inplace restore of instance %s to date %s" % (instance.name, dest_date))
+    root_rbd_id = str(instance.id + "_disk")
+    volume_ids = [str('volume-' + vol.id) for vol in INVENTORY.server_volumes(instance.id)]
+    return restore_inplace(instance, instance, [root_rbd_id] + volume_ids, dest_date)
+
+def restore_volume_inplace(target, dest_date):
+    LOG.info("Performing inplace restore of volume %s to date %s" % (target.name, dest_date))
+    if not target.server:
+        LOG.info("Volume is detached")
+    return restore_inplace(target, target.server, [target.rbd_name], dest_date)
+
+def restore_inplace(instance, server, rbd_names, dest_date):
+    """
+    Restores images from backups of an instance or a volume. The server
+    using them, if any, is powered off during the restore. If the restore
+    fails and left checkpoints the server stays off, so it doesn't write to
+    half restored images the next restore would continue.
+    """
+    if server:
+        JOB.host = instance_host(server)
+        if instance_is_running(server):
+            LOG.info("Powering off instance.")
+            server.stop()
+            while instance_is_running(server):
+                print('.', end='')
+                sleep(2)
+            print("\nDone")
+        else:
+            LOG.info("Instance is already powered off")
+    backups = get_backups(instance)
+    if dest_date not in backups.keys():
+        LOG.error("Invalid restore date was specified")
+        return 1
+    restored = False
+    try:
+        for rbd_name in rbd_names:
+            chain = restore_files(backups, rbd_name, dest_date)
+            if not chain:
+                LOG.warning("No backups of %s found up to %s" % (rbd_name, dest_date))
+                continue
+            with METRICS.timer('restore'):
+                restore_rbd(rbd_name, chain)
+        # Checkpoints of restored images are kept until all of them succeed
+        for path in glob(os.path.join(backup_folder(instance), '.restore_*.ckpt')):
+            os.remove(path)
+        METRICS.instance(instance.name, id=instance.id, status='ok')
+        restored = True
+    except:
+        METRICS.instance(instance.name, id=instance.id, status='failed')
+        raise
+    finally:
+        if server and not restored and \
+                glob(os.path.join(backup_folder(instance), '.restore_*.ckpt')):
+            LOG.error("Restore failed, instance %s is left powered off: run the restore again "
+                      "before starting it" % server.name)
+        elif server:
+            LOG.info("Starting instance after the restore")
+            server.start()
+    return 0
+
+def verify_worker_init(rate):
+    # Verification runs in the background of backups, at low priority
+    global VERIFY_BUCKET
+    os.nice(VERIFY_NICE)
+    VERIFY_BUCKET = TokenBucket(rate)
+
+def verify_file(task):
+    """
+    Recomputes block checksums of a backup file, or of a range of blocks of
+    a raw one, and compares them with expected sums starting at block first.
+    Raw files are read memory-mapped, skipping holes: blocks recorded as
+    holes are read only if the file has data allocated there, which must be
+    zeros. Returns (path, bytes read, list of bad block numbers or error
+    messages).
+    """
+    path, block_size, first, expected = task
+    bad = []
+    nbytes = 0
+    try:
+        if backup_file_format(path) is None:
+            if expected is None:
+                # Nothing to compare raw files without checksums with
+                return path, nbytes, bad
+            f = open(path, 'rb')
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for n, value in enumerate(expected, first):
+                    start = n*block_size
+                    if value == '-' and not has_data(f.fileno(), start, start + block_size):
+                        continue
+                    block = buffer(m, start, block_size)
+                    VERIFY_BUCKET.consume(len(block))
+                    nbytes += len(block)
+                    if value == '-':
+                        if not is_zero(m[start:start + block_size]):
+                            bad.append(n)
+                    elif '%08x' % (zlib.crc32(block) & 0xffffffff) != value:
+                        bad.append(n)
+            finally:
+                m.close()
+                f.close()
+            return path, nbytes, bad
+        sums = BlockSums(block_size=block_size)
+        for length, data in read_backup_file(path):
+            if data is None:
+                sums.skip(length)
+            else:
+                VERIFY_BUCKET.consume(length)
+                nbytes += length
+                sums.write(data)
+        computed = sums.close()
+        if expected is None:
+            return path, nbytes, bad
+        if len(computed) != len(expected):
+            bad.append("%s blocks instead of %s" % (len(computed), len(expected)))
+        for n, (value, ref) in enumerate(zip(computed, expected)):
+            # Deduplicated backups store zero blocks as holes
+            zero = zero_crc(min(block_size, sums.pos - n*block_size))
+            if value != ref and set([value, ref]) != set(['-', zero]):
+                bad.append(n)
+    except Exception as e:
+        bad.append(str(e))
+    return path, nbytes, bad
+
+def data_ranges(fd, size):
+    # (offset, length) of ranges of sparse file with data allocated, all of
+    # it if the file system can't tell
+    ranges = []
+    pos = 0
+    try:
+        while pos < size:
+            try:
+                start = os.lseek(fd, pos, SEEK_DATA)
+            except OSError as e:
+                if e.errno != errno.ENXIO:
+                    raise
+                # Only a hole after pos
+                break
+            end = min(os.lseek(fd, start, SEEK_HOLE), size)
+            ranges.append((start, end - start))
+            pos = end
+    except OSError:
+        return [(0, size)] if size else []
+    return ranges
+
+def has_data(fd, start, end):
+    # Whether sparse file has blocks allocated between start and end
+    try:
+        return os.lseek(fd, start, SEEK_DATA) < end
+    except OSError as e:
+        return e.errno != errno.ENXIO
+
+def verify_tasks(path):
+    # Splits verification of backup file into tasks for verify_file()
+    sums = read_sums(path)
+    if sums is None:
+        return [(path, SUMS_BLOCK_SIZE, 0, None)]
+    block_size, size, expected = sums
+    if backup_file_format(path) is not None:
+        return [(path, block_size, 0, expected)]
+    if os.path.getsize(path) != size:
+        raise IOError("size is %s instead of %s" % (os.path.getsize(path), size))
+    return [(path, block_size, n, expected[n:n+VERIFY_RANGE])
+                for n in range(0, len(expected), VERIFY_RANGE)]
+
+def compare_with_snapshot(path, rbd_name, date, samples):
+    """
+    Compares randomly sampled chunks of data in backup file with the same
+    places of RBD snapshot it was taken from. Returns number of mismatching
+    chunks or None if the snapshot doesn't exist anymore.
+    """
+    try:
+        rbd_image = rbd.Image(get_pool_ioctx(rbd_name), rbd_name, snapshot=date, read_only=True)
+    except rbd.ImageNotFound:
+        return None
+    source = BackupSource(path)
+    try:
+        if BACKUP_FILE_RE.match(os.path.basename(path)).group(1) == 'full':
+            regions = [(offset, length, offset) for offset, length in source.extents()]
+        else:
+            regions = [record[1:] for record in parse_diff(source) if record[0] == 'w']
+        if not regions:
+            return 0
+        ends = []
+        total = 0
+        for offset, length, position in regions:
+            total += length
+            ends.append(total)
+        bad = 0
+        pool, host = detect_pool(rbd_name), getattr(JOB, 'host', None)
+        for n in range(samples):
+            pick = random.randrange(total)
+            i = bisect.bisect_right(ends, pick)
+            offset, length, position = regions[i]
+            skip = pick - (ends[i] - length)
+            chunk = min(EXPORT_CHUNK_SIZE, length - skip)
+            THROTTLE.consume(chunk, pool, host)
+            if rbd_image.read(offset + skip, chunk) != source.read(position + skip, chunk):
+                bad += 1
+        return bad
+    finally:
+        source.close()
+        rbd_image.close()
+
+def verify_backups(folders=None, samples=0):
+    """
+    Checks backup files of given instance folders (of all backups by default)
+    against their block checksums on a pool of VERIFY_WORKERS processes
+    reading at most VERIFY_BANDWIDTH in total. With samples, backups whose
+    snapshot still exists are also compared with it at that many places.
+    Returns number of damaged files.
+    """
+    time1 = datetime.now()
+    files = CATALOG.list_files(folders)
+    tasks = []
+    bad = {}
+    unsummed = 0
+    for folder, date, name, rbd_name, backup_type in files:
+        path = os.path.join(BACKUPS_TOP_DIR, folder, date, name)
+        try:
+            file_tasks = verify_tasks(path)
+        except (IOError, OSError) as e:
+            bad[path] = [str(e)]
+            continue
+        if file_tasks[0][3] is None:
+            unsummed += 1
+        tasks += file_tasks
+    pool = multiprocessing.Pool(VERIFY_WORKERS, verify_worker_init,
+                                (VERIFY_BANDWIDTH / VERIFY_WORKERS,))
+    nbytes = 0
+    try:
+        for path, read, errors in pool.imap_unordered(verify_file, tasks):
+            nbytes += read
+            if errors:
+                bad.setdefault(path, []).extend(errors)
+    finally:
+        pool.close()
+        pool.join()
+    if samples:
+        for folder, date, name, rbd_name, backup_type in files:
+            path = os.path.join(BACKUPS_TOP_DIR, folder, date, name)
+            if path in bad:
+                continue
+            mismatches = compare_with_snapshot(path, rbd_name, date, samples)
+            if mismatches:
+                bad[path] = ["%s of %s sampled chunks differ from snapshot %s@%s" \
+                                % (mismatches, samples, rbd_name, date)]
+            elif mismatches is not None:
+                LOG.info("%s matches snapshot %s@%s" % (path, rbd_name, date))
+    METRICS.observe('verify', timedelta(datetime.now(), time1))
+    METRICS.add('verify_files', len(files))
+    METRICS.add('verify_bytes', nbytes)
+    METRICS.add('verify_damaged_files', len(bad))
+    for path in sorted(bad):
+        blocks = [str(n) for n in bad[path] if isinstance(n, int)]
+        errors = [e for e in bad[path] if not isinstance(e, int)]
+        if blocks:
+            errors.append("bad blocks " + ", ".join(blocks))
+        LOG.error("Verification of %s failed: %s" % (path, "; ".join(errors)))
+    LOG.info("Verified %s backup files, %.2f GB read in %.2f sec: %s damaged, %s without checksums" \
+            % (len(files), nbytes/1024.0**3, timedelta(datetime.now(), time1), len(bad), unsummed))
+    return len(bad)
+
+def get_backups(instance):
+    return CATALOG.get_backups(os.path.basename(backup_folder(instance)))
+
+def file_sizes(path):
+    """
+    Returns logical and physical (allocated on disk) size of backup file in
+    bytes. They differ for sparse, compressed and deduplicated backups.
+    """
+    if in_object_store(path):
+        # Logical size is recorded in checksums, the object is all stored
+        sums = read_sums(path)
+        return sums[1] if sums else compressed_logical_size(path), S3_STORE.size(path)
+    st = os.stat(path)
+    fmt = backup_file_format(path)
+    if fmt == MANIFEST_SUFFIX:
+        size, stored = manifest_sizes(path)
+        return size, st.st_blocks*512 + stored
+    elif fmt:
+        return compressed_logical_size(path), st.st_blocks*512
+    return st.st_size, st.st_blocks*512
+
+def backup_is_available(instance, date, rbd_name):
+    return CATALOG.has_backup(os.path.basename(backup_folder(instance)), date, rbd_name)
+
+def backup_tree():
+    """
+    Yields (folder, date, status, names of files) of all backups found in
+    directories of BACKUPS_TOP_DIR, or under object prefixes of the bucket.
+    """
+    if S3_STORE:
+        for folder, dates in sorted(S3_STORE.walk().items()):
+            for date, names in sorted(dates.items()):
+                status = None
+                if 'status' in names:
+                    status = S3_STORE.get(S3_STORE.key(os.path.join(BACKUPS_TOP_DIR, folder, date,
+                                                                    'status'))).strip()
+                yield folder, date, status, [name for name in names if name != 'status']
+        return
+    folders = [folder for folder in os.listdir(BACKUPS_TOP_DIR) if not folder.startswith('.')
+                and os.path.isdir(os.path.join(BACKUPS_TOP_DIR, folder))]
+    for folder in folders:
+        folder_dir = os.path.join(BACKUPS_TOP_DIR, folder)
+        for date in os.listdir(folder_dir):
+            date_dir = os.path.join(folder_dir, date)
+            if not os.path.isdir(date_dir):
+                continue
+            status = None
+            if os.path.exists(os.path.join(date_dir, 'status')):
+                with open(os.path.join(date_dir, 'status')) as f:
+                    status = f.read().strip()
+            yield folder, date, status, os.listdir(date_dir)
+
+class BackupCatalog(object):
+    """
+    SQLite index of all backups under BACKUPS_TOP_DIR, so listing backups
+    and resolving backup chains don't need to scan backup directories.
+    Backups are keyed by name of instance backup folder and date, every
+    backup file is recorded with its type, sizes and parent snapshot.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        new = not os.path.exists(path)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS backups ("
+                            "folder TEXT NOT NULL, date TEXT NOT NULL, status TEXT, "
+                            "PRIMARY KEY (folder, date))")
+            self.db.execute("CREATE TABLE IF NOT EXISTS files ("
+                            "folder TEXT NOT NULL, date TEXT NOT NULL, name TEXT NOT NULL, "
+                            "rbd_name TEXT NOT NULL, type TEXT NOT NULL, size INTEGER, "
+                            "used INTEGER, parent TEXT, PRIMARY KEY (folder, date, name))")
+            self.db.execute("CREATE INDEX IF NOT EXISTS files_rbd_name "
+                            "ON files (folder, rbd_name, date)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS changes ("
+                            "folder TEXT NOT NULL, date TEXT NOT NULL, rbd_name TEXT NOT NULL, "
+                            "changed INTEGER, allocated INTEGER, "
+                            "PRIMARY KEY (folder, date, rbd_name))")
+        if new:
+            LOG.info("Backup catalog %s created, indexing existing backups" % path)
+            self.reindex()
+
+    def record(self, folder, date, status, files):
+        """
+        Records result of a backup run: status of the run and list of
+        (date, name, rbd_name, type, size, used, parent) of written files.
+        """
+        with METRICS.timer('catalog'), self.lock, self.db:
+            for file in files:
+                self.db.execute("INSERT OR IGNORE INTO backups VALUES (?, ?, NULL)",
+                                (folder, file[0]))
+                self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                (folder,) + tuple(file))
+            if date:
+                self.db.execute("INSERT OR REPLACE INTO backups VALUES (?, ?, ?)",
+                                (folder, date, str(status)))
+
+    def replace_files(self, folder, date, old_names, files):
+        with METRICS.timer('catalog'), self.lock, self.db:
+            self.db.executemany("DELETE FROM files WHERE folder = ? AND date = ? AND name = ?",
+                                [(folder, date, name) for name in old_names])
+            for file in files:
+                self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                (folder,) + tuple(file))
+
+    def remove(self, folder, date):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM files WHERE folder = ? AND date = ?", (folder, date))
+            self.db.execute("DELETE FROM backups WHERE folder = ? AND date = ?", (folder, date))
+
+    def has_backup(self, folder, date, rbd_name):
+        with self.lock:
+            return self.db.execute("SELECT 1 FROM files WHERE folder = ? AND date = ? "
+                                   "AND rbd_name = ?", (folder, date, rbd_name)).fetchone() is not None
+
+    def record_changes(self, folder, date, changes):
+        # Records measured {rbd_name: (changed, allocated)} bytes of images
+        with self.lock, self.db:
+            for rbd_name, (changed, allocated) in changes.items():
+                self.db.execute("INSERT OR REPLACE INTO changes VALUES (?, ?, ?, ?, ?)",
+                                (folder, date, rbd_name, changed, allocated))
+
+    def change_history(self, folder, limit):
+        # Returns changed bytes of all images of folder for the latest dates
+        with self.lock:
+            rows = self.db.execute("SELECT date, SUM(changed) FROM changes "
+                                   "WHERE folder = ? AND changed IS NOT NULL GROUP BY date "
+                                   "ORDER BY date DESC LIMIT ?", (folder, limit)).fetchall()
+        return [changed for date, changed in rows]
+
+    def list_files(self, folders=None):
+        # Returns (folder, date, name, rbd_name, type) of files of given or all folders
+        with self.lock:
+            rows = self.db.execute("SELECT folder, date, name, rbd_name, type FROM files "
+                                   "ORDER BY folder, date, name").fetchall()
+        return [row for row in rows if folders is None or row[0] in folders]
+
+    def get_backups(self, folder):
+        # Returns dict of backups by date: type, files, sizes and status
+        with METRICS.timer('catalog'), self.lock:
+            dates = self.db.execute("SELECT date, status FROM backups WHERE folder = ?",
+                                    (folder,)).fetchall()
+            files = self.db.execute("SELECT date, name, type, size, used FROM files "
+                                    "WHERE folder = ? ORDER BY date, name", (folder,)).fetchall()
+        backups = {}
+        for date, status in dates:
+            backups[date] = { 'status': STATUS_OK if status == '0' else status or STATUS_ERROR }
+        by_date = {}
+        for date, name, file_type, size, used in files:
+            by_date.setdefault(date, []).append((name, file_type, size, used))
+        for date, date_files in by_date.items():
+            types = set([file_type for name, file_type, size, used in date_files])
+            backup = backups.setdefault(date, { 'status': STATUS_ERROR })
+            if len(types) != 1:
+                continue
+            backup['type'] = types.pop()
+            backup['files'] = [os.path.join(BACKUPS_TOP_DIR, folder, date, name)
+                                for name, file_type, size, used in date_files]
+            backup['size'] = sum([size or 0 for name, file_type, size, used in date_files])
+            backup['used'] = sum([used or 0 for name, file_type, size, used in date_files])
+        for date, backup in backups.items():
+            if 'type' not in backup:
+                # Dates without usable backup files have empty description
+                backups[date] = {}
+        return backups
+
+    def reindex(self):
+        """
+        Rebuilds the catalog from backup files found under BACKUPS_TOP_DIR,
+        or in the bucket if backups are kept in S3.
+        """
+        folders = set()
+        with METRICS.timer('catalog'), self.lock, self.db:
+            self.db.execute("DELETE FROM files")
+            self.db.execute("DELETE FROM backups")
+            for folder, date, status, names in backup_tree():
+                folders.add(folder)
+                date_dir = os.path.join(BACKUPS_TOP_DIR, folder, date)
+                self.db.execute("INSERT INTO backups VALUES (?, ?, ?)", (folder, date, status))
+                for name in names:
+                    match = BACKUP_FILE_RE.match(name)
+                    if not match or not detect_pool(match.group(2)):
+                        continue
+                    path = os.path.join(date_dir, name)
+                    size, used = file_sizes(path)
+                    parent = diff_parent(path) if match.group(1) == 'inc' else None
+                    self.db.execute("INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                    (folder, date, name, match.group(2), match.group(1),
+                                     size, used, parent))
+        LOG.info("Backup catalog rebuilt: %s instance folders indexed" % len(folders))
+
+def p(width, date):
+    w = '{:%s}' % width
+    return w.format(date)
+
+def print_backup_list_header():
+    INSTANCE = p(INSTANCE_LEN, 'INSTANCE')
+    TENANT = p(TENANT_LEN, 'PROJECT')
+    DATE = p(DATE_LEN, 'DATE')
+    TYPE = p(TYPE_LEN, 'TYPE')
+    SIZE = p(SIZE_LEN, 'SIZE(GB)')
+    USED = p(USED_LEN, 'USED(GB)')
+    STATUS = p(STATUS_LEN, 'STATUS')
+    print(d.join(("", INSTANCE, TENANT, DATE, TYPE, SIZE, USED, STATUS, "")))
+
+def display_date(date):
+    date = date.split('-')
+    time = ":".join((date[3], date[4]))
+    date = "-".join((date[2], date[1], date[0]))
+    return " ".join((date, time))
+
+def format_user_date(date):
+    date = date.split(' ')
+    time = date[1].replace(':', '-')
+    date = '-'.join(date[0].split('-')[::-1])
+    return '-'.join((date, time))
+
+def display_backups(instance):
+    def print_line(instance, tenant, date, backup_type, size, used, status):
+        print(d.join(("", p(INSTANCE_LEN, instance), p(TENANT_LEN, tenant), p(DATE_LEN, date), \
+                p(TYPE_LEN, backup_type), p(SIZE_LEN, str(size)), p(USED_LEN, str(used)), \
+                p(STATUS_LEN+9, status), "")))
+    bs = get_backups(instance)
+    tenant = get_tenant_name_by_id(instance.tenant_id, instance.id)
+    if bs:
+        backup_dir = backup_folder(instance)
+        for i, b in enumerate(sorted(bs.keys())):
+            size = round(bs[b].get('size', 0)/1024.0**3, 2)
+            used = round(bs[b].get('used', 0)/1024.0**3, 2)
+            status = bs[b].get('status')
+            status = GREEN + STATUS_OK + END if status == STATUS_OK \
+                    else RED + STATUS_ERROR + END
+            backup_type = bs[b].get('type')
+            if i == 0 and backup_type:
+                print_line(instance.name, tenant, display_date(b), backup_type, size, used, status)
+            elif i == 0 and not backup_type:
+                print_line(instance.name, tenant, display_date(b), '---', '---', '---', status)
+            elif backup_type:
+                print_line("", "", display_date(b), backup_type, size, used, status)
+            elif len(bs)>1 and i!=0:
+                print_line("", "", display_date(b), '---', '---', '---', status)
+            else:
+                print_line(instance.name, tenant, display_date(b), '---', '---', '---', status)
+    else:
+        l = '{:^%s}' % (DATE_LEN + TYPE_LEN + SIZE_LEN + USED_LEN + STATUS_LEN + len(YELLOW) + len(END) + 8)
+        if not isinstance(instance, VolumeTarget) and not instance_in_ceph(instance):
+            print(d.join(("", p(INSTANCE_LEN, instance.name), p(TENANT_LEN, tenant), \
+                    l.format(YELLOW + "-- Nothing to backup --" + END ), "")))
+        else:
+            print(d.join(("", p(INSTANCE_LEN, instance.name), p(TENANT_LEN, tenant), \
+                    l.format(RED + "-- No backups found --" + END ), "")))
+
+def instance_in_ceph(instance):
+    if instance.metadata.get('storage')=='rbd:ceph/vms':
+        return True
+    elif not LIST_BACKUPS:
+        LOG.warning("Instance %s is not stored in Ceph, its root disk will not be backed up (volumes will be)!" \
+                % instance.name)
+        return False
+
+class InventoryRecord(object):
+    """
+    Server or volume loaded from the inventory cache
+    """
+    def __init__(self, manager, info, loaded=True):
+        self._info = info
+        self.__dict__.update(info)
+
+    def to_dict(self):
+        return dict(self._info)
+
+class Inventory(object):
+    """
+    Servers, volumes and projects of all tenants, loaded with a few paginated
+    all_tenants list calls and indexed in memory by ID, name, tenant and
+    attachment. Listings are cached in a JSON file and reused for `ttl` seconds,
+    or regardless of their age with stale_ok.
+    """
+    def __init__(self, path, ttl, refresh=False, stale_ok=False):
+        self.path = path
+        self.ttl = ttl
+        self.stale_ok = stale_ok
+        data = None if refresh else self.load_cache()
+        if data is None:
+            self.time = datetime.now()
+            data = self.fetch()
+            self.save_cache(data)
+        self.build(data)
+
+    def load_cache(self):
+        if self.ttl <= 0 or not os.path.isfile(self.path):
+            return None
+        mtime = datetime.fromtimestamp(os.path.getmtime(self.path))
+        if timedelta(datetime.now(), mtime) > self.ttl and not self.stale_ok:
+            return None
+        self.time = mtime
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except ValueError:
+            LOG.warning("Inventory cache %s is corrupted, ignoring it" % self.path)
+
+    def save_cache(self, data):
+        if self.ttl <= 0:
+            return
+        tmp = self.path + '.tmp'
+        with os.fdopen(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+            json.dump(data, f)
+        os.rename(tmp, self.path)
+
+    @staticmethod
+    def list_all(manager):
+        res = []
+        marker = None
+        while True:
+            page = manager.list(search_opts={'all_tenants': True}, marker=marker,
+                                limit=INVENTORY_PAGE_SIZE)
+            # Pages are capped by osapi_max_limit of the API, which may be below
+            # the limit asked for, so only an empty page ends the listing
+            if not page or page[-1].id == marker:
+                return res
+            res.extend(page)
+            marker = page[-1].id
+
+    def fetch(self):
+        time1 = datetime.now()
+        with METRICS.timer('inventory'):
+            data = {'servers': [server.to_dict() for server in self.list_all(CLOUD.nova.servers)],
+                    'volumes': [volume.to_dict() for volume in self.list_all(CLOUD.cinder.volumes)],
+                    'projects': [{'id': project.id, 'name': project.name} \
+                                 for project in CLOUD.keystone.projects.list()]}
+        LOG.info("Loaded inventory of %s servers, %s volumes and %s projects in %s sec" \
+                 % (len(data['servers']), len(data['volumes']), len(data['projects']),
+                    timedelta(datetime.now(), time1)))
+        return data
+
+    def build(self, data):
+        def index(objects, key):
+            res = {}
+            for obj in objects:
+                res.setdefault(key(obj), []).append(obj)
+            return res
+        # Cached listings don't load the API clients, their records have no API methods
+        if CLOUD.clients:
+            server_class, server_manager = CLOUD.nova.servers.resource_class, CLOUD.nova.servers
+            volume_class, volume_manager = CLOUD.cinder.volumes.resource_class, CLOUD.cinder.volumes
+        else:
+            server_class = volume_class = InventoryRecord
+            server_manager = volume_manager = None
+        servers = [server_class(server_manager, info, loaded=True) for info in data['servers']]
+        volumes = [volume_class(volume_manager, info, loaded=True) for info in data['volumes']]
+        self.server_by_id = dict((server.id, server) for server in servers)
+        self.servers_by_name = index(servers, lambda server: server.name)
+        self.servers_by_tenant = index(servers, lambda server: server.tenant_id)
+        self.volume_by_id = dict((volume.id, volume) for volume in volumes)
+        self.volumes_by_name = index(volumes, lambda volume: volume.name)
+        self.volumes_by_tenant = index(volumes, lambda volume: getattr(volume, 'os-vol-tenant-attr:tenant_id', None))
+        self.volumes_by_server = {}
+        for volume in volumes:
+            for attachment in volume.attachments:
+                self.volumes_by_server.setdefault(attachment['server_id'], []).append((attachment.get('device'), volume))
+        for server_id, attached in self.volumes_by_server.items():
+            self.volumes_by_server[server_id] = [volume for device, volume in sorted(attached)]
+        self.tenant_ids = dict((project['name'], project['id']) for project in data['projects'])
+        self.tenant_names = dict((project['id'], project['name']) for project in data['projects'])
+
+    def server_volumes(self, server_id):
+        return self.volumes_by_server.get(server_id, [])
+
+def get_instance_list(instance_list=None, tenant_list=None):
+    res = []
+    if instance_list:
+        for instance_name in instance_list.split(','):
+            instance_name = instance_name.strip()
+            if looks_like_uuid(instance_name) and instance_name in INVENTORY.server_by_id:
+                res.append(INVENTORY.server_by_id[instance_name])
+            elif instance_name in INVENTORY.servers_by_name:
+                res.extend(INVENTORY.servers_by_name[instance_name])
+            else:
+                LOG.warning("Cannot find instance with name or ID %s" % instance_name)
+    if tenant_list:
+        for tenant_id in get_tenant_id_list(tenant_list):
+            instances = INVENTORY.servers_by_tenant.get(tenant_id)
+            if not instances:
+                LOG.warning("No instances found in tenant %s" % tenant_id)
             else:
                 res.extend(instances)
     return res
@@ -669,42 +4090,32 @@ def get_volume_list(volume_list=None, tenant_list=None, instance_list=None):
     if volume_list:
         for volume_name in volume_list.split(','):
             volume_name = volume_name.strip()
-            volume = volumes = None
-            if looks_like_uuid(volume_name):
-                volume = cinder.volumes.get(volume_name)
-                if not volume:
-                    LOG.warning("Cannot find volume with ID %s" % volume_name)
-                elif volume_name in (volume.name, volume.id):
-                    res.append(volume)
+            if looks_like_uuid(volume_name) and volume_name in INVENTORY.volume_by_id:
+                res.append(INVENTORY.volume_by_id[volume_name])
+            elif volume_name in INVENTORY.volumes_by_name:
+                res.extend(INVENTORY.volumes_by_name[volume_name])
             else:
-                volumes = cinder.volumes.list( search_opts={'name': volume_name, 'all_tenants': True} )
-                volumes = [vol for vol in volumes if vol.name == volume_name]
-                if not volumes:
-                    LOG.warning("Cannot find volume with name %s" % volume_name)
-                else:
-                    res.extend(volumes)
+                LOG.warning("Cannot find volume with name or ID %s" % volume_name)
     if tenant_list:
         for tenant_id in get_tenant_id_list(tenant_list):
-            volumes = cinder.volumes.list( search_opts={'project_id': tenant_id, 'all_tenants': True} )
+            volumes = INVENTORY.volumes_by_tenant.get(tenant_id)
             if not volumes:
                 LOG.warning("No volumes found in tenant %s" % tenant_id)
             else:
                 res.extend(volumes)
     # Don't include volumes that are already attached to target instances
-    instance_id_list = [instance.id for instance in instance_list]
-    res1 = [vol for vol in res if vol.attachments and vol.attachments[0]['server_id'] in instance_id_list]
-    res = [vol for vol in res if vol not in res1]
+    instance_id_list = set(instance.id for instance in instance_list)
+    res = [vol for vol in res if not (vol.attachments and vol.attachments[0]['server_id'] in instance_id_list)]
     return res
 
 def get_tenant_id_list(tenant_list):
     tenant_ids = []
     for tenant_name in tenant_list.split(','):
         tenant_name = tenant_name.strip()
-        instances = tenant_id = None
-        if looks_like_uuid(tenant_name):
-            tenant_id = keystone.projects.get(tenant_name).id
+        if looks_like_uuid(tenant_name) and tenant_name in INVENTORY.tenant_names:
+            tenant_id = tenant_name
         else:
-            tenant_id = all_tenants[tenant_name]
+            tenant_id = INVENTORY.tenant_ids.get(tenant_name)
         if not tenant_id:
             LOG.warning("Cannot find tenant with name or ID %s" % tenant_name)
         else:
@@ -712,9 +4123,9 @@ def get_tenant_id_list(tenant_list):
     return tenant_ids
 
 def get_tenant_name_by_id(tenant_id, instance_id):
-    tenants = [k for k,v in all_tenants.iteritems() if v==tenant_id]
-    if tenants:
-        return tenants[0]
+    tenant = INVENTORY.tenant_names.get(tenant_id)
+    if tenant:
+        return tenant
     else:
         LOG.warning("No tenant with ID %s found for instance ID %s" \
                         % (tenant_id, instance_id))
@@ -756,30 +4167,520 @@ def get_backup_targets(config):
     res['volumes'] = remove_duplicates(res5)
     return res
 
-def volume_backup(volume, full_backup=True):
-    #TODO Not implemented yet!
-    rbd_id = str('volume-' + volume.id)
-    rbd_image = rbd.Image(VOLUMES_POOL_IOCTX, rbd_id)
-    if volume.attachments:
-        host = virsh_name = libvirt_conn = dom = None
-        server_id = volume.attachments[0]['server_id']
-        instance = nova.servers.get(server_id)
-        if instance_is_running(instance):
-            host = getattr(instance, 'OS-EXT-SRV-ATTR:hypervisor_hostname')
-            virsh_name = getattr(instance, 'OS-EXT-SRV-ATTR:instance_name')
-            libvirt_conn=libvirt.open(LIBVIRT_URI % host)
-            dom = libvirt_conn.lookupByName(virsh_name)
-            take_rbd_snapshots(dom, [rbd_image], 'volume %s/%s' % \
-                                (detect_pool(rbd_image.name), rbd_image.name))
+class VolumeTarget(object):
+    """
+    Cinder volume backed up on its own, into a folder of its own like an
+    instance. Attached volumes keep the server they are attached to.
+    """
+    def __init__(self, volume):
+        self.volume = volume
+        self.id = volume.id
+        self.name = volume.name or volume.id
+        self.tenant_id = getattr(volume, 'os-vol-tenant-attr:tenant_id', None)
+        self.rbd_name = str('volume-' + volume.id)
+        server_id = volume.attachments[0]['server_id'] if volume.attachments else None
+        self.server = INVENTORY.server_by_id.get(server_id) if server_id else None
+        # Backup chosen for the volume when it was snapshotted
+        self.snap_time = None
+        self.snap = None
+        self.unfinished = None
+        self.full_backup = False
+        self.synth = False
+
+def target_kind(instance):
+    return 'volume' if isinstance(instance, VolumeTarget) else 'instance'
+
+def get_volume_targets(volumes):
+    return [VolumeTarget(volume) for volume in remove_duplicates(volumes)]
+
+def snapshot_volume_group(group, full_backup=False, auto=False):
+    """
+    Chooses the backup of each volume of a group and snapshots the volumes
+    together: volumes attached to a running server with a single freeze
+    of the guest, others without any libvirt work.
+    """
+    server, targets = group
+    label = "volumes of %s" % server.name if server else targets[0].name
+    rbd_list = [rbd.Image(get_pool_ioctx(target.rbd_name), target.rbd_name) for target in targets]
+    try:
+        to_snapshot = []
+        for target, rbd_image in zip(targets, rbd_list):
+            if auto:
+                full, target.synth = apply_backup_policy(target, [rbd_image])
+            else:
+                full = full_backup
+            target.unfinished, target.full_backup = plan_backup(target, [rbd_image], full)
+            if not target.unfinished:
+                to_snapshot.append(rbd_image)
+        if not to_snapshot:
+            return
+        if server and instance_is_running(server):
+            host = instance_host(server)
+            virsh_name = getattr(server, 'OS-EXT-SRV-ATTR:instance_name')
+            with SCHEDULER.host_slot(host), LIBVIRT_CONNS.use(host) as libvirt_conn:
+                dom = libvirt_conn.lookupByName(virsh_name)
+                take_rbd_snapshots(dom, to_snapshot, label)
+        else:
+            take_rbd_snapshots(None, to_snapshot, label)
+        for target, rbd_image in zip(targets, rbd_list):
+            snaps = snapshots_list(rbd_image)
+            target.snap = snaps[-1] if snaps else None
+    finally:
+        for rbd_image in rbd_list:
+            rbd_image.close()
+
+def volume_backup_job(target):
+    # Snapshot names sort by time, one older than the run means snapshotting failed
+    if not target.unfinished and (not target.snap or target.snap < target.snap_time):
+        LOG.error("No snapshot of volume %s taken since %s, backup is not possible" \
+                  % (target.name, target.snap_time))
+        return 1, 0
+    rbd_image = rbd.Image(get_pool_ioctx(target.rbd_name), target.rbd_name)
+    try:
+        res, exported = export_diff(target, [rbd_image], full_backup=target.full_backup,
+                                    resume=bool(target.unfinished))
+    finally:
+        rbd_image.close()
+    if target.synth and res == 0:
+        res = synthesize_full(target)[0] or 0
+    return res, exported
+
+def group_volumes(targets):
+    # Returns (server, volumes) of volumes attached to the same server, or
+    # (None, [volume]) for every detached volume
+    groups = {}
+    for target in targets:
+        key = target.server.id if target.server else target.id
+        groups.setdefault(key, (target.server, []))[1].append(target)
+    return [groups[key] for key in sorted(groups)]
 
-def its_show_time(config):
+def backup_volumes(targets, full_backup=False, auto=False):
+    """
+    Backs up standalone volumes in two passes. Volumes attached to the same
+    server are snapshotted as one group, each detached volume on its own,
+    groups in parallel. Exports then run in parallel across all volumes,
+    limited per Ceph pool by the scheduler.
+    """
+    snap_time = current_time()
+    for target in targets:
+        target.snap_time = snap_time
+    groups = group_volumes(targets)
+    def snapshot_group(group):
+        threading.current_thread().name = group[1][0].name
+        try:
+            snapshot_volume_group(group, full_backup=full_backup, auto=auto)
+        except Exception as msg:
+            LOG.exception("Snapshots of %s failed: %s" % (", ".join(t.name for t in group[1]), msg))
+    time1 = datetime.now()
+    pool = ThreadPool(max(1, min(SCHEDULER.workers, len(groups))))
+    try:
+        pool.map(snapshot_group, groups, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    LOG.info("Snapshots of %s volumes in %s groups taken in %.2f sec" \
+             % (len(targets), len(groups), timedelta(datetime.now(), time1)))
+    return SCHEDULER.run(volume_backup_job, targets)
+
+def parse_schedule(config):
+    """
+    Returns (weekday, full_time, inc_time, window) of the schedule section:
+    ISO weekday of full backups, (hour, minute) of full and incremental
+    backups and seconds to spread backups of a run over.
+    """
     sched_full = config.get('schedule', 'full')
     sched_inc = config.get('schedule', 'incremental')
     week = { 'mon': 1, 'tue': 2, 'wed': 3, 'thu': 4, 'fri': 5, 'sat': 6, 'sun': 7 }
     full_backup_weekday, full_backup_time = [s.strip().lower() for s in sched_full.split(',')]
     inc_backup_time = sched_inc.strip().lower()
-    #if datetime.now() 
-    #if week[full_backup_weekday] == datetime.now().isoweekday():
+    def hour_minute(value):
+        hour, minute = value.split(':')
+        return int(hour), int(minute)
+    window = float(config.get('schedule', 'window')) if config.has_option('schedule', 'window') \
+             else 3600
+    return week[full_backup_weekday], hour_minute(full_backup_time), \
+           hour_minute(inc_backup_time), window
+
+def next_backup_run(schedule, now):
+    # Returns time and type of the first scheduled backup after now: full
+    # on the day of full backups, incremental on other days
+    weekday, full_time, inc_time, window = schedule
+    for days in range(8):
+        day = datetime.fromordinal(now.toordinal() + days)
+        backup_type, (hour, minute) = ('full', full_time) if day.isoweekday() == weekday \
+                                      else ('inc', inc_time)
+        run_time = day.replace(hour=hour, minute=minute)
+        if run_time > now:
+            return run_time, backup_type
+
+def normalize_restore_date(date):
+    # Returns restore date given in TIME_FORMAT or USER_TIME_FORMAT in TIME_FORMAT
+    if looks_like_date(date):
+        return date
+    if looks_like_date(date, time_format=USER_TIME_FORMAT):
+        return format_user_date(date)
+
+def prune_old_images():
+    # Removes images moved aside by restores with all their snapshots
+    rbd_inst = rbd.RBD()
+    old_images = [image for image in rbd_inst.list(CLOUD.ioctx(VMS_POOL)) + \
+                    rbd_inst.list(CLOUD.ioctx(VOLUMES_POOL)) if image.endswith('.bak')]
+    for image in old_images:
+        PRUNER.prune(image, remove_image=True)
+
+class DaemonJob(object):
+    """
+    Backup of an instance, backup of volumes attached to one server (or of
+    a detached volume), or restore, queued in the daemon. Jobs sharing an
+    instance or a volume never run at the same time.
+    """
+    def __init__(self, kind, targets, priority, not_before=None, **params):
+        self.id = None
+        self.kind = kind
+        self.targets = targets
+        self.priority = priority
+        self.not_before = not_before or datetime.now()
+        self.params = params
+        self.status = 'queued'
+        self.started = self.finished = None
+        self.keys = set()
+        for target in targets:
+            self.keys.add(target.id)
+            if isinstance(target, VolumeTarget):
+                if target.server:
+                    self.keys.add(target.server.id)
+            else:
+                self.keys.update([volume.id for volume in INVENTORY.server_volumes(target.id)])
+
+    def run(self):
+        # Returns number of failed targets
+        backup_type = self.params.get('backup_type')
+        if self.kind == 'restore':
+            target = self.targets[0]
+            threading.current_thread().name = target.name
+            if isinstance(target, VolumeTarget):
+                return restore_volume_inplace(target, self.params['date'])
+            return restore_instance_inplace(target, self.params['date'])
+        if self.kind == 'backup':
+            func = lambda instance: backup_instance_job(instance, full_backup=backup_type=='full',
+                                                        auto=backup_type=='auto',
+                                                        with_root=self.params.get('with_root'))
+        else:
+            snap_time = current_time()
+            for target in self.targets:
+                target.snap_time = snap_time
+            threading.current_thread().name = self.targets[0].name
+            snapshot_volume_group((self.targets[0].server, self.targets),
+                                  full_backup=backup_type=='full', auto=backup_type=='auto')
+            func = volume_backup_job
+        return len([res for target, res, exported, elapsed in \
+                    [SCHEDULER.run_job((func, target)) for target in self.targets] if res])
+
+    def describe(self):
+        times = [('not_before', self.not_before), ('started', self.started),
+                 ('finished', self.finished)]
+        res = dict([(name, value.strftime('%Y-%m-%d %H:%M:%S')) for name, value in times if value])
+        res.update(id=self.id, kind=self.kind, priority=self.priority, status=self.status,
+                   targets=[target.name for target in self.targets])
+        res.update(self.params)
+        return res
+
+class BackupDaemon(object):
+    """
+    Keeps Ceph, OpenStack and libvirt connections and the inventory between
+    runs. Backups are started on the configured schedule, targets of a run
+    are spread over the schedule window. Backups and restores may be queued
+    anytime over a Unix socket, one JSON request per connection. Jobs run
+    on a pool of workers, most urgent (lowest priority) first.
+    """
+    def __init__(self, config_files, socket_path, workers):
+        self.config_files = config_files
+        self.socket_path = socket_path
+        self.workers = workers
+        self.cond = threading.Condition()
+        self.inventory_lock = threading.Lock()
+        self.queue = []
+        self.running = []
+        self.finished = deque(maxlen=100)
+        self.busy = set()
+        self.last_id = 0
+        self.kinds = set()
+        self.stopping = False
+        self.reload_requested = False
+        self.next_run = None
+
+    def read_config(self):
+        config = ConfigParser.ConfigParser()
+        config.read(self.config_files)
+        return config
+
+    def refresh_inventory(self, force=False):
+        global INVENTORY
+        with self.inventory_lock:
+            if force or timedelta(datetime.now(), INVENTORY.time) > INVENTORY_CACHE_TTL:
+                INVENTORY = Inventory(INVENTORY_CACHE, INVENTORY_CACHE_TTL, refresh=True)
+
+    def submit(self, jobs):
+        with self.cond:
+            for job in jobs:
+                self.last_id += 1
+                job.id = self.last_id
+                self.queue.append(job)
+            self.cond.notify_all()
+        return [job.id for job in jobs]
+
+    def _next_job(self):
+        # Waits for the most urgent job which is due and not blocked by
+        # running jobs, returns None when the daemon stops
+        with self.cond:
+            while not self.stopping:
+                now = datetime.now()
+                ready = [job for job in self.queue \
+                         if job.not_before <= now and not job.keys & self.busy]
+                if ready:
+                    job = min(ready, key=lambda job: (job.priority, job.not_before, job.id))
+                    self.queue.remove(job)
+                    self.running.append(job)
+                    self.busy |= job.keys
+                    return job
+                due = [timedelta(job.not_before, now) for job in self.queue if job.not_before > now]
+                self.cond.wait(min(due + [60]))
+
+    def worker(self):
+        while True:
+            job = self._next_job()
+            if job is None:
+                return
+            job.status = 'running'
+            job.started = datetime.now()
+            try:
+                job.status = 'failed' if job.run() else 'ok'
+            except Exception as msg:
+                LOG.exception("Job %s (%s of %s) failed: %s" \
+                              % (job.id, job.kind, ", ".join([t.name for t in job.targets]), msg))
+                job.status = 'failed'
+            job.finished = datetime.now()
+            if job.kind == 'restore':
+                prune_old_images()
+            with self.cond:
+                self.running.remove(job)
+                self.busy -= job.keys
+                self.finished.append(job)
+                self.kinds.add(job.kind)
+                idle = not self.queue and not self.running
+                self.cond.notify_all()
+            if idle:
+                self.finish_run()
+
+    def finish_run(self):
+        # Writes metrics and counters of jobs done since the daemon was idle
+        PRUNER.wait()
+        if PRUNER.time1:
+            LOG.info(PRUNER.summary())
+        PRUNER.reset()
+        with self.cond:
+            kinds, self.kinds = self.kinds, set()
+        METRICS.mode = 'restore' if kinds == set(['restore']) else 'backup' if kinds else None
+        if METRICS.mode:
+            METRICS.write(METRICS_TEXTFILE_DIR, METRICS_JSONL)
+        METRICS.reset()
+
+    def schedule_backups(self, backup_type, window):
+        """
+        Queues backups of all configured targets. Targets are interleaved by
+        hypervisor host and given evenly spaced start times over the window,
+        each with random jitter within its share of the window.
+        """
+        config = self.read_config()
+        self.refresh_inventory(force=True)
+        targets = get_backup_targets(config)
+        with_root = set([instance.id for instance in targets['with_root_disk']])
+        instances = SCHEDULER.order_by_host(remove_duplicates(targets['with_root_disk'] + \
+                                                              targets['without_root_disk']))
+        volumes = get_volume_targets(targets['volumes'])
+        SNAPSHOTS.clear()
+        if instances or volumes:
+            SNAPSHOTS.load_pool(CLOUD.ioctx(VMS_POOL))
+            SNAPSHOTS.load_pool(CLOUD.ioctx(VOLUMES_POOL))
+        jobs = [DaemonJob('backup', [instance], PRIORITY_SCHEDULED, backup_type=backup_type,
+                          with_root=instance.id in with_root) for instance in instances] + \
+               [DaemonJob('volumes', group, PRIORITY_SCHEDULED, backup_type=backup_type)
+                for server, group in group_volumes(volumes)]
+        with self.cond:
+            # Backups of the previous run still waiting are not queued twice
+            pending = set()
+            for job in self.queue:
+                if job.kind != 'restore':
+                    pending |= job.keys
+        skipped = [job for job in jobs if job.keys & pending]
+        jobs = [job for job in jobs if not job.keys & pending]
+        start = datetime.now()
+        for i, job in enumerate(jobs):
+            offset = (i + random.random()) * window / len(jobs)
+            job.not_before = datetime.fromtimestamp(mktime(start.timetuple()) + offset)
+        self.submit(jobs)
+        LOG.info("Queued %s backup of %s targets over %.0f sec" % (backup_type, len(jobs), window))
+        if skipped:
+            LOG.warning("Backups of %s still queued from the previous run: %s" \
+                        % (len(skipped), ", ".join([job.targets[0].name for job in skipped])))
+
+    def resolve(self, request):
+        instances = []
+        volumes = []
+        for name in request.get('instances') or []:
+            found = get_instance_list(instance_list=name)
+            if not found:
+                raise ValueError("Cannot find instance with name or ID %s" % name)
+            instances.extend(found)
+        for name in request.get('volumes') or []:
+            found = get_volume_list(volume_list=name, instance_list=[])
+            if not found:
+                raise ValueError("Cannot find volume with name or ID %s" % name)
+            volumes.extend(found)
+        return remove_duplicates(instances), get_volume_targets(volumes)
+
+    def handle(self, request):
+        # Returns reply to a request of the control socket
+        command = request.get('command')
+        if command == 'status':
+            return {'ok': True, 'status': self.status()}
+        if command not in ('backup', 'restore'):
+            raise ValueError("Unknown command %s" % command)
+        self.refresh_inventory(force=command == 'restore')
+        instances, volumes = self.resolve(request)
+        priority = request.get('priority')
+        if command == 'backup':
+            backup_type = request.get('type')
+            if backup_type not in ('full', 'inc', 'auto'):
+                raise ValueError("Unknown backup type %s" % backup_type)
+            if priority is None:
+                priority = PRIORITY_ADHOC
+            jobs = [DaemonJob('backup', [instance], priority, backup_type=backup_type,
+                              with_root=bool(request.get('with_root_disks')) and \
+                                        instance_in_ceph(instance))
+                    for instance in instances] + \
+                   [DaemonJob('volumes', group, priority, backup_type=backup_type)
+                    for server, group in group_volumes(volumes)]
+        else:
+            date = normalize_restore_date(request.get('date') or '')
+            if not date:
+                raise ValueError("Restore date doesn't match date format: %s or %s" \
+                                 % (TIME_FORMAT, USER_TIME_FORMAT))
+            if len(instances) + len(volumes) != 1:
+                raise ValueError("You may specify only a single instance or volume to restore")
+            if priority is None:
+                priority = PRIORITY_RESTORE
+            jobs = [DaemonJob('restore', instances + volumes, priority, date=date)]
+        if not jobs:
+            raise ValueError("No instances or volumes given")
+        ids = self.submit(jobs)
+        LOG.info("Queued %s of %s as job(s) %s" % (command, ", ".join([target.name \
+                 for job in jobs for target in job.targets]), ", ".join(map(str, ids))))
+        return {'ok': True, 'jobs': ids}
+
+    def status(self):
+        with self.cond:
+            res = {'queued': [job.describe() for job in sorted(self.queue,
+                              key=lambda job: (job.priority, job.not_before, job.id))],
+                   'running': [job.describe() for job in self.running],
+                   'finished': [job.describe() for job in self.finished]}
+        if self.next_run:
+            res['next_run'] = self.next_run[0].strftime('%Y-%m-%d %H:%M:%S')
+            res['next_run_type'] = self.next_run[1]
+        return res
+
+    def serve_control(self):
+        # Serves requests of the control socket in a daemon thread
+        daemon = self
+        class Handler(SocketServer.StreamRequestHandler):
+            def handle(self):
+                try:
+                    reply = daemon.handle(json.loads(self.rfile.readline()))
+                except Exception as msg:
+                    reply = {'ok': False, 'error': str(msg)}
+                self.wfile.write(json.dumps(reply) + '\n')
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        # Restores replace images, only the owner may connect
+        umask = os.umask(0o177)
+        try:
+            server = SocketServer.ThreadingUnixStreamServer(self.socket_path, Handler)
+        finally:
+            os.umask(umask)
+        server.daemon_threads = True
+        thread = threading.Thread(target=server.serve_forever, name='control')
+        thread.daemon = True
+        thread.start()
+        return server
+
+    def stop(self, *args):
+        self.stopping = True
+
+    def request_reload(self, *args):
+        # SIGHUP reloads limits of throttling and the schedule
+        THROTTLE.request_reload()
+        self.reload_requested = True
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGHUP, self.request_reload)
+        threads = [threading.Thread(target=self.worker, name='worker-%s' % i)
+                   for i in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        server = self.serve_control()
+        LOG.info("Daemon started with %s workers, control socket %s" \
+                 % (self.workers, self.socket_path))
+        schedule = None
+        while not self.stopping:
+            if schedule is None or self.reload_requested:
+                self.reload_requested = False
+                schedule = parse_schedule(self.read_config())
+                self.next_run = next_backup_run(schedule, datetime.now())
+                LOG.info("Next %s backup at %s" % (self.next_run[1], self.next_run[0]))
+            if datetime.now() >= self.next_run[0]:
+                try:
+                    self.schedule_backups(self.next_run[1], schedule[3])
+                except Exception as msg:
+                    LOG.exception("Scheduling %s backup failed: %s" % (self.next_run[1], msg))
+                schedule = None
+                continue
+            sleep(1)
+        LOG.info("Daemon stopping, waiting for %s running jobs" % len(self.running))
+        server.shutdown()
+        server.server_close()
+        os.remove(self.socket_path)
+        with self.cond:
+            dropped = len(self.queue)
+            self.cond.notify_all()
+        while [thread for thread in threads if thread.is_alive()]:
+            sleep(1)
+        if dropped:
+            LOG.warning("Dropped %s queued jobs" % dropped)
+        self.finish_run()
+
+def send_to_daemon(socket_path, request):
+    # Sends request to the control socket of the daemon, returns its reply
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+        sock.sendall(json.dumps(request) + '\n')
+        return json.loads(sock.makefile().readline())
+    finally:
+        sock.close()
+
+def print_daemon_status(status):
+    if status.get('next_run'):
+        print("Next %s backup at %s" % (status['next_run_type'], status['next_run']))
+    for state in ('running', 'queued', 'finished'):
+        print("%s jobs: %s" % (state.capitalize(), len(status[state])))
+        for job in status[state]:
+            print("  %5s  %-8s %-7s prio %-3s %-19s %s" \
+                  % (job['id'], job['kind'], job.get('backup_type') or job.get('date', ''),
+                     job['priority'], job.get('finished') or job.get('started') or \
+                     job['not_before'], ", ".join(job['targets'])) + \
+                  (" " + job['status'] if state == 'finished' else ""))
 
 def exception_handler(type, value, tb):
     LOG.exception("".join(traceback.format_exception(type, value, tb)))
@@ -802,21 +4703,83 @@ SSH_USER            = defaults['ssh_user']
 SSH_KEY             = defaults['ssh_key']
 LOG_FILE            = defaults['log_file']
 BACKUP_RETENTION_WEEKS = int(defaults['backup_retention_weeks'])
-ceph_cluster = rados.Rados(conffile='/etc/ceph/ceph.conf')
-ceph_cluster.connect()
-VMS_POOL_IOCTX = ceph_cluster.open_ioctx(VMS_POOL)
-VOLUMES_POOL_IOCTX = ceph_cluster.open_ioctx(VOLUMES_POOL)
-
-
-# Get Keystone, Nova and Cinder sessions
-session, keystone = get_keystone_session()
-nova = novaclient.Client(2, session=session)
-cinder = cinderclient.Client(session=session)
-all_tenants = dict([(tenant.name, tenant.id) for tenant in keystone.projects.list()])
+# Pruning needs two full backups within 7*(weeks+1) backups
+POLICY_MAX_CHAIN    = max(1, 7*(BACKUP_RETENTION_WEEKS+1)//2 - 1)
+BACKUP_WORKERS      = int(defaults.get('backup_workers', 4))
+BACKUP_WORKERS_PER_HOST = int(defaults.get('backup_workers_per_host', 2))
+BACKUP_WORKERS_PER_POOL = int(defaults.get('backup_workers_per_pool', 4))
+PRUNE_WORKERS = int(defaults.get('prune_workers', 16))
+PRUNE_WORKERS_PER_POOL = int(defaults.get('prune_workers_per_pool', 8))
+EXPORT_ENGINE       = defaults.get('export_engine', 'native')
+if EXPORT_ENGINE not in ('native', 'rbd'):
+    sys.exit("Unknown export_engine %s, choose from: native, rbd" % EXPORT_ENGINE)
+COMPRESSION         = defaults.get('compression', 'none')
+if COMPRESSION != 'none' and not codec_available(COMPRESSION):
+    sys.exit("Compression codec %s is unknown or its module is not installed" % COMPRESSION)
+COMPRESSION_SUFFIX  = '' if COMPRESSION == 'none' else '.' + COMPRESSION
+COMPRESSION_LEVEL   = int(defaults['compression_level']) if 'compression_level' in defaults else None
+COMPRESSION_WORKERS = int(defaults.get('compression_workers', multiprocessing.cpu_count()))
+COMPRESS_POOL       = None
+COMPRESS_POOL_LOCK  = threading.Lock()
+DEDUP               = defaults.get('dedup', 'no').lower() in ('yes', 'true', '1')
+DEDUP_BLOCK_SIZE    = int(defaults.get('dedup_block_size', 4*1024**2))
+CHUNK_STORE_DIR     = defaults.get('chunk_store_dir', os.path.join(BACKUPS_TOP_DIR, '.chunks'))
+CHUNK_STORE         = ChunkStore(CHUNK_STORE_DIR) if DEDUP or os.path.isdir(CHUNK_STORE_DIR) else None
+# Chunks of deduplicated backups are compressed themselves
+BACKUP_FILE_SUFFIX  = '.' + MANIFEST_SUFFIX if DEDUP else COMPRESSION_SUFFIX
+# Bytes between checkpoints of exports and restores, 0 disables resuming
+CHECKPOINT_INTERVAL = int(defaults.get('checkpoint_interval', 1024**3))
+VERIFY_WORKERS      = int(defaults.get('verify_workers', max(1, multiprocessing.cpu_count()//2)))
+# Total read bandwidth of verification in MB/s, 0 means unlimited
+VERIFY_BANDWIDTH    = float(defaults.get('verify_bandwidth', 0))*1024**2
+VERIFY_NICE         = int(defaults.get('verify_nice', 10))
+RESTORE_ENGINE      = defaults.get('restore_engine', 'native')
+if RESTORE_ENGINE not in ('native', 'rbd'):
+    sys.exit("Unknown restore_engine %s, choose from: native, rbd" % RESTORE_ENGINE)
+MAX_FREEZE_SECONDS  = float(defaults.get('max_freeze_seconds', 10))
+SNAPSHOT_TIMEOUT    = float(defaults.get('snapshot_timeout', 60))
+INVENTORY_CACHE     = defaults.get('inventory_cache', os.path.join(BACKUPS_TOP_DIR, 'inventory.json'))
+INVENTORY_CACHE_TTL = float(defaults.get('inventory_cache_ttl', 300))
+INVENTORY_PAGE_SIZE = int(defaults.get('inventory_page_size', 1000))
+HOST_CONN_USERS     = int(defaults.get('host_connection_users', 8))
+HOST_CONN_IDLE      = float(defaults.get('host_connection_idle_timeout', 300))
+LIBVIRT_CONNS       = HostConnections('libvirt', lambda host: libvirt.open(LIBVIRT_URI % host),
+                                      lambda conn: conn.isAlive(), HOST_CONN_USERS, HOST_CONN_IDLE)
+SSH_CONNS           = HostConnections('SSH', ssh_connect, ssh_is_alive, HOST_CONN_USERS, HOST_CONN_IDLE)
+POLICY_RESTORE_WEIGHT = float(defaults.get('policy_restore_weight', 0.1))
+POLICY_LOCAL_WEIGHT = float(defaults.get('policy_local_weight', 0.25))
+POLICY_HISTORY      = int(defaults.get('policy_history', 14))
+THROTTLE_CONTROL    = defaults.get('throttle_control_file')
+# Context of the job running in current thread
+JOB                 = threading.local()
+METRICS             = Metrics()
+# Directory of node exporter textfile collector, JSON lines file and live endpoint
+METRICS_TEXTFILE_DIR = defaults.get('metrics_textfile_dir')
+METRICS_JSONL       = defaults.get('metrics_jsonl')
+METRICS_ADDRESS     = defaults.get('metrics_address', '127.0.0.1')
+METRICS_PORT        = int(defaults.get('metrics_port', 0))
+CATALOG_FILE        = defaults.get('catalog_file', os.path.join(BACKUPS_TOP_DIR, 'catalog.db'))
+# Backup files are uploaded to this bucket of RGW/S3 instead of BACKUPS_TOP_DIR if set
+S3_BUCKET           = defaults.get('s3_bucket')
+S3_PART_SIZE        = max(5*1024**2, int(defaults.get('s3_part_size', 16*1024**2)))
+S3_UPLOAD_INFLIGHT  = int(defaults.get('s3_upload_inflight', 4))
+S3_READ_SIZE        = int(defaults.get('s3_read_size', 8*1024**2))
+S3_READ_AHEAD       = int(defaults.get('s3_read_ahead', 2))
+S3_STORE            = S3Store(defaults.get('s3_endpoint', 'localhost'), S3_BUCKET,
+                              defaults.get('s3_access_key'), defaults.get('s3_secret_key'),
+                              defaults.get('s3_prefix', ''),
+                              defaults.get('s3_secure', 'no').lower() in ('yes', 'true', '1'),
+                              int(defaults.get('s3_workers', 16))) if S3_BUCKET else None
+if S3_STORE and (COMPRESSION == 'none' or DEDUP):
+    sys.exit("Backups in S3 are written compressed and without dedup, set compression "
+             "and disable dedup to use s3_bucket")
+CONTROL_SOCKET      = defaults.get('control_socket', '/var/run/ceph-backup.sock')
+# Ceph cluster, pools, Keystone, Nova and Cinder are connected on first use
+CLOUD = CloudHandles('/etc/ceph/ceph.conf', get_keystone_session)
 
 # Logging settings
 LOG.basicConfig(filename=LOG_FILE, level=LOG.INFO,
-                format="%(asctime)s %(levelname)s: %(message)s", 
+                format="%(asctime)s %(levelname)s [%(threadName)s]: %(message)s", 
                 datefmt="%Y-%m-%d %H:%M:%S")
 # Skip annoying info spam from "requests" and "paramiko"
 LOG.getLogger("requests").setLevel(LOG.WARNING)
@@ -831,102 +4794,144 @@ elif not args.list_backups:
     log_to_stdout.setFormatter(fmt)
     LOG.getLogger().addHandler(log_to_stdout)
 
+if args.queue:
+    request = {'command': 'backup' if args.backup_type else 'restore' if args.restore_date \
+                          else 'status',
+               'type': args.backup_type, 'date': args.restore_date, 'priority': args.priority,
+               'instances': [name.strip() for name in ",".join(args.instances).split(',') if name.strip()],
+               'volumes': [name.strip() for name in ",".join(args.volumes).split(',') if name.strip()],
+               'with_root_disks': args.backup_root_disks}
+    try:
+        reply = send_to_daemon(CONTROL_SOCKET, request)
+    except socket.error as msg:
+        sys.exit("ERROR: Cannot connect to the daemon at %s: %s" % (CONTROL_SOCKET, msg))
+    if not reply['ok']:
+        sys.exit("ERROR: %s" % reply['error'])
+    if 'status' in reply:
+        print_daemon_status(reply['status'])
+    else:
+        print("Queued job(s): %s" % ", ".join(map(str, reply['jobs'])))
+    sys.exit(0)
+METRICS_SERVER = METRICS.serve(METRICS_ADDRESS, METRICS_PORT) if METRICS_PORT else None
 check_directory_is_writeable(BACKUPS_TOP_DIR)
+CATALOG = BackupCatalog(CATALOG_FILE)
+SNAPSHOTS = SnapshotCache()
+# Restores always work with up-to-date attachments, listings of backups with any cached ones
+INVENTORY = Inventory(INVENTORY_CACHE, INVENTORY_CACHE_TTL, refresh=bool(args.restore_date),
+                      stale_ok=args.list_backups)
+if args.reindex:
+    CATALOG.reindex()
 BACKUP_TYPE = args.backup_type
 RESTORE_DATE = args.restore_date
 LIST_BACKUPS = args.list_backups
+METRICS.mode = 'backup' if BACKUP_TYPE else 'restore' if RESTORE_DATE else \
+               'verify' if args.verify else 'synthesize' if args.synthesize_full else None
 
-if args.instances:
-    INSTANCE_LIST = get_instance_list(instance_list=",".join(args.instances))
+TARGETS_GIVEN = bool(args.instances or args.volumes)
+if args.daemon:
+    # Targets are read from the config file by every scheduled run
+    INSTANCE_LIST = VOLUMES_LIST = INSTANCES_WITH_ROOT = INSTANCES_WITHOUT_ROOT = []
+elif TARGETS_GIVEN:
+    INSTANCE_LIST = get_instance_list(instance_list=",".join(args.instances)) \
+                    if args.instances else []
+    VOLUMES_LIST = get_volume_targets(get_volume_list(volume_list=",".join(args.volumes),
+                                                      instance_list=[])) if args.volumes else []
     INSTANCES_WITH_ROOT = []
     INSTANCES_WITHOUT_ROOT = []
 else:
     BACKUP_TARGETS = get_backup_targets(config)
     INSTANCES_WITH_ROOT = BACKUP_TARGETS['with_root_disk']
     INSTANCES_WITHOUT_ROOT = BACKUP_TARGETS['without_root_disk']
-    VOLUMES_LIST = BACKUP_TARGETS['volumes']
+    VOLUMES_LIST = get_volume_targets(BACKUP_TARGETS['volumes'])
     INSTANCE_LIST = INSTANCES_WITH_ROOT + INSTANCES_WITHOUT_ROOT
 
-if args.instances and not LIST_BACKUPS and not BACKUP_TYPE and not RESTORE_DATE:
-    print("ERROR: Instance list given but no action specified (choose from -b, -r or -l)")
+if TARGETS_GIVEN and not LIST_BACKUPS and not BACKUP_TYPE and not RESTORE_DATE \
+        and not args.synthesize_full and not args.verify:
+    print("ERROR: Instance or volume list given but no action specified "
+          "(choose from -b, -r, -l, --synthesize-full or --verify)")
+SCHEDULER = BackupScheduler(BACKUP_WORKERS, BACKUP_WORKERS_PER_HOST, BACKUP_WORKERS_PER_POOL)
+PRUNER = Pruner(PRUNE_WORKERS, PRUNE_WORKERS_PER_POOL)
+
 if LIST_BACKUPS:
     print(header.replace("-","="))
     print_backup_list_header()
     print(header.replace("-","="))
-for instance in sorted(INSTANCE_LIST, key=lambda f: f.tenant_id):
+THROTTLE = Throttle([args.config], THROTTLE_CONTROL)
+signal.signal(signal.SIGHUP, THROTTLE.request_reload)
+if BACKUP_TYPE or RESTORE_DATE or args.daemon:
+    THROTTLE.start_feedback()
+if BACKUP_TYPE and (INSTANCE_LIST or VOLUMES_LIST) and not TARGETS_GIVEN:
+    # Most images of the pools are backed up, list their snapshots at once
+    SNAPSHOTS.load_pool(CLOUD.ioctx(VMS_POOL))
+    SNAPSHOTS.load_pool(CLOUD.ioctx(VOLUMES_POOL))
+if BACKUP_TYPE == 'auto' and args.dry_run:
+    policy_report(sorted(INSTANCE_LIST, key=lambda f: f.tenant_id) + \
+                  sorted(VOLUMES_LIST, key=lambda f: f.tenant_id))
+    BACKUP_TYPE = None
+if COMPRESSION != 'none' and (BACKUP_TYPE or args.synthesize_full or args.daemon):
+    # Start compression workers before any backup threads
+    compress_pool()
+if args.verify:
+    verify_backups([os.path.basename(backup_folder(instance))
+                    for instance in INSTANCE_LIST + VOLUMES_LIST]
+                    if TARGETS_GIVEN else None, args.verify_sample)
+if args.synthesize_full and INSTANCE_LIST:
+    SCHEDULER.run(synthesize_full, sorted(INSTANCE_LIST, key=lambda f: f.tenant_id))
+if args.synthesize_full and VOLUMES_LIST:
+    SCHEDULER.run(synthesize_full, sorted(VOLUMES_LIST, key=lambda f: f.tenant_id))
+if BACKUP_TYPE and INSTANCE_LIST:
+    SCHEDULER.run(lambda instance: backup_instance_job(instance, full_backup=BACKUP_TYPE=='full',
+                                                       auto=BACKUP_TYPE=='auto'),
+                  sorted(INSTANCE_LIST, key=lambda f: f.tenant_id))
+if BACKUP_TYPE and VOLUMES_LIST:
+    backup_volumes(sorted(VOLUMES_LIST, key=lambda f: f.tenant_id),
+                   full_backup=BACKUP_TYPE=='full', auto=BACKUP_TYPE=='auto')
+for instance in sorted(INSTANCE_LIST, key=lambda f: f.tenant_id) + \
+        sorted(VOLUMES_LIST, key=lambda f: f.tenant_id):
     if LIST_BACKUPS:
         display_backups(instance)
         print(header)
         continue
-    elif (BACKUP_TYPE and INSTANCE_LIST) or (instance in INSTANCES_WITH_ROOT) or \
-            (instance in INSTANCES_WITHOUT_ROOT):
-        host = virsh_name = libvirt_conn = dom = None
-        rbd_list = []
-        # Check instance was launched from image, otherwise skip Nova RBD disks lookup
-        if instance.image and ((args.backup_root_disks and instance_in_ceph(instance)) or \
-                instance in INSTANCES_WITH_ROOT):
-            rbd_id = str(instance.id + "_disk")
-            rbd_list.append(rbd.Image(VMS_POOL_IOCTX, rbd_id))
-        volumes_attached = nova.volumes.get_server_volumes(instance.id)
-        host = getattr(instance, 'OS-EXT-SRV-ATTR:hypervisor_hostname')
-        virsh_name = getattr(instance, 'OS-EXT-SRV-ATTR:instance_name')
-        libvirt_conn=libvirt.open(LIBVIRT_URI % host)
-        dom = libvirt_conn.lookupByName(virsh_name)
-        if volumes_attached:
-            for volume in volumes_attached:
-                vol_id = str('volume-' + volume.id)
-                rbd_list.append(rbd.Image(VOLUMES_POOL_IOCTX, vol_id))
-        if not rbd_list:
-            # Instances with root disks not chosen for backup and having no
-            # volumes attached or with root disk not in Ceph have nothing to backup
-            LOG.warning("Nothing to backup for instance %s" % instance.name)
-            continue
-        #for rbd_img in rbd_list:
-        #    if is_clone(rbd_img):
-        #        LOG.info("Flattening RBD image %s/%s" % \
-        #                (detect_pool(rbd_img.name), rbd_img.name))
-        #        rbd_img.flatten()
-        if BACKUP_TYPE=='full':
-            instance_backup(instance, dom, rbd_list, full_backup=True)
-        elif BACKUP_TYPE=='inc':
-            instance_backup(instance, dom, rbd_list)
-        for rbd_image in rbd_list:
-            rbd_image.close()
-        libvirt_conn.close()
+    elif BACKUP_TYPE or not TARGETS_GIVEN:
+        # Backups are already done by the scheduler above, restores need
+        # an instance or volume given explicitly
         continue
     elif RESTORE_DATE:
-        if looks_like_date(RESTORE_DATE):
-            pass
-        elif looks_like_date(RESTORE_DATE, time_format=USER_TIME_FORMAT):
-            RESTORE_DATE = format_user_date(RESTORE_DATE)
-        else:
+        if not normalize_restore_date(RESTORE_DATE):
             raise Exception("Restore date doesn't match date format: %s or %s" 
                                 % (TIME_FORMAT, USER_TIME_FORMAT))
+        RESTORE_DATE = normalize_restore_date(RESTORE_DATE)
+        if len(INSTANCE_LIST) + len(VOLUMES_LIST) > 1:
+            print("ERROR: You may specify only a single instance or volume to restore")
             sys.exit(1)
-        if len(INSTANCE_LIST)>1:
-            print("ERROR: You may specify only a single instance to restore")
-            sys.exit(1)
-        restore_instance_inplace(instance, RESTORE_DATE)
+        if isinstance(instance, VolumeTarget):
+            restore_volume_inplace(instance, RESTORE_DATE)
+        else:
+            restore_instance_inplace(instance, RESTORE_DATE)
     elif RESTORE_DATE and not looks_like_date(RESTORE_DATE):
         raise Exception("Restore date doesn't match date format: %s" % TIME_FORMAT)
-#    if VOLUMES_LIST:
-#        for volume in VOLUMES_LIST:
-#               full_backup(instance, dom, [rbd_image])
-#                incremental_backup(instance, dom, [rbd_image])
-#            else:
-#                rbd_snap_create(rbd_name, snap_name)
+
+if args.daemon:
+    BackupDaemon([args.config], CONTROL_SOCKET, BACKUP_WORKERS).run()
 
 ## Clean up old files and sessions 
-rbd_inst = rbd.RBD()
-old_images = [image for image in rbd_inst.list(VMS_POOL_IOCTX) + \
-                rbd_inst.list(VOLUMES_POOL_IOCTX) if image.endswith('.bak')]
-for image in old_images:
-    with get_rbd_image_obj(image) as rbd_img:
-        remove_all_snapshots([rbd_img])
-    try:
-        rbd_inst.remove(get_pool_ioctx(image), image)
-    except rbd.ImageNotFound:
-        pass
-VMS_POOL_IOCTX.close()
-VOLUMES_POOL_IOCTX.close()
-ceph_cluster.shutdown()
+if BACKUP_TYPE or RESTORE_DATE:
+    prune_old_images()
+PRUNER.close()
+if PRUNER.time1:
+    LOG.info(PRUNER.summary())
+if METRICS.mode and args.dry_run:
+    METRICS.mode = None
+if METRICS.mode:
+    METRICS.write(METRICS_TEXTFILE_DIR, METRICS_JSONL)
+if METRICS_SERVER:
+    METRICS_SERVER.shutdown()
+    METRICS_SERVER.server_close()
+if COMPRESS_POOL:
+    COMPRESS_POOL.close()
+    COMPRESS_POOL.join()
+for conns in (LIBVIRT_CONNS, SSH_CONNS):
+    if conns.connects:
+        LOG.info(conns.summary())
+    conns.close_all()
+CLOUD.close()
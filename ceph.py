@@ -1,25 +1,216 @@
 #!/usr/bin/env python
+import os
+import re
+import sys
+import csv
 import rbd
 import rados
 import json
-import subprocess
-from itertools import chain
+import struct
+import argparse
+import threading
+from multiprocessing.pool import ThreadPool
 from texttable import Texttable, get_color_string, bcolors
 
+# Bits of rbd image features, names as in `rbd info`
+FEATURES = { "layering": 1, "striping": 2, "exclusive-lock": 4, "object-map": 8,
+             "fast-diff": 16, "deep-flatten": 32, "journaling": 64, "data-pool": 128 }
+FIELDS   = [ "pool", "image", "size", "features", "lockers", "stripe_unit", "stripe_count" ]
+# Binary snapshot: magic, then per image lengths of pool, image and lockers,
+# numeric fields and the three strings, lockers separated by newlines
+SNAPSHOT_MAGIC  = 'RBDINV1\n'
+SNAPSHOT_RECORD = struct.Struct('<HHHQQQQ')
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Show Ceph pools and RBD images in them")
+    parser.add_argument("-c", "--conf",
+                        default='/etc/ceph/ceph.conf',
+                        help="Ceph config file (default: %(default)s)")
+    parser.add_argument("-w", "--workers",
+                        type=int,
+                        default=32,
+                        help="Images inspected in parallel (default: %(default)s)")
+    parser.add_argument("-q", "--quiet",
+                        action='store_true',
+                        default=False,
+                        help="Don't report progress of pools on stderr")
+    parser.add_argument("-f", "--format",
+                        choices=['table', 'json', 'csv', 'binary'],
+                        default='table',
+                        help="Output format, all but table are written an image at a time as "
+                             "images are inspected: JSON lines, CSV or binary snapshot "
+                             "(default: %(default)s)")
+    parser.add_argument("--pool",
+                        help="Only pools with names matching this regular expression")
+    parser.add_argument("--min-size",
+                        type=int,
+                        default=0,
+                        help="Only images of at least that many MB")
+    parser.add_argument("--features",
+                        default='',
+                        help="Only images with all these comma separated features (%s)"
+                             % ', '.join(sorted(FEATURES, key=FEATURES.get)))
+    parser.add_argument("--diff",
+                        help="Only show images added, removed or changed since this binary "
+                             "snapshot (json and csv formats)")
+    parser.add_argument("--save",
+                        help="Also save binary snapshot of the images shown to this file, "
+                             "for a later --diff")
+    args = parser.parse_args()
+    args.feature_mask = 0
+    for name in filter(None, args.features.split(',')):
+        if name.strip() not in FEATURES:
+            parser.error("unknown feature %s" % name.strip())
+        args.feature_mask |= FEATURES[name.strip()]
+    if args.diff and args.format not in ('json', 'csv'):
+        parser.error("--diff needs json or csv format")
+    if args.save and args.format == 'table':
+        parser.error("--save needs json, csv or binary format")
+    return args
+
 def f(x):
     if x=="quota_max_bytes":
         return str(pool[x]/1024/1024)
     else:
         return str(pool[x])
 
-p = subprocess.check_output('ceph osd dump -f json-pretty', shell=True)
-pools       = json.loads(p)['pools']
-pools_table = Texttable()
-header      = [ "Id", "Pool", "Size", "Min_size", "Pg_num", "Pgp_num", "Crush","Quota (MB)", "Quota (obj)" ]
-keys        = [ "pool", "pool_name", "size", "min_size", "pg_num", "pg_placement_num", "crush_ruleset","quota_max_bytes","quota_max_objects" ]
-pools_table.header(map(lambda x: get_color_string(bcolors.YELLOW, x), header))
-for pool in pools:
-    pools_table.add_row(map(f, keys))
+class Progress(object):
+    # Count of inspected images of every pool, reported on stderr
+    def __init__(self, totals, quiet):
+        self.totals = totals
+        self.counts = dict((pool, 0) for pool in totals)
+        self.quiet = quiet
+        self.lock = threading.Lock()
+
+    def done(self, pool):
+        with self.lock:
+            self.counts[pool] += 1
+            count = self.counts[pool]
+        if not self.quiet and (count == self.totals[pool] or count % 1000 == 0):
+            sys.stderr.write("%s: %d/%d images inspected\n" % (pool, count, self.totals[pool]))
+
+def selected(record):
+    # Filters which need the image opened, pools are filtered before listing
+    return record['size'] >= args.min_size*1024**2 and \
+           record['features'] & args.feature_mask == args.feature_mask
+
+def inspect_image(task):
+    # Record of image opened read-only on the shared ioctx of its pool, None if
+    # it's gone or filtered out
+    pool, ioctx, image_name = task
+    try:
+        with rbd.Image(ioctx, image_name, read_only=True) as image:
+            lockers = image.list_lockers()
+            record = { "pool": pool, "image": image_name, "size": image.size(),
+                       "features": image.features(),
+                       "lockers": [' '.join(map(str, locker)) for locker in lockers['lockers']]
+                                  if lockers else [],
+                       "stripe_unit": image.stripe_unit(), "stripe_count": image.stripe_count() }
+        return record if selected(record) else None
+    except rbd.ImageNotFound:
+        return None
+    finally:
+        progress.done(pool)
+
+def table_row(record):
+    return ["", record['image'], str(record['size']/1024**2), str(record['features']),
+            ', '.join(record['lockers']), str(record['stripe_unit']), str(record['stripe_count'])]
+
+def pack_record(record):
+    pool, image, lockers = record['pool'], record['image'], '\n'.join(record['lockers'])
+    return SNAPSHOT_RECORD.pack(len(pool), len(image), len(lockers), record['size'],
+                                record['features'], record['stripe_unit'],
+                                record['stripe_count']) + pool + image + lockers
+
+def read_snapshot(path):
+    # Generator over records of binary snapshot
+    with open(path, 'rb') as f:
+        if f.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+            sys.exit("%s is not a binary snapshot of ceph.py" % path)
+        while True:
+            head = f.read(SNAPSHOT_RECORD.size)
+            if not head:
+                return
+            if len(head) < SNAPSHOT_RECORD.size:
+                sys.exit("%s is truncated" % path)
+            pool_len, image_len, lockers_len, size, features, stripe_unit, stripe_count = \
+                SNAPSHOT_RECORD.unpack(head)
+            pool, image = f.read(pool_len), f.read(image_len)
+            lockers = f.read(lockers_len)
+            yield { "pool": pool, "image": image, "size": size, "features": features,
+                    "lockers": lockers.split('\n') if lockers else [],
+                    "stripe_unit": stripe_unit, "stripe_count": stripe_count }
+
+class StreamWriter(object):
+    """
+    Writes records to stdout in JSON lines, CSV or binary snapshot format as
+    they come. With previous records (keyed by pool and image) only records
+    added or changed since are written, with "change" and "previous" values
+    of changed fields, and the ones left over are written as removed by
+    close(). With save path every record also goes to a binary snapshot
+    which replaces that file on close().
+    """
+    def __init__(self, fmt, previous=None, save=None):
+        self.fmt = fmt
+        self.previous = previous
+        self.save = save
+        self.out = sys.stdout
+        if fmt == 'csv':
+            self.csv = csv.writer(self.out)
+            self.csv.writerow(FIELDS + (["change", "previous"] if previous is not None else []))
+        elif fmt == 'binary':
+            self.out.write(SNAPSHOT_MAGIC)
+        if save:
+            self.snapshot = open(save + '.tmp', 'wb')
+            self.snapshot.write(SNAPSHOT_MAGIC)
+
+    def _emit(self, record, change=None, previous=None):
+        if self.fmt == 'json':
+            if change:
+                record = dict(record, change=change)
+                if previous:
+                    record['previous'] = previous
+            self.out.write(json.dumps(record, sort_keys=True) + '\n')
+        elif self.fmt == 'csv':
+            row = [';'.join(record[x]) if x == 'lockers' else record[x] for x in FIELDS]
+            if self.previous is not None:
+                row += [change, json.dumps(previous, sort_keys=True) if previous else '']
+            self.csv.writerow(row)
+        else:
+            self.out.write(pack_record(record))
+        self.out.flush()
+
+    def write(self, record):
+        if self.save:
+            self.snapshot.write(pack_record(record))
+        if self.previous is None:
+            self._emit(record)
+            return
+        old = self.previous.pop((record['pool'], record['image']), None)
+        if old is None:
+            self._emit(record, 'added')
+        else:
+            changed = dict((x, old[x]) for x in FIELDS if old[x] != record[x])
+            if changed:
+                self._emit(record, 'changed', changed)
+
+    def close(self):
+        if self.previous:
+            for key in sorted(self.previous):
+                self._emit(self.previous[key], 'removed')
+        if self.save:
+            self.snapshot.close()
+            os.rename(self.save + '.tmp', self.save)
+
+args = parse_args()
+pool_re = re.compile(args.pool) if args.pool else None
+
+previous = None
+if args.diff:
+    # Images of the previous snapshot the filters would skip now aren't removed
+    previous = dict(((record['pool'], record['image']), record)
+                    for record in read_snapshot(args.diff)
+                    if (not pool_re or pool_re.search(record['pool'])) and selected(record))
 
 table = Texttable()
 table.set_deco(Texttable.BORDER | Texttable.HEADER | Texttable.VLINES)
@@ -27,23 +218,58 @@ table.set_cols_align( [ "l", "l", "l", "l", "l", "l", "l" ])
 table.set_cols_valign([ "m", "m", "m", "m", "m", "m", "m" ])
 table.set_cols_width([ "20", "20", "8","8","20","8","8"])
 header = [ "Pool", "Image", "Size(Mb)", "Features", "Lockers", "Str_size", "Str_cnt" ]
-keys   = [ "features", "list_lockers", "stripe_unit", "stripe_count" ]
 table.header(map(lambda x: get_color_string(bcolors.YELLOW, x), header))
 
-with rados.Rados(conffile='/etc/ceph/ceph.conf') as cluster:
-    pool_list = cluster.list_pools()
-    for pool in pool_list:
-        table.add_row([  get_color_string(bcolors.GREEN, pool) , "", "", "", "", "", "" ])
-        with cluster.open_ioctx(pool) as ioctx:
-            rbd_inst = rbd.RBD()
-            image_list = rbd_inst.list(ioctx)
-            for image_name in image_list:
-                with rbd.Image(ioctx, image_name) as image:
-                    image_size = str(image.size()/1024**2)
-                    table.add_row(["", image_name, image_size] + map(lambda x: str(getattr(image,x)()), keys))
-        if pool != pool_list[-1]:
-            table.add_row([ "-"*20, "-"*20,"-"*8,"-"*8,"-"*20,"-"*8,"-"*8 ])
-
-print(pools_table.draw())
-print
-print(table.draw())
+with rados.Rados(conffile=args.conf) as cluster:
+    if args.format == 'table':
+        # Same as `ceph osd dump`, without running the CLI and connecting again
+        ret, out, err = cluster.mon_command(json.dumps({'prefix': 'osd dump', 'format': 'json'}), '')
+        if ret != 0:
+            sys.exit("osd dump failed: %s" % err)
+        pools       = json.loads(out)['pools']
+        pools_table = Texttable()
+        header      = [ "Id", "Pool", "Size", "Min_size", "Pg_num", "Pgp_num", "Crush","Quota (MB)", "Quota (obj)" ]
+        pool_keys   = [ "pool", "pool_name", "size", "min_size", "pg_num", "pg_placement_num", "crush_ruleset","quota_max_bytes","quota_max_objects" ]
+        pools_table.header(map(lambda x: get_color_string(bcolors.YELLOW, x), header))
+        for pool in pools:
+            if not pool_re or pool_re.search(pool['pool_name']):
+                pools_table.add_row(map(f, pool_keys))
+
+    # Images of all pools are inspected at once, every pool has one ioctx
+    # shared by the workers, librbd calls don't hold the GIL
+    pool_list = [pool for pool in cluster.list_pools() if not pool_re or pool_re.search(pool)]
+    ioctxs = dict((pool, cluster.open_ioctx(pool)) for pool in pool_list)
+    try:
+        images = dict((pool, rbd.RBD().list(ioctxs[pool])) for pool in pool_list)
+        progress = Progress(dict((pool, len(images[pool])) for pool in pool_list), args.quiet)
+        tasks = [(pool, ioctxs[pool], image_name) for pool in pool_list for image_name in images[pool]]
+        del images
+        workers = ThreadPool(max(1, args.workers))
+        try:
+            if args.format == 'table':
+                records = workers.imap(inspect_image, tasks, chunksize=16)
+                for pool in pool_list:
+                    table.add_row([  get_color_string(bcolors.GREEN, pool) , "", "", "", "", "", "" ])
+                    for n in range(progress.totals[pool]):
+                        record = next(records)
+                        if record:
+                            table.add_row(table_row(record))
+                    if pool != pool_list[-1]:
+                        table.add_row([ "-"*20, "-"*20,"-"*8,"-"*8,"-"*20,"-"*8,"-"*8 ])
+            else:
+                # Written in the order images are done, nothing is kept
+                writer = StreamWriter(args.format, previous, args.save)
+                for record in workers.imap_unordered(inspect_image, tasks, chunksize=16):
+                    if record:
+                        writer.write(record)
+                writer.close()
+        finally:
+            workers.terminate()
+    finally:
+        for ioctx in ioctxs.values():
+            ioctx.close()
+
+if args.format == 'table':
+    print(pools_table.draw())
+    print
+    print(table.draw())